@@ -68,6 +68,7 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'reserver.middleware.UserContextMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
 #   'django.middleware.clickjacking.XFrameOptionsMiddleware',
 #	'debug_toolbar.middleware.DebugToolbarMiddleware'
@@ -122,6 +123,22 @@ DATABASES = {
     }
 }
 
+# Cache
+# The default cache is local to each process, so clearing a cached value after a change only reaches the
+# process that made it. The admin overview and other cached values are kept briefly for that reason, and
+# default categories, email templates and settings are reloaded within REGISTRY_MAX_AGE in reserver/models.py.
+# With a shared backend here (memcached, Redis or the database cache) every process sees changes at once.
+# https://docs.djangoproject.com/en/1.11/topics/cache/
+
+# Authentication backends
+# the user context backend loads user data and organization along with the user; the default
+# backend is kept so sessions started before it was added stay logged in
+
+AUTHENTICATION_BACKENDS = [
+    'reserver.auth_backends.UserContextBackend',
+    'django.contrib.auth.backends.ModelBackend',
+]
+
 # Password validation
 # https://docs.djangoproject.com/en/1.11/ref/settings/#auth-password-validators
 
@@ -160,12 +177,42 @@ STATIC_URL = '/static/'
 
 STATIC_ROOT = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'reserver'+STATIC_URL)
 
+# Startup
+
+# maintenance tasks (reserver.maintenance) run when the development server starts, skipping those
+# already done; set this to False to only run them with manage.py run_maintenance
+RUN_MAINTENANCE_ON_BOOT = True
+
 # User-uploaded files
 
 MEDIA_URL = '/uploads/'
 
 MEDIA_ROOT = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'uploads/')
 
+# Uploads are served by reserver.views.upload_view after a permission check. Set UPLOAD_SENDFILE_HEADER to
+# 'X-Accel-Redirect' (nginx) or 'X-Sendfile' (Apache mod_xsendfile, lighttpd) to have the front-end server
+# send the file instead of a Python worker. For nginx, map UPLOAD_ACCEL_REDIRECT_PREFIX to MEDIA_ROOT in an
+# internal location, such as: location /protected-uploads/ { internal; alias /path/to/uploads/; }
+
+UPLOAD_SENDFILE_HEADER = None
+UPLOAD_ACCEL_REDIRECT_PREFIX = '/protected-uploads/'
+
+# Rendered cruise PDFs, named by a fingerprint of the cruise's contents so edits make new ones.
+# Served like other uploads, but only to superusers through the uploads URL, and left out of backups.
+
+CRUISE_PDF_CACHE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'uploads/pdf-cache/')
+CRUISE_PDF_WORKERS = 2 # processes rendering PDFs
+
+# Archived action logs, one gzipped JSON lines file per month. Kept outside MEDIA_ROOT so they're never served publicly.
+
+ACTION_ARCHIVE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'action-archive/')
+
+# Incremental backups: a content-addressed store of uploads and database snapshots, plus a manifest per run.
+# Made nightly when enabled; see reserver/backups.py and the incremental_backup, restore_backup and verify_backups commands.
+
+BACKUP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'backups/')
+NIGHTLY_BACKUPS_ENABLED = True
+
 # Email settings
 
 ANYMAIL = {
@@ -173,9 +220,31 @@ ANYMAIL = {
 	"MAILGUN_SENDER_DOMAIN": RESERVER_MAILGUN_SENDER_DOMAIN,
 }
 
-EMAIL_BACKEND = 'anymail.backends.mailgun.EmailBackend'
+# all mail goes through the tee backend, which sends using EMAIL_TEE_BACKEND and
+# archives a copy to EMAIL_FILE_PATH from a background thread
+EMAIL_BACKEND = 'reserver.email_backends.TeeEmailBackend'
+EMAIL_TEE_BACKEND = 'anymail.backends.mailgun.EmailBackend'
+EMAIL_ARCHIVE_QUEUE_SIZE = 1000
+# failed notification mail is retried with exponential backoff before it's dead-lettered,
+# and sends are rate limited per sender domain and per recipient domain
+EMAIL_MAX_DELIVERY_ATTEMPTS = 6
+EMAIL_RETRY_BASE_DELAY = 60 # seconds
+EMAIL_RETRY_MAX_DELAY = 6*60*60 # seconds
+EMAIL_SENDER_DOMAIN_RATE = 10 # messages per second
+EMAIL_RECIPIENT_DOMAIN_RATE = 2 # messages per second
+EMAIL_RATE_LIMIT_BURST = 20
+EMAIL_RATE_LIMIT_MAX_WAIT = 5 # seconds the retry job will wait for the rate limiter before deferring
+EMAIL_DELIVERY_CLAIM_TIME = 15*60 # seconds a send may take before the delivery counts as abandoned and is retried
 DEFAULT_FROM_EMAIL = 'no-reply@rvgunnerus.no'
 
+# Client debug logs posted to /log/ are capped in size and rate per user, and only the
+# newest DEBUG_DATA_MAX_ROWS logs younger than DEBUG_DATA_MAX_AGE_DAYS are kept
+DEBUG_DATA_MAX_PAYLOAD_SIZE = 75000 # bytes
+DEBUG_DATA_RATE_LIMIT = 10 # logs per user per DEBUG_DATA_RATE_PERIOD
+DEBUG_DATA_RATE_PERIOD = 60 # seconds
+DEBUG_DATA_MAX_ROWS = 1000
+DEBUG_DATA_MAX_AGE_DAYS = 30
+
 try:
 	from reserver.secrets import IS_DEV_SERVER
 	IS_DEV_SERVER
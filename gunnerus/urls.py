@@ -19,8 +19,6 @@ from django.conf.urls import include
 import sys
 from django.contrib.auth import views as auth_views
 from reserver import views
-from django.conf import settings
-from django.views.static import serve
 from reserver.views import *
 from django.contrib.auth.decorators import login_required, permission_required, user_passes_test
 from reserver.utils import init, server_starting
@@ -73,8 +71,10 @@ urlpatterns = [
 	url(r'^qr/(?P<b64_path>[\=0-9A-Za-z_\-]+)/qr.png$', views.path_to_qr_view, name='path-to-qr'),
 	url(r'^login/redirect/$', login_required(views.login_redirect), name='login-redirect'),
 	url(r'^admin/cruises/$', login_required(user_passes_test(lambda u: u.is_superuser)(views.admin_cruise_view)), name='admin-cruises'),
+	url(r'^admin/cruises/pdf/$', login_required(user_passes_test(lambda u: u.is_superuser)(views.admin_cruise_pdf_export_view)), name='admin-cruise-pdf-export'),
 	url(r'^admin/actions/$', login_required(user_passes_test(lambda u: u.is_superuser)(views.admin_actions_view)), name='admin-actions'),
 	url(r'^admin/statistics/$', login_required(user_passes_test(lambda u: u.is_superuser)(views.admin_statistics_view)), name='admin-statistics'),
+	url(r'^admin/statistics/series/$', login_required(user_passes_test(lambda u: u.is_superuser)(views.admin_statistics_series_view)), name='admin-statistics-series'),
 	url(r'^admin/users/$', login_required(user_passes_test(lambda u: u.is_superuser)(views.admin_user_view)), name='admin-users'),
 	url(r'^admin/users/(?P<pk>[0-9]+)/edit/$', login_required(user_passes_test(lambda u: u.is_superuser)(UserDataEditView.as_view())), name='edit-userdata'),
 	url(r'^admin/users/(?P<pk>[0-9]+)/set_as_admin/$', login_required(user_passes_test(lambda u: u.is_superuser)(views.set_as_admin)), name='user-set-admin'),
@@ -108,6 +108,8 @@ urlpatterns = [
 	url(r'^admin/notifications/(?P<pk>[0-9]+)/edit_notification/$', login_required(user_passes_test(lambda u: u.is_superuser)(NotificationEditView.as_view())), name='notification-update'),
 	url(r'^admin/notifications/(?P<pk>[0-9]+)/delete_notification/$', login_required(user_passes_test(lambda u: u.is_superuser)(NotificationDeleteView.as_view())), name='notification-delete'),
 	url(r'^admin/notifications/add_notification/$', login_required(user_passes_test(lambda u: u.is_superuser)(CreateNotification.as_view())), name='add-notification'),
+	url(r'^admin/notifications/(?P<pk>[0-9]+)/retry_delivery/$', login_required(user_passes_test(lambda u: u.is_superuser)(views.retry_email_delivery_view)), name='email-delivery-retry'),
+	url(r'^admin/notifications/(?P<pk>[0-9]+)/delete_delivery/$', login_required(user_passes_test(lambda u: u.is_superuser)(views.delete_email_delivery_view)), name='email-delivery-delete'),
 	url(r'^admin/notifications/(?P<pk>[0-9]+)/edit_email_template/$', login_required(user_passes_test(lambda u: u.is_superuser)(EmailTemplateEditView.as_view())), name='email-template-update'),
 	url(r'^admin/notifications/(?P<pk>[0-9]+)/reset_email_template/$', login_required(user_passes_test(lambda u: u.is_superuser)(views.email_template_reset_view)), name='email-template-reset'),
 	url(r'^admin/notifications/(?P<pk>[0-9]+)/delete_email_template/$', login_required(user_passes_test(lambda u: u.is_superuser)(EmailTemplateDeleteView.as_view())), name='email-template-delete'),
@@ -119,13 +121,14 @@ urlpatterns = [
 	url(r'^calendar/', views.calendar_event_source, name='calendar_event_source'),
 	url(r'^log/', views.log_debug_data, name='log-debug-data'),
 	url(r'^admin/debug/view/', views.admin_debug_view, name='view-debug-data'),
+	url(r'^admin/debug/(?P<pk>[0-9]+)/$', views.admin_debug_detail_view, name='view-debug-data-detail'),
 	url(r'^admin/emails/$', login_required(user_passes_test(lambda u: u.is_superuser)(views.view_email_logs)), name='email_list_view'),
 	url(r'^admin/emails/test/$', login_required(user_passes_test(lambda u: u.is_superuser)(views.test_email_view)), name='send_test_email_view'),
 	url(r'^admin/emails/purge/$', login_required(user_passes_test(lambda u: u.is_superuser)(views.purge_email_logs)), name='email_purge_view'),
 	url(r'^admin/backup/$', login_required(user_passes_test(lambda u: u.is_superuser)(views.backup_view)), name='backup-view'),
 	url(r'^cruises/cost/', views.cruise_receipt_source, name='cruise_receipt_source'),
 	url(r'^logout/$', auth_views.logout, {'next_page': 'home'}, name='logout'),
-	url(r'^uploads/(?P<path>.*)$', serve, {'document_root': settings.MEDIA_ROOT,}),
+	url(r'^uploads/(?P<path>.*)$', login_required(views.upload_view), name='upload'),
 	url(r'^hijack/', include('hijack.urls')),
 #	url(r'^__debug__/', include(debug_toolbar.urls)),
 ]
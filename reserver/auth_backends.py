@@ -0,0 +1,13 @@
+from django.contrib.auth import get_user_model
+from django.contrib.auth.backends import ModelBackend
+
+class UserContextBackend(ModelBackend):
+	""" Loads the user together with their user data and organization, since nearly every page reads them. """
+	
+	def get_user(self, user_id):
+		UserModel = get_user_model()
+		try:
+			user = UserModel._default_manager.select_related('userdata', 'userdata__organization').get(pk=user_id)
+		except UserModel.DoesNotExist:
+			return None
+		return user if self.user_can_authenticate(user) else None
@@ -0,0 +1,297 @@
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import zipfile
+import zlib
+
+from django.conf import settings
+from django.utils import timezone
+
+# these are compressed already, so they're stored as they are rather than deflated again
+COMPRESSED_FILE_EXTENSIONS = {
+	'.7z', '.bz2', '.docx', '.gif', '.gz', '.jpeg', '.jpg', '.mp3', '.mp4', '.odp', '.ods', '.odt',
+	'.pdf', '.png', '.pptx', '.rar', '.webp', '.xlsx', '.xz', '.zip',
+}
+# how many database pages to copy at a time, letting writers in between the steps
+BACKUP_PAGES_PER_STEP = 1024
+FILE_CHUNK_SIZE = 64*1024
+
+class StreamBuffer(object):
+	""" A write-only file for ZipFile that hands back what has been written since the last pop().
+	    It can't seek, so ZipFile writes sizes after each member instead of going back for them. """
+	def __init__(self):
+		self.chunks = []
+		self.position = 0
+
+	def write(self, data):
+		self.chunks.append(bytes(data))
+		self.position += len(data)
+		return len(data)
+
+	def tell(self):
+		return self.position
+
+	def flush(self):
+		pass
+
+	def pop(self):
+		data = b''.join(self.chunks)
+		self.chunks = []
+		return data
+
+def snapshot_database(destination_path):
+	""" Copies a consistent snapshot of the SQLite database to destination_path while the site keeps running. """
+	database = settings.DATABASES['default']
+	if database['ENGINE'] != 'django.db.backends.sqlite3':
+		raise ValueError("Only SQLite databases can be backed up this way")
+	source = sqlite3.connect(database['NAME'])
+	try:
+		if hasattr(source, 'backup'):
+			destination = sqlite3.connect(destination_path)
+			try:
+				source.backup(destination, pages=BACKUP_PAGES_PER_STEP)
+			finally:
+				destination.close()
+		else:
+			# Python before 3.7 has no backup API; this needs SQLite 3.27 or newer
+			source.execute("VACUUM INTO ?", (destination_path,))
+	finally:
+		source.close()
+
+def iter_folder_files(root, prefix, skipped_folders=()):
+	""" Yields (path, prefix + path relative to root) for the files under root, leaving out skipped_folders. """
+	skipped_folders = {os.path.normpath(folder) for folder in skipped_folders}
+	for folder, subfolders, filenames in os.walk(root):
+		subfolders[:] = sorted(subfolder for subfolder in subfolders if os.path.normpath(os.path.join(folder, subfolder)) not in skipped_folders)
+		for filename in sorted(filenames):
+			path = os.path.join(folder, filename)
+			yield path, prefix + os.path.relpath(path, root).replace(os.sep, "/")
+
+def get_backup_files(include_uploads=True):
+	""" Yields (path, name in archive) for the uploads, archived actions and migrations to back up, next to
+	    the database. Archived actions have been deleted from the database, so they're backed up even without uploads. """
+	if include_uploads and os.path.isdir(settings.MEDIA_ROOT):
+		# logged email copies and rendered PDFs aren't part of the backup
+		yield from iter_folder_files(settings.MEDIA_ROOT, "uploads/", [settings.EMAIL_FILE_PATH, settings.CRUISE_PDF_CACHE_PATH, settings.ACTION_ARCHIVE_PATH])
+	if os.path.isdir(settings.ACTION_ARCHIVE_PATH):
+		yield from iter_folder_files(settings.ACTION_ARCHIVE_PATH, "action-archive/")
+	migrations_folder = os.path.join(settings.BASE_DIR, "reserver", "migrations")
+	if os.path.isdir(migrations_folder):
+		for filename in sorted(os.listdir(migrations_folder)):
+			path = os.path.join(migrations_folder, filename)
+			if os.path.isfile(path):
+				yield path, "migrations/" + filename
+
+def write_file_to_archive(archive, buffer, path, name):
+	""" Adds the file to the archive a chunk at a time, yielding the archive bytes produced along the way. """
+	member = zipfile.ZipInfo.from_file(path, name)
+	if os.path.splitext(name)[1].lower() in COMPRESSED_FILE_EXTENSIONS:
+		member.compress_type = zipfile.ZIP_STORED
+	else:
+		member.compress_type = zipfile.ZIP_DEFLATED
+	with open(path, 'rb') as source, archive.open(member, 'w', force_zip64=member.file_size > zipfile.ZIP64_LIMIT//2) as destination:
+		while True:
+			chunk = source.read(FILE_CHUNK_SIZE)
+			if not chunk:
+				break
+			destination.write(chunk)
+			data = buffer.pop()
+			if data:
+				yield data
+	data = buffer.pop()
+	if data:
+		yield data
+
+def iter_backup_archive(include_uploads=True):
+	""" Yields a zip archive of a database snapshot, the uploads, the archived actions and the migrations
+	    in pieces, so it can be streamed without holding it in memory or on disk. """
+	buffer = StreamBuffer()
+	with tempfile.TemporaryDirectory() as snapshot_folder:
+		snapshot_path = os.path.join(snapshot_folder, 'db.sqlite3')
+		snapshot_database(snapshot_path)
+		archive = zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+		yield from write_file_to_archive(archive, buffer, snapshot_path, 'db.sqlite3')
+		for path, name in get_backup_files(include_uploads):
+			yield from write_file_to_archive(archive, buffer, path, name)
+		archive.close()
+		yield buffer.pop()
+
+# Incremental backups live in settings.BACKUP_PATH as a content-addressed store. Every file is kept once
+# under objects/, named by the SHA-256 of its contents, and each run adds a manifest under manifests/
+# listing the hash of the database snapshot and of every backed-up file at that point. A run only
+# stores objects that aren't there yet, so it costs as much as what changed since the last one.
+
+def get_object_folder():
+	return os.path.join(settings.BACKUP_PATH, 'objects')
+
+def get_manifest_folder():
+	return os.path.join(settings.BACKUP_PATH, 'manifests')
+
+def get_object_path(digest, compressed):
+	path = os.path.join(get_object_folder(), digest[:2], digest)
+	if compressed:
+		path += '.gz'
+	return path
+
+def find_object(digest):
+	""" Returns the path of the stored object with the given hash, or None if it isn't stored. """
+	for compressed in (True, False):
+		path = get_object_path(digest, compressed)
+		if os.path.exists(path):
+			return path
+	return None
+
+def open_object(path):
+	if path.endswith('.gz'):
+		return gzip.open(path, 'rb')
+	return open(path, 'rb')
+
+def get_file_hash(file):
+	digest = hashlib.sha256()
+	while True:
+		chunk = file.read(FILE_CHUNK_SIZE)
+		if not chunk:
+			break
+		digest.update(chunk)
+	return digest.hexdigest()
+
+def store_object(path, name):
+	""" Stores the file in the object store unless it's there already. Returns (hash, bytes written). """
+	with open(path, 'rb') as source:
+		digest = get_file_hash(source)
+	if find_object(digest) is not None:
+		return digest, 0
+	compressed = os.path.splitext(name)[1].lower() not in COMPRESSED_FILE_EXTENSIONS
+	object_path = get_object_path(digest, compressed)
+	os.makedirs(os.path.dirname(object_path), exist_ok=True)
+	# written under a temporary name, so an interrupted run never leaves a truncated object behind
+	partial_path = object_path + '.partial'
+	with open(path, 'rb') as source:
+		destination = gzip.open(partial_path, 'wb') if compressed else open(partial_path, 'wb')
+		with destination:
+			shutil.copyfileobj(source, destination, FILE_CHUNK_SIZE)
+	os.replace(partial_path, object_path)
+	return digest, os.path.getsize(object_path)
+
+def get_manifest_names():
+	""" Returns the names of the stored manifests, oldest first. """
+	if not os.path.isdir(get_manifest_folder()):
+		return []
+	return sorted(filename[:-len('.json')] for filename in os.listdir(get_manifest_folder()) if filename.endswith('.json'))
+
+def read_manifest(manifest_name):
+	with open(os.path.join(get_manifest_folder(), manifest_name + '.json'), 'r') as manifest_file:
+		return json.load(manifest_file)
+
+def create_incremental_backup(include_uploads=True):
+	""" Stores a database snapshot and the new or changed files, and writes a manifest for this point.
+	    Returns (manifest name, number of objects written, bytes written). """
+	manifest_names = get_manifest_names()
+	previous_manifest = read_manifest(manifest_names[-1]) if manifest_names else None
+	previous_files = previous_manifest['files'] if previous_manifest else {}
+	written_count = 0
+	written_size = 0
+
+	files = {}
+	for path, name in get_backup_files(include_uploads):
+		stat = os.stat(path)
+		previous_entry = previous_files.get(name)
+		# uploads are rarely touched once stored, so files that look the same as last time aren't read again
+		if previous_entry is not None and previous_entry['size'] == stat.st_size and previous_entry['mtime'] == stat.st_mtime and find_object(previous_entry['sha256']) is not None:
+			files[name] = previous_entry
+			continue
+		digest, size = store_object(path, name)
+		if size > 0:
+			written_count += 1
+			written_size += size
+		files[name] = {'sha256': digest, 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+	with tempfile.TemporaryDirectory() as snapshot_folder:
+		snapshot_path = os.path.join(snapshot_folder, 'db.sqlite3')
+		snapshot_database(snapshot_path)
+		digest, size = store_object(snapshot_path, 'db.sqlite3')
+		if size > 0:
+			written_count += 1
+			written_size += size
+		database = {'sha256': digest, 'size': os.path.getsize(snapshot_path)}
+
+	created = timezone.now()
+	# down to the microsecond, so runs close together don't share a name
+	manifest_name = created.strftime('%Y-%m-%d-%H%M%S-%f')
+	manifest = {
+		'created': created.isoformat(),
+		'previous': manifest_names[-1] if manifest_names else None,
+		'database': database,
+		'files': files,
+	}
+	os.makedirs(get_manifest_folder(), exist_ok=True)
+	manifest_path = os.path.join(get_manifest_folder(), manifest_name + '.json')
+	if os.path.exists(manifest_path):
+		# the next run's previous would point at the replaced manifest
+		raise ValueError("There is a backup named " + manifest_name + " already")
+	with open(manifest_path + '.partial', 'w') as manifest_file:
+		json.dump(manifest, manifest_file, sort_keys=True)
+	os.replace(manifest_path + '.partial', manifest_path)
+	return manifest_name, written_count, written_size
+
+def restore_backup(manifest_name, destination_folder):
+	""" Rebuilds the database and files recorded in the manifest into destination_folder, checking every
+	    object against its hash on the way. The database is restored as db.sqlite3, MEDIA_ROOT as uploads/
+	    and ACTION_ARCHIVE_PATH as action-archive/. """
+	manifest = read_manifest(manifest_name)
+	entries = [('db.sqlite3', manifest['database'])] + sorted(manifest['files'].items())
+	for name, entry in entries:
+		object_path = find_object(entry['sha256'])
+		if object_path is None:
+			raise ValueError("The backup of " + name + " is missing from the object store")
+		path = os.path.join(destination_folder, *name.split('/'))
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		digest = hashlib.sha256()
+		with open_object(object_path) as source, open(path, 'wb') as destination:
+			while True:
+				chunk = source.read(FILE_CHUNK_SIZE)
+				if not chunk:
+					break
+				digest.update(chunk)
+				destination.write(chunk)
+		if digest.hexdigest() != entry['sha256']:
+			raise ValueError("The backup of " + name + " is corrupt")
+		if 'mtime' in entry:
+			os.utime(path, (entry['mtime'], entry['mtime']))
+	return len(entries)
+
+def verify_backups(manifest_names=None):
+	""" Checks that every object the manifests refer to is stored and matches its hash.
+	    Returns a list of problems, which is empty when everything checks out. """
+	if manifest_names is None:
+		manifest_names = get_manifest_names()
+	problems = []
+	references = {}
+	for manifest_name in manifest_names:
+		try:
+			manifest = read_manifest(manifest_name)
+		except (OSError, ValueError) as e:
+			problems.append(manifest_name + ": the manifest can't be read (" + str(e) + ")")
+			continue
+		references.setdefault(manifest['database']['sha256'], (manifest_name, 'db.sqlite3'))
+		for name, entry in manifest['files'].items():
+			references.setdefault(entry['sha256'], (manifest_name, name))
+
+	# each object is hashed once, however many manifests refer to it
+	for digest, (manifest_name, name) in sorted(references.items()):
+		object_path = find_object(digest)
+		if object_path is None:
+			problems.append(manifest_name + ": " + name + " is missing from the object store")
+			continue
+		try:
+			with open_object(object_path) as source:
+				matches = get_file_hash(source) == digest
+		except (OSError, EOFError, zlib.error):
+			matches = False
+		if not matches:
+			problems.append(manifest_name + ": " + name + " is corrupt (" + object_path + ")")
+	return problems
@@ -0,0 +1,95 @@
+import mimetypes
+import os
+import re
+
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, parse_http_date_safe, quote_etag, urlquote
+
+FILE_CHUNK_SIZE = 64*1024
+RANGE_PATTERN = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+def get_file_etag(stat):
+	# changes whenever the file is replaced or rewritten, without reading it
+	return quote_etag("%x-%x" % (int(stat.st_mtime*1000000), stat.st_size))
+
+def get_requested_range(request, size, etag, last_modified):
+	""" Returns (start, end) of the single byte range asked for, None to send the whole file,
+	    or False if the range can't be satisfied. Several ranges at once get the whole file. """
+	match = RANGE_PATTERN.match(request.META.get('HTTP_RANGE', '').strip())
+	if match is None:
+		return None
+	# If-Range only asks for the range if the file hasn't changed since the client got its part
+	if_range = request.META.get('HTTP_IF_RANGE', '').strip()
+	if if_range and if_range != etag and parse_http_date_safe(if_range) != last_modified:
+		return None
+	first, last = match.groups()
+	if first == '':
+		if last == '' or int(last) == 0:
+			return False
+		return max(size-int(last), 0), size-1
+	start = int(first)
+	end = size-1 if last == '' else min(int(last), size-1)
+	if start >= size or end < start:
+		return False
+	return start, end
+
+def iter_file_range(path, start, end):
+	with open(path, 'rb') as file:
+		file.seek(start)
+		remaining = end-start+1
+		while remaining > 0:
+			chunk = file.read(min(FILE_CHUNK_SIZE, remaining))
+			if not chunk:
+				break
+			remaining -= len(chunk)
+			yield chunk
+
+def serve_file(request, path, filename=None):
+	""" Sends the file at path. When UPLOAD_SENDFILE_HEADER is set the front-end server does the
+	    transfer, including conditional and range requests; otherwise the file is streamed from here
+	    with ETag, Last-Modified and single byte ranges. """
+	content_type, encoding = mimetypes.guess_type(path)
+	if content_type is None or encoding is not None:
+		# compressed files are sent as they are, not for the browser to unpack
+		content_type = 'application/octet-stream'
+
+	if settings.UPLOAD_SENDFILE_HEADER == 'X-Accel-Redirect':
+		response = HttpResponse(content_type=content_type)
+		relative_path = os.path.relpath(path, settings.MEDIA_ROOT).replace(os.sep, '/')
+		response['X-Accel-Redirect'] = urlquote(settings.UPLOAD_ACCEL_REDIRECT_PREFIX + relative_path)
+	elif settings.UPLOAD_SENDFILE_HEADER == 'X-Sendfile':
+		response = HttpResponse(content_type=content_type)
+		response['X-Sendfile'] = path
+	else:
+		stat = os.stat(path)
+		etag = get_file_etag(stat)
+		last_modified = int(stat.st_mtime)
+		response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+		if response is not None:
+			# 304 Not Modified or 412 Precondition Failed
+			return response
+		requested_range = get_requested_range(request, stat.st_size, etag, last_modified)
+		if requested_range is False:
+			response = HttpResponse(status=416)
+			response['Content-Range'] = 'bytes */' + str(stat.st_size)
+			return response
+		elif requested_range is None:
+			# FileResponse hands the file to the server's wsgi.file_wrapper, which can use sendfile()
+			response = FileResponse(open(path, 'rb'), content_type=content_type)
+			response['Content-Length'] = str(stat.st_size)
+		else:
+			start, end = requested_range
+			response = StreamingHttpResponse(iter_file_range(path, start, end), content_type=content_type, status=206)
+			response['Content-Range'] = 'bytes ' + str(start) + '-' + str(end) + '/' + str(stat.st_size)
+			response['Content-Length'] = str(end-start+1)
+		response['ETag'] = etag
+		response['Last-Modified'] = http_date(last_modified)
+		response['Accept-Ranges'] = 'bytes'
+
+	if filename is not None:
+		response['Content-Disposition'] = "inline; filename*=UTF-8''" + urlquote(filename)
+	# uploads are only shown to some users, so shared caches mustn't keep them
+	patch_cache_control(response, private=True, no_cache=True)
+	return response
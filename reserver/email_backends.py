@@ -0,0 +1,106 @@
+import queue
+import threading
+from django.conf import settings
+from django.core.mail import get_connection
+from django.core.mail.backends.base import BaseEmailBackend
+from django.core.mail.backends.filebased import EmailBackend as FileEmailBackend
+from django.utils import timezone
+
+class LoggingFileEmailBackend(FileEmailBackend):
+	""" File backend that also records each written message in the EmailLog table,
+	    so the email log viewer never has to read the log files themselves. """
+	
+	def __init__(self, *args, notification=None, **kwargs):
+		self.notification = notification
+		super(LoggingFileEmailBackend, self).__init__(*args, **kwargs)
+		
+	def write_message(self, message):
+		from reserver.models import EmailLog
+		start = self.stream.tell()
+		super(LoggingFileEmailBackend, self).write_message(message)
+		self.stream.flush()
+		log = EmailLog()
+		log.timestamp = timezone.now()
+		log.subject = message.subject
+		log.recipients = ", ".join(message.recipients())
+		if self.notification is not None and self.notification.pk is not None:
+			log.notification = self.notification
+		log.file_path = self._get_filename()
+		log.size = self.stream.tell() - start
+		log.save()
+		
+class ArchiveWriter(object):
+	""" Writes archival copies of sent emails from a background thread. The queue is
+	    bounded; if it's full, the archival copy is dropped rather than delaying the send. """
+	
+	def __init__(self, max_queued_messages):
+		self.queue = queue.Queue(maxsize=max_queued_messages)
+		self.thread = None
+		self.lock = threading.Lock()
+		self.dropped_count = 0
+		
+	def put(self, email_messages, notification=None):
+		self.start()
+		for message in email_messages:
+			try:
+				self.queue.put_nowait((message, notification))
+			except queue.Full:
+				with self.lock:
+					self.dropped_count += 1
+				print("Email archive queue is full, dropped archival copy of: " + str(message.subject))
+				
+	def start(self):
+		with self.lock:
+			if self.thread is None or not self.thread.is_alive():
+				self.thread = threading.Thread(target=self.run, name="email-archive-writer", daemon=True)
+				self.thread.start()
+				
+	def flush(self):
+		""" Blocks until every queued archival copy has been written. """
+		self.queue.join()
+		
+	def run(self):
+		from django.db import close_old_connections
+		while True:
+			message, notification = self.queue.get()
+			try:
+				LoggingFileEmailBackend(notification=notification, fail_silently=True).send_messages([message])
+			except Exception as e:
+				print("There was an error archiving an email: ", e)
+			finally:
+				close_old_connections()
+				self.queue.task_done()
+				
+archive_writer = ArchiveWriter(getattr(settings, 'EMAIL_ARCHIVE_QUEUE_SIZE', 1000))
+
+class TeeEmailBackend(BaseEmailBackend):
+	""" Hands each message to the real transport (EMAIL_TEE_BACKEND) once, and queues an archival
+	    copy of each one it sent for the background writer instead of writing it in the caller. """
+	
+	def __init__(self, fail_silently=False, notification=None, **kwargs):
+		super(TeeEmailBackend, self).__init__(fail_silently=fail_silently)
+		self.notification = notification
+		self.connection = get_connection(settings.EMAIL_TEE_BACKEND, fail_silently=fail_silently, **kwargs)
+		
+	def open(self):
+		return self.connection.open()
+		
+	def close(self):
+		return self.connection.close()
+		
+	def send_messages(self, email_messages):
+		if not email_messages:
+			return 0
+		# one connection for the batch, but each message is sent on its own so only the ones the transport reports as sent are archived
+		new_connection_created = self.connection.open()
+		sent_messages = []
+		try:
+			for message in email_messages:
+				if self.connection.send_messages([message]):
+					sent_messages.append(message)
+		finally:
+			if new_connection_created:
+				self.connection.close()
+			if sent_messages:
+				archive_writer.put(sent_messages, self.notification)
+		return len(sent_messages)
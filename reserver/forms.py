@@ -9,22 +9,7 @@ from django.contrib.auth.models import User
 from django.contrib import messages
 from django.core.exceptions import PermissionDenied, ObjectDoesNotExist
 from django.utils.safestring import mark_safe
-from reserver.utils import check_for_and_fix_users_without_userdata, send_activation_email
-
-def check_for_and_fix_users_without_userdata():
-	for user in User.objects.all():
-		# check for users without user data, and add them to unapproved users if they're not admins
-		# these may be legacy accounts or accounts created using manage.py's adduser
-		try:
-			user.userdata
-		except:
-			user_data = UserData()
-			if user.is_superuser:
-				user_data.role = "admin"
-			else:
-				user_data.role = ""
-			user_data.user = user
-			user_data.save()
+from reserver.utils import send_activation_email
 
 class CruiseForm(ModelForm):
 	class Meta:
@@ -38,7 +23,6 @@ class CruiseForm(ModelForm):
 		return (self.cleaned_data['owner'] | User.objects.filter(pk=self.user.pk))
 
 	def __init__(self, *args, **kwargs):
-		check_for_and_fix_users_without_userdata()
 		if "request" in kwargs:
 			self.request = kwargs.pop("request")
 		super().__init__(*args, **kwargs)
@@ -154,6 +138,15 @@ class SettingsForm(ModelForm):
 		
 		self.fields['external_order_day_count'].label = "External cruise days per year"
 		self.fields['external_order_day_count'].help_text = "How many cruise days are available to internal users per year?"
+		
+		self.fields['email_log_retention_days'].label = "Days to keep email logs"
+		self.fields['email_log_retention_days'].help_text = "Logged copies of sent emails older than this are deleted every night."
+		
+		self.fields['email_log_max_size_mb'].label = "Maximum email log size (MB)"
+		self.fields['email_log_max_size_mb'].help_text = "If the logged emails take up more space than this, the oldest ones are deleted every night."
+		
+		self.fields['action_archive_age_days'].label = "Days before actions are archived"
+		self.fields['action_archive_age_days'].help_text = "Logged actions older than this are moved to compressed monthly archive files every night. Archived actions can still be browsed from the action log."
 class NotificationForm(ModelForm):
 	recips = forms.ModelMultipleChoiceField(queryset=UserData.objects.exclude(role=''), label='Individual users', required=False)
 	all = BooleanField(required=False)
@@ -241,9 +234,17 @@ class UserForm(ModelForm):
 		if "request" in kwargs:
 			self.request = kwargs.pop("request")
 		super().__init__(*args, **kwargs)
+		if self.instance.pk is not None:
+			preferences = get_user_preferences(self.instance)
+			self.fields['email_digest_enabled'].initial = preferences.email_digest_enabled
+			self.fields['digest_window_hours'].initial = preferences.digest_window_hours
+			self.fields['digest_admin_notices'].initial = preferences.digest_admin_notices
 		
 	new_password=CharField(widget=PasswordInput(), required=False)
 	confirm_password=CharField(widget=PasswordInput(), required=False)
+	email_digest_enabled = BooleanField(required=False, label="Send notifications as a digest", help_text="Collects cruise and season notifications into a single email instead of sending each one separately.")
+	digest_window_hours = forms.IntegerField(required=False, min_value=1, max_value=168, initial=24, label="Digest interval (hours)", help_text="How long notifications are collected before the digest is sent.")
+	digest_admin_notices = BooleanField(required=False, label="Include admin notices in the digest", help_text="Only relevant for administrators. Admin notices are sent immediately unless this is checked.")
 
 	def clean(self):
 		cleaned_data = super(UserForm, self).clean()
@@ -267,6 +268,12 @@ class UserForm(ModelForm):
 			send_activation_email(self.request, user)
 		if commit:
 			user.save()
+			preferences = get_user_preferences(user)
+			preferences.email_digest_enabled = self.cleaned_data["email_digest_enabled"]
+			if self.cleaned_data["digest_window_hours"]:
+				preferences.digest_window_hours = self.cleaned_data["digest_window_hours"]
+			preferences.digest_admin_notices = self.cleaned_data["digest_admin_notices"]
+			preferences.save()
 		return user
 
 class UserRegistrationForm(forms.ModelForm):
@@ -421,7 +428,7 @@ class CruiseDayForm(ModelForm):
 		event.name = "Cruise day " + str(start_datetime.date())
 		event.start_time = start_datetime
 		event.end_time = end_datetime
-		event.category = EventCategory.objects.get(name="Cruise day")
+		event.category = get_event_category("Cruise day")
 		
 		seasons = Season.objects.all()
 		for season in seasons:
@@ -442,7 +449,7 @@ class CruiseDayForm(ModelForm):
 class DocumentForm(ModelForm):
 	class Meta:
 		model = Document
-		exclude = ('cruise',)
+		exclude = ('cruise', 'original_name')
 		
 	def __init__(self, *args, **kwargs):
 		super().__init__(*args, **kwargs)
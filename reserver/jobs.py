@@ -1,12 +1,25 @@
 from reserver.models import *
 from datetime import datetime, timedelta, date
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from apscheduler.schedulers.background import BackgroundScheduler
 from django.core.mail import send_mail, get_connection
 from django.core.exceptions import ObjectDoesNotExist
-from smtplib import SMTPException
+from smtplib import SMTPException, SMTPRecipientsRefused
+from anymail.exceptions import AnymailAPIError, AnymailError, AnymailRecipientsRefused
+import os
+import gzip
+import json
+import random
+import threading
+import time
 from django.conf import settings
+from django.apps import apps
+from collections import OrderedDict
 from django.db import transaction
+from django.template.loader import render_to_string
+from django.utils.html import strip_tags
+from django.utils.safestring import mark_safe
 
 job_defaults = {
     'coalesce': False,
@@ -22,20 +35,200 @@ def daily_0800():
 def daily_0000():
 	""" runs once daily at 0000 - daily statistic logging, etc. """
 	collect_statistics()
+	apply_email_log_retention()
+	archive_old_actions()
+	apply_debug_data_retention()
+	log_integrity_sweeps()
+	create_nightly_backup()
+	
+def apply_email_log_retention(**kwargs):
+	""" Deletes logged emails older than the retention period, and then the oldest
+	    logged emails until the logs fit within the size limit. Returns the number of deleted logs. """
+	settings_object = get_settings_object()
+	cutoff = timezone.now()-timedelta(days=settings_object.email_log_retention_days)
+	if kwargs.get("delete_all"):
+		cutoff = timezone.now()
+		
+	# walk from the newest log until the size limit is reached; everything older than that goes
+	max_size = settings_object.email_log_max_size_mb*1024*1024
+	total_size = 0
+	for timestamp, size in EmailLog.objects.filter(timestamp__gte=cutoff).order_by('-timestamp').values_list('timestamp', 'size').iterator():
+		total_size += size
+		if total_size > max_size:
+			cutoff = timestamp + timedelta(microseconds=1)
+			break
+			
+	expired_logs = EmailLog.objects.filter(timestamp__lt=cutoff)
+	file_paths = set(expired_logs.values_list('file_path', flat=True).distinct())
+	deleted_count = expired_logs.count()
+	expired_logs.delete()
+	
+	# a file may hold several messages, so only remove files no longer referenced by any log
+	file_paths = list(file_paths)
+	for index in range(0, len(file_paths), 500):
+		chunk = set(file_paths[index:index+500])
+		chunk -= set(EmailLog.objects.filter(file_path__in=chunk).values_list('file_path', flat=True))
+		for file_path in chunk:
+			try:
+				os.remove(file_path)
+			except OSError:
+				pass
+	return deleted_count
+	
+def log_integrity_sweeps():
+	from reserver.utils import run_integrity_sweeps
+	for sweep, touched_count in run_integrity_sweeps().items():
+		print("Integrity sweep, " + sweep + ": " + str(touched_count) + " row(s) fixed")
+		
+def create_nightly_backup():
+	if not settings.NIGHTLY_BACKUPS_ENABLED:
+		return
+	from reserver.backups import create_incremental_backup
+	manifest_name, written_count, written_size = create_incremental_backup()
+	print("Nightly backup " + manifest_name + ": " + str(written_count) + " new object(s), " + str(written_size) + " bytes written")
+	
+def trim_debug_data():
+	""" Deletes all but the newest DEBUG_DATA_MAX_ROWS debug logs. Returns the number of deleted logs. """
+	oldest_kept = DebugData.objects.order_by('-pk').values_list('pk', flat=True)[settings.DEBUG_DATA_MAX_ROWS-1:settings.DEBUG_DATA_MAX_ROWS]
+	if len(oldest_kept) == 0:
+		return 0
+	return DebugData.objects.filter(pk__lt=oldest_kept[0]).delete()[0]
+	
+def apply_debug_data_retention():
+	""" Deletes debug logs older than DEBUG_DATA_MAX_AGE_DAYS, then trims the rest down to
+	    DEBUG_DATA_MAX_ROWS. Returns the number of deleted logs. """
+	cutoff = timezone.now()-timedelta(days=settings.DEBUG_DATA_MAX_AGE_DAYS)
+	deleted_count = DebugData.objects.filter(timestamp__lt=cutoff).delete()[0]
+	return deleted_count + trim_debug_data()
+	
+ACTION_ARCHIVE_CHUNK_SIZE = 500
+
+def get_action_archive_path(month):
+	""" Returns the path of the archive file for the given month, written as YYYY-MM. """
+	return os.path.join(settings.ACTION_ARCHIVE_PATH, 'actions-' + month + '.jsonl.gz')
+	
+def get_archived_action_months():
+	""" Returns the months that have archived actions, newest first. """
+	try:
+		file_names = os.listdir(settings.ACTION_ARCHIVE_PATH)
+	except OSError:
+		return []
+	return sorted([file_name[len('actions-'):-len('.jsonl.gz')] for file_name in file_names if file_name.startswith('actions-') and file_name.endswith('.jsonl.gz')], reverse=True)
+	
+def read_archived_actions(month):
+	""" Returns the archived actions for the given month as dicts, newest first. """
+	actions = {}
+	try:
+		with gzip.open(get_action_archive_path(month), 'rt', encoding='utf-8') as archive_file:
+			for line in archive_file:
+				try:
+					action = json.loads(line)
+				except ValueError:
+					# a line cut short by a crash mid-write; the rows it held weren't deleted and get archived again
+					continue
+				action['timestamp'] = parse_datetime(action['timestamp'])
+				# rows written again after an interrupted run are the same actions, so keep one copy of each
+				actions[action['id']] = action
+	except (OSError, EOFError):
+		pass
+	return sorted(actions.values(), key=lambda action: (action['timestamp'], action['id']), reverse=True)
+	
+def archive_old_actions(**kwargs):
+	""" Moves logged actions older than the archive age out of the database and into gzipped JSON lines
+	    files, one per month. Rows are only deleted once they've been written. Returns the number of archived actions. """
+	cutoff = timezone.now()-timedelta(days=get_settings_object().action_archive_age_days)
+	if kwargs.get("archive_all"):
+		cutoff = timezone.now()
+	if not os.path.exists(settings.ACTION_ARCHIVE_PATH):
+		os.makedirs(settings.ACTION_ARCHIVE_PATH)
+		
+	archived_count = 0
+	while True:
+		actions = list(Action.objects.filter(timestamp__lt=cutoff).select_related('user').order_by('timestamp', 'pk')[:ACTION_ARCHIVE_CHUNK_SIZE])
+		if len(actions) == 0:
+			break
+		actions_by_month = {}
+		for action in actions:
+			actions_by_month.setdefault(timezone.localtime(action.timestamp).strftime('%Y-%m'), []).append(action)
+		for month, month_actions in actions_by_month.items():
+			# each append adds a new gzip member, which readers see as one continuous file
+			with gzip.open(get_action_archive_path(month), 'at', encoding='utf-8') as archive_file:
+				for action in month_actions:
+					archive_file.write(json.dumps({
+						'id': action.pk,
+						'timestamp': action.timestamp.isoformat(),
+						'user_id': action.user_id,
+						'user': str(action.user),
+						'action': action.action,
+						'target': action.target,
+						'description': action.description,
+					}) + "\n")
+		Action.objects.filter(pk__in=[action.pk for action in actions]).delete()
+		archived_count += len(actions)
+	return archived_count
+	
+def count_querysets(querysets):
+	""" Counts each of the given {name: queryset} in a single query. Returns {name: count}. """
+	from django.db import connection
+	parts = []
+	params = []
+	for index, (name, queryset) in enumerate(querysets.items()):
+		sql, query_params = queryset.order_by().values('pk').query.sql_with_params()
+		parts.append('SELECT %s, COUNT(*) FROM (' + sql + ') counted_' + str(index))
+		params += [name] + list(query_params)
+	with connection.cursor() as cursor:
+		cursor.execute(' UNION ALL '.join(parts), params)
+		return {name: count for name, count in cursor.fetchall()}
+		
+def get_calendar_feed_size():
+	""" Returns the size in bytes of the calendar feed as served to visitors who aren't logged in. """
+	from django.contrib.auth.models import AnonymousUser
+	from django.http import HttpRequest
+	from reserver.views import calendar_event_source
+	request = HttpRequest()
+	request.method = 'GET'
+	request.user = AnonymousUser()
+	return len(calendar_event_source(request).content)
 	
 def collect_statistics():
-	statistics = Statistics()
-	statistics.timestamp = timezone.now()
-	statistics.event_count = Event.objects.all().count()
-	statistics.cruise_count = Cruise.objects.all().count()
-	statistics.approved_cruise_count = Cruise.objects.filter(is_approved=True).count()
-	statistics.cruise_day_count = CruiseDay.objects.all().count()
-	statistics.approved_cruise_day_count = CruiseDay.objects.filter(cruise__is_approved=True).count()
-	statistics.user_count = User.objects.all().count()
-	statistics.emailconfirmed_user_count = UserData.objects.filter(email_confirmed=True).count()
-	statistics.organization_count = Organization.objects.all().count()
-	statistics.email_notification_count = EmailNotification.objects.all().count()
-	statistics.save()
+	""" Stores today's statistics, replacing any already collected today. """
+	now = timezone.now()
+	querysets = OrderedDict([
+		('event_count', Event.objects.all()),
+		('cruise_count', Cruise.objects.all()),
+		('approved_cruise_count', Cruise.objects.filter(is_approved=True)),
+		('cruise_day_count', CruiseDay.objects.all()),
+		('approved_cruise_day_count', CruiseDay.objects.filter(cruise__is_approved=True)),
+		('user_count', User.objects.all()),
+		('emailconfirmed_user_count', UserData.objects.filter(email_confirmed=True)),
+		('organization_count', Organization.objects.all()),
+		('email_notification_count', EmailNotification.objects.all()),
+		('emails_sent', EmailDelivery.objects.filter(status=EmailDelivery.SENT, sent_time__gt=now-timedelta(days=1))),
+		('emails_pending', EmailDelivery.objects.filter(status=EmailDelivery.PENDING)),
+		('emails_failed', EmailDelivery.objects.filter(status=EmailDelivery.DEAD)),
+	])
+	for model in [User] + list(apps.get_app_config('reserver').get_models()):
+		querysets['rows:' + model._meta.db_table] = model.objects.all()
+	values = count_querysets(querysets)
+	
+	# time the same checks that run when a cruise is shown or submitted, without touching the cached results
+	upcoming_cruises = list(Cruise.objects.filter(cruise_end__gte=now))
+	if len(upcoming_cruises) > 0:
+		started = time.perf_counter()
+		for cruise in upcoming_cruises:
+			get_missing_cruise_information(cruise=cruise)
+		values['validation_ms'] = (time.perf_counter()-started)*1000/len(upcoming_cruises)
+		
+	try:
+		values['calendar_feed_bytes'] = get_calendar_feed_size()
+	except Exception as e:
+		print('Could not measure the calendar feed: ', e)
+		
+	database = settings.DATABASES['default']
+	if database['ENGINE'] == 'django.db.backends.sqlite3' and os.path.exists(database['NAME']):
+		values['database_bytes'] = os.path.getsize(database['NAME'])
+		
+	store_statistic_values(timezone.localtime(now).date(), values)
 
 @transaction.atomic
 def create_jobs(scheduler, notifs=None): #Creates jobs for given email notifications, or for all existing notifications if none given
@@ -48,6 +241,8 @@ def create_jobs(scheduler, notifs=None): #Creates jobs for given email notificat
 			job.remove()
 		scheduler.add_job(daily_0800, trigger='cron', day='*', hour=8)
 		scheduler.add_job(daily_0000, trigger='cron', day='*', hour=0)
+		scheduler.add_job(send_digests, trigger='cron', hour='*')
+		scheduler.add_job(retry_email_deliveries, trigger='interval', minutes=1)
 	else:
 		email_notifications = notifs
 	for notif in email_notifications:
@@ -165,17 +360,12 @@ def other_email(notif):
 		send_email(recipient.email, notif.template.message, notif)
 
 def send_email(recipients, message, notif, **kwargs):
-	# file path is set in settings.py as EMAIL_FILE_PATH
-	file_backend = get_connection('django.core.mail.backends.filebased.EmailBackend')
-	smtp_backend = get_connection(settings.EMAIL_BACKEND)
 	template = EmailTemplate()
 	subject = "Cruise reservation system notification"
 	
-	try:
-		if notif.is_sent:
-			return
-	except:
-		pass
+	# each recipient gets at most one delivery per notification; failed ones are retried by retry_email_deliveries
+	if notif.pk is not None and (EmailDelivery.objects.filter(notification=notif, recipient=recipients).exists() or DigestEntry.objects.filter(notification=notif, recipient=recipients).exists()):
+		return
 	
 	try:
 		if notif.template:
@@ -273,35 +463,17 @@ def send_email(recipients, message, notif, **kwargs):
 	if kwargs.get("subject"):
 		subject = kwargs["subject"]
 		
-	send_mail(
-		subject,
-		message,
-		settings.DEFAULT_FROM_EMAIL,
-		[recipients],
-		fail_silently=True,
-		connection=file_backend,
-		html_message=template.render(context)
-	)
-	
-	try:
-		send_mail(
-			subject,
-			message,
-			settings.DEFAULT_FROM_EMAIL,
-			[recipients],
-			fail_silently=False,
-			connection=smtp_backend,
-			html_message=template.render(context)
-		)
+	if recipients in get_digest_recipients([recipients], template.group):
+		add_digest_entry(recipients, subject, template, context, notif)
 		notif.is_sent = True
 		notif.save()
-	except SMTPException as e:
-		print('There was an error sending an email: ', e) 
+		return
+		
+	queue_email_delivery(recipients, subject, message, template.render(context), notif)
+	notif.is_sent = True
+	notif.save()
 		
 def send_template_only_email(recipients, template, **kwargs):
-	# file path is set in settings.py as EMAIL_FILE_PATH
-	file_backend = get_connection('django.core.mail.backends.filebased.EmailBackend')
-	smtp_backend = get_connection(settings.EMAIL_BACKEND)
 	subject = "Cruise reservation system notification"
 	
 	try:
@@ -336,28 +508,214 @@ def send_template_only_email(recipients, template, **kwargs):
 	if kwargs.get("subject"):
 		subject = kwargs["subject"]
 		
-	send_mail(
-		subject,
-		template.message,
-		settings.DEFAULT_FROM_EMAIL,
-		recipients,
-		fail_silently=True,
-		connection=file_backend,
-		html_message=template.render(context)
-	)
+	digest_recipients = get_digest_recipients(recipients, template.group)
+	for recipient in digest_recipients:
+		add_digest_entry(recipient, subject, template, context)
+	recipients = [recipient for recipient in recipients if recipient not in digest_recipients]
+	if len(recipients) == 0:
+		return
+		
+	html_message = template.render(context)
+	for recipient in recipients:
+		queue_email_delivery(recipient, subject, template.message, html_message)
+		
+# groups that are never digested, since the user is waiting for them right now
+undigestable_email_template_groups = {
+	'User administration',
+}
+
+admin_email_template_groups = {
+	'Admin notices',
+	'Admin deadline notice',
+}
+
+def get_digest_recipients(recipients, group):
+	""" Returns the set of the given email addresses whose owners want notifications of this group digested. """
+	if group in undigestable_email_template_groups:
+		return set()
+	preferences = UserPreferences.objects.filter(user__email__in=recipients, email_digest_enabled=True)
+	if group in admin_email_template_groups:
+		preferences = preferences.filter(digest_admin_notices=True)
+	return set(preferences.values_list('user__email', flat=True))
+	
+def add_digest_entry(recipient, subject, template, context, notif=None):
+	entry = DigestEntry()
+	entry.recipient = recipient
+	entry.notification = notif
+	entry.subject = subject
+	entry.group = template.group
+	entry.message = template.render_message_body(context)
+	entry.created = timezone.now()
+	entry.save()
+	
+def send_digests():
+	""" Sends one email per recipient containing every digest entry queued for them,
+	    once the oldest entry has waited for the recipient's digest window. """
+	entries_by_recipient = {}
+	for entry in DigestEntry.objects.filter(is_sent=False):
+		entries_by_recipient.setdefault(entry.recipient, []).append(entry)
+	if len(entries_by_recipient) == 0:
+		return
+		
+	window_by_recipient = dict(UserPreferences.objects.filter(user__email__in=entries_by_recipient.keys()).values_list('user__email', 'digest_window_hours'))
+	now = timezone.now()
+	for recipient, entries in entries_by_recipient.items():
+		window = timedelta(hours=window_by_recipient.get(recipient, 24))
+		if entries[0].created > now - window:
+			continue
+		if send_digest_email(recipient, entries):
+			DigestEntry.objects.filter(pk__in=[entry.pk for entry in entries]).update(is_sent=True)
+			
+def send_digest_email(recipient, entries):
+	""" Queues one email with all the entries, and returns its delivery. """
+	if len(entries) == 1:
+		subject = entries[0].subject
+	else:
+		subject = "Notification digest (" + str(len(entries)) + " notifications)"
+		
+	message = ""
+	html_body = ""
+	for entry in entries:
+		message += entry.subject + "\n" + strip_tags(entry.message) + "\n\n"
+		html_body += "<b>" + entry.subject + "</b><br>" + entry.message + "<br><br>"
+	html_message = render_to_string('reserver/emails/base.html', {
+		"title": subject,
+		"message": mark_safe(html_body),
+		"group": "Digest"
+	})
+	
+	return queue_email_delivery(recipient, subject, message.strip(), html_message)
+	
+class TokenBucket(object):
+	""" Allows bursts of up to capacity sends, refilled at rate sends per second. """
+	
+	def __init__(self, rate, capacity):
+		self.rate = rate
+		self.capacity = capacity
+		self.tokens = capacity
+		self.updated = time.monotonic()
+		
+	def get_wait_time(self):
+		""" Returns the number of seconds until a token is available, or 0 if one is available now. """
+		now = time.monotonic()
+		self.tokens = min(self.capacity, self.tokens + (now-self.updated)*self.rate)
+		self.updated = now
+		if self.tokens >= 1:
+			return 0
+		return (1-self.tokens)/self.rate
+		
+	def take(self):
+		self.tokens -= 1
+		
+# buckets live in this process only, which is fine since the scheduler and the views share it
+rate_limit_buckets = {}
+rate_limit_lock = threading.Lock()
+
+def get_rate_limit_bucket(key, rate):
+	if key not in rate_limit_buckets:
+		rate_limit_buckets[key] = TokenBucket(rate, settings.EMAIL_RATE_LIMIT_BURST)
+	return rate_limit_buckets[key]
+	
+def reserve_send_slot(recipient_domain):
+	""" Takes a token from both the sender domain and the recipient domain bucket if both have one.
+	    Returns 0 on success, or the number of seconds to wait before trying again. """
+	sender_domain = settings.DEFAULT_FROM_EMAIL.rpartition('@')[2].lower()
+	with rate_limit_lock:
+		buckets = [
+			get_rate_limit_bucket('sender:' + sender_domain, settings.EMAIL_SENDER_DOMAIN_RATE),
+			get_rate_limit_bucket('recipient:' + recipient_domain, settings.EMAIL_RECIPIENT_DOMAIN_RATE)
+		]
+		wait_time = max(bucket.get_wait_time() for bucket in buckets)
+		if wait_time == 0:
+			for bucket in buckets:
+				bucket.take()
+		return wait_time
+		
+def get_retry_delay(attempts):
+	""" Exponential backoff with jitter, so a failed blast doesn't retry in lockstep. """
+	delay = min(settings.EMAIL_RETRY_MAX_DELAY, settings.EMAIL_RETRY_BASE_DELAY*2**(attempts-1))
+	return random.uniform(delay/2, delay)
+	
+def is_permanent_email_error(error):
+	""" 5xx SMTP replies and 4xx API responses other than 429 Too Many Requests mean the message will
+	    never be accepted as it is, so retrying is pointless. """
+	if isinstance(error, SMTPRecipientsRefused):
+		return all(code >= 500 for code, message in error.recipients.values())
+	if isinstance(error, AnymailRecipientsRefused):
+		return True
+	if isinstance(error, AnymailAPIError):
+		return error.status_code is not None and 400 <= error.status_code < 500 and error.status_code != 429
+	return getattr(error, 'smtp_code', 0) >= 500
 	
+def queue_email_delivery(recipient, subject, message, html_message, notif=None):
+	delivery = EmailDelivery()
+	delivery.recipient = recipient
+	if notif is not None and notif.pk is not None:
+		delivery.notification = notif
+	delivery.subject = subject
+	delivery.message = message
+	delivery.html_message = html_message
+	delivery.created = timezone.now()
+	# claimed for the first attempt from the start, so retry_email_deliveries leaves it alone
+	delivery.next_attempt = delivery.created + timedelta(seconds=settings.EMAIL_DELIVERY_CLAIM_TIME)
+	delivery.save()
+	attempt_email_delivery(delivery)
+	return delivery
+	
+def attempt_email_delivery(delivery, max_wait=0):
+	""" Tries to send a delivery, waiting up to max_wait seconds for the rate limiter.
+	    Returns True if the message was sent. """
+	wait_time = reserve_send_slot(delivery.get_recipient_domain())
+	while 0 < wait_time <= max_wait:
+		time.sleep(wait_time)
+		wait_time = reserve_send_slot(delivery.get_recipient_domain())
+	if wait_time > 0:
+		# rate limited, which doesn't count as an attempt; left alone if someone else has picked it up meanwhile
+		next_attempt = timezone.now() + timedelta(seconds=wait_time)
+		EmailDelivery.objects.filter(pk=delivery.pk, status=EmailDelivery.PENDING, next_attempt=delivery.next_attempt).update(next_attempt=next_attempt)
+		delivery.next_attempt = next_attempt
+		return False
+		
+	# claims the delivery for this attempt, so nothing else sends it while it's underway however long
+	# that takes; if this process dies mid-send, it's retried once the claim runs out
+	claimed_until = timezone.now() + timedelta(seconds=settings.EMAIL_DELIVERY_CLAIM_TIME)
+	if not EmailDelivery.objects.filter(pk=delivery.pk, status=EmailDelivery.PENDING, next_attempt=delivery.next_attempt).update(next_attempt=claimed_until):
+		# sent, rescheduled or claimed by someone else since it was loaded
+		return False
+	delivery.next_attempt = claimed_until
+	delivery.attempts += 1
 	try:
+		# archived copy is written to EMAIL_FILE_PATH by the tee backend
 		send_mail(
-			subject,
-			template.message,
+			delivery.subject,
+			delivery.message,
 			settings.DEFAULT_FROM_EMAIL,
-			recipients,
+			[delivery.recipient],
 			fail_silently=False,
-			connection=smtp_backend,
-			html_message=template.render(context)
+			connection=get_connection(settings.EMAIL_BACKEND, notification=delivery.notification),
+			html_message=delivery.html_message or None
 		)
-	except SMTPException as e:
-		print('There was an error sending an email: ', e) 
+	except (SMTPException, OSError, AnymailError) as e:
+		# SMTP and connection failures, and the API errors of the Mailgun transport; anything else is a bug, not a delivery problem
+		print('There was an error sending an email: ', e)
+		delivery.last_error = str(e)
+		if delivery.attempts >= settings.EMAIL_MAX_DELIVERY_ATTEMPTS or is_permanent_email_error(e):
+			delivery.status = EmailDelivery.DEAD
+		else:
+			delivery.next_attempt = timezone.now() + timedelta(seconds=get_retry_delay(delivery.attempts))
+		delivery.save()
+		return False
+		
+	delivery.status = EmailDelivery.SENT
+	delivery.sent_time = timezone.now()
+	delivery.save()
+	return True
+	
+def retry_email_deliveries():
+	""" Sends pending deliveries that are due, pacing them to the rate limits. """
+	due_deliveries = EmailDelivery.objects.filter(status=EmailDelivery.PENDING, next_attempt__lte=timezone.now()).select_related('notification')
+	for delivery in list(due_deliveries):
+		attempt_email_delivery(delivery, max_wait=settings.EMAIL_RATE_LIMIT_MAX_WAIT)
 		
 def main():
 	#Scheduler which executes methods at set times in the future, such as sending emails about upcoming cruises to the leader, owners and participants on certain deadlines
@@ -0,0 +1,141 @@
+import base64
+import datetime
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import F, Q, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from django.utils.http import urlencode
+
+# sorts empty dates first
+EARLIEST_DATETIME = datetime.datetime(1900, 1, 1, tzinfo=timezone.utc)
+
+class AdminListing(object):
+	""" One page of an admin table. Sorting, searching and filtering happen in the database, and pages
+	    are found with a cursor on the sort value and primary key rather than an offset, so every page
+	    costs the same no matter how far into the table it is.
+
+	    sort_options maps a sort parameter to (label, field, value to sort NULLs as). Use None as the NULL
+	    value for columns that can't be NULL, so the database can walk an index on the column directly.
+	    filter_options maps a filter parameter to (label, lookup, [(value, label), ...]), or to
+	    (label, lookup, None) to accept any typed-in value. """
+
+	def __init__(self, request, queryset, sort_options, default_sort, search_fields=(), filter_options=None, page_size=25):
+		self.sort_options = sort_options
+		self.filter_options = filter_options or {}
+		self.page_size = page_size
+
+		self.sort = request.GET.get('sort', default_sort)
+		if self.sort.lstrip('-') not in sort_options:
+			self.sort = default_sort
+		self.descending = self.sort.startswith('-')
+
+		self.search = request.GET.get('q', '').strip()
+		if self.search and search_fields:
+			search_query = Q()
+			for field in search_fields:
+				search_query |= Q(**{field + '__icontains': self.search})
+			queryset = queryset.filter(search_query)
+
+		self.filters = {}
+		for name, (label, lookup, choices) in self.filter_options.items():
+			value = request.GET.get(name, '')
+			if choices is None:
+				value = value.strip()
+				if value:
+					self.filters[name] = value
+					queryset = queryset.filter(**{lookup: value})
+			elif value in [choice_value for choice_value, choice_label in choices]:
+				self.filters[name] = value
+				queryset = queryset.filter(**{lookup: value})
+
+		label, field, null_value = sort_options[self.sort.lstrip('-')]
+		if null_value is None:
+			queryset = queryset.annotate(listing_sort_key=F(field))
+		else:
+			queryset = queryset.annotate(listing_sort_key=Coalesce(F(field), Value(null_value)))
+		self.sort_key_field = queryset.query.annotations['listing_sort_key'].output_field
+
+		after = self.decode_cursor(request.GET.get('after'))
+		before = self.decode_cursor(request.GET.get('before'))
+		if before is not None:
+			# walk backwards from the cursor, then put the page back in display order
+			items = list(self.order(self.seek(queryset, before, not self.descending), not self.descending)[:page_size+1])
+			self.has_previous = len(items) > page_size
+			self.has_next = True
+			self.items = items[:page_size][::-1]
+		else:
+			if after is not None:
+				queryset = self.seek(queryset, after, self.descending)
+			items = list(self.order(queryset, self.descending)[:page_size+1])
+			self.has_previous = after is not None
+			self.has_next = len(items) > page_size
+			self.items = items[:page_size]
+
+	def __iter__(self):
+		return iter(self.items)
+
+	def __len__(self):
+		return len(self.items)
+
+	def order(self, queryset, descending):
+		if descending:
+			return queryset.order_by('-listing_sort_key', '-pk')
+		return queryset.order_by('listing_sort_key', 'pk')
+
+	def seek(self, queryset, cursor, descending):
+		sort_key, pk = cursor
+		if descending:
+			return queryset.filter(Q(listing_sort_key__lt=sort_key) | Q(listing_sort_key=sort_key, pk__lt=pk))
+		return queryset.filter(Q(listing_sort_key__gt=sort_key) | Q(listing_sort_key=sort_key, pk__gt=pk))
+
+	def encode_cursor(self, item):
+		sort_key = item.listing_sort_key
+		if isinstance(sort_key, (datetime.datetime, datetime.time)):
+			# DjangoJSONEncoder drops the microseconds past milliseconds, which would skip or repeat rows
+			sort_key = sort_key.isoformat()
+		cursor = json.dumps([sort_key, item.pk], cls=DjangoJSONEncoder)
+		return base64.urlsafe_b64encode(cursor.encode()).decode()
+
+	def decode_cursor(self, encoded_cursor):
+		if not encoded_cursor:
+			return None
+		try:
+			sort_key, pk = json.loads(base64.urlsafe_b64decode(encoded_cursor.encode()).decode())
+			return (self.sort_key_field.to_python(sort_key), int(pk))
+		except (ValueError, TypeError):
+			# a stale or mangled link just starts over from the first page
+			return None
+
+	def get_query_string(self, **kwargs):
+		parameters = {'sort': self.sort}
+		if self.search:
+			parameters['q'] = self.search
+		parameters.update(self.filters)
+		parameters.update(kwargs)
+		return '?' + urlencode(parameters)
+
+	def get_first_url(self):
+		return self.get_query_string()
+
+	def get_next_url(self):
+		if not self.has_next or len(self.items) == 0:
+			return None
+		return self.get_query_string(after=self.encode_cursor(self.items[-1]))
+
+	def get_previous_url(self):
+		if not self.has_previous or len(self.items) == 0:
+			return None
+		return self.get_query_string(before=self.encode_cursor(self.items[0]))
+
+	def get_sort_choices(self):
+		choices = []
+		for name, (label, field, null_value) in self.sort_options.items():
+			choices.append((name, label + ', ascending'))
+			choices.append(('-' + name, label + ', descending'))
+		return choices
+
+	def get_filter_choices(self):
+		""" Returns (parameter, label, choices, selected value) for each filter, for the template. """
+		return [(name, label, choices, self.filters.get(name, '')) for name, (label, lookup, choices) in self.filter_options.items()]
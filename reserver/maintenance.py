@@ -0,0 +1,69 @@
+import time
+
+from django.conf import settings
+from django.utils import timezone
+
+from reserver import utils
+from reserver.storage import deduplicate_documents
+
+def get_default_models_fingerprint():
+	from reserver.models import EmailTemplate, EventCategory, Organization
+	return ":".join([
+		str(Organization.objects.filter(name="R/V Gunnerus").exists()),
+		str(EventCategory.objects.filter(is_default=True).count()),
+		str(EmailTemplate.objects.filter(is_default=True).count()),
+		str(len(utils.default_email_templates)),
+	])
+
+def get_upload_folders_fingerprint():
+	import os
+	return ":".join(str(os.path.exists(path)) for path in [settings.MEDIA_ROOT, settings.EMAIL_FILE_PATH, settings.ACTION_ARCHIVE_PATH])
+
+# (name, version, function, fingerprint function or None), run in this order.
+# A task runs when it has never run, when its version is bumped here, or when its fingerprint
+# differs from the one recorded last time it ran. Bump the version to make a task run again,
+# such as after changing how missing cruise information is computed. Repairs of data that can
+# go wrong again run nightly as integrity sweeps instead; see utils.run_integrity_sweeps.
+MAINTENANCE_TASKS = [
+	("default_models", 1, utils.check_default_models, get_default_models_fingerprint),
+	("upload_folders", 1, utils.check_if_upload_folders_exist, get_upload_folders_fingerprint),
+	("cruise_info_caches", 1, utils.invalidate_cruise_info_caches, None),
+	("cruise_display_names", 1, utils.update_cruise_display_names, None),
+	("deduplicate_statistics", 1, utils.deduplicate_statistics, None),
+	("legacy_statistics", 1, utils.copy_legacy_statistics, None),
+	("red_day_holiday_dates", 1, utils.set_red_day_holiday_dates, None),
+	("deduplicate_documents", 1, deduplicate_documents, None),
+]
+
+def get_maintenance_task_names():
+	return [name for name, version, function, get_fingerprint in MAINTENANCE_TASKS]
+
+def run_maintenance_tasks(names=None, force=False):
+	""" Runs the maintenance tasks that are due, or only the named ones, or all of them if forced.
+	    Returns (task name, outcome, seconds) for each task, where outcome is "ran" or "skipped". """
+	from reserver.models import MaintenanceTask
+	records = {record.name: record for record in MaintenanceTask.objects.all()}
+	profile = []
+	for name, version, function, get_fingerprint in MAINTENANCE_TASKS:
+		if names is not None and name not in names:
+			continue
+		started = time.perf_counter()
+		fingerprint = get_fingerprint() if get_fingerprint is not None else ''
+		record = records.get(name)
+		if not force and record is not None and record.version == version and record.fingerprint == fingerprint:
+			profile.append((name, "skipped", time.perf_counter()-started))
+			continue
+
+		function()
+		# tasks can change what their fingerprint covers, so take it again before recording it
+		if get_fingerprint is not None:
+			fingerprint = get_fingerprint()
+		duration = time.perf_counter()-started
+		MaintenanceTask.objects.update_or_create(name=name, defaults={
+			'version': version,
+			'fingerprint': fingerprint,
+			'completed': timezone.now(),
+			'duration': duration,
+		})
+		profile.append((name, "ran", duration))
+	return profile
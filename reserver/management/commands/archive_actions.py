@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from reserver.jobs import archive_old_actions
+
+class Command(BaseCommand):
+	help = 'Moves logged actions older than the configured archive age into the monthly archive files.'
+	
+	def add_arguments(self, parser):
+		parser.add_argument('--all', action='store_true', help='Archive every logged action, regardless of age.')
+		
+	def handle(self, *args, **options):
+		archived_count = archive_old_actions(archive_all=options['all'])
+		self.stdout.write("Archived " + str(archived_count) + " actions")
@@ -0,0 +1,23 @@
+import os
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from reserver.backups import iter_backup_archive
+
+class Command(BaseCommand):
+	help = 'Writes a zip of a consistent database snapshot, the archived actions and the uploads, the same as the admin backup download. Safe to run while the site is up, such as from cron.'
+	
+	def add_arguments(self, parser):
+		parser.add_argument('path', nargs='?', help='Where to write the backup. Defaults to reserver-backup-<time>.zip in the current folder.')
+		parser.add_argument('--no-uploads', action='store_true', help='Only back up the database and the archived actions.')
+		
+	def handle(self, *args, **options):
+		path = options['path'] or 'reserver-backup-' + timezone.now().strftime('%Y-%m-%d-%H%M%S') + '.zip'
+		# written under a temporary name first, so a cron job never leaves a half-written backup behind
+		partial_path = path + '.partial'
+		with open(partial_path, 'wb') as backup_file:
+			for data in iter_backup_archive(include_uploads=not options['no_uploads']):
+				backup_file.write(data)
+		os.replace(partial_path, path)
+		self.stdout.write("Wrote backup to " + path)
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from reserver.storage import deduplicate_documents
+
+class Command(BaseCommand):
+	help = 'Moves cruise documents into the content-addressed store, so each distinct file is kept once, and deletes files no document refers to.'
+	
+	def handle(self, *args, **options):
+		moved_count, deleted_count, freed_size, skipped_documents = deduplicate_documents()
+		for pk, name in skipped_documents:
+			self.stdout.write("Document " + str(pk) + " refers to missing file " + name + ", skipped")
+		self.stdout.write("Moved " + str(moved_count) + " documents, deleted " + str(deleted_count) + " files, freed " + str(freed_size) + " bytes")
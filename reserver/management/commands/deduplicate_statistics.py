@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from reserver.utils import copy_legacy_statistics, deduplicate_statistics
+
+class Command(BaseCommand):
+	help = 'Fills in the day of statistics collected before they were limited to one per day, deletes the extra rows, and copies the rest into the per-metric statistics table.'
+	
+	def handle(self, *args, **options):
+		deleted_count = deduplicate_statistics()
+		self.stdout.write("Deleted " + str(deleted_count) + " duplicate statistics")
+		copied_count = copy_legacy_statistics()
+		self.stdout.write("Copied " + str(copied_count) + " days of statistics")
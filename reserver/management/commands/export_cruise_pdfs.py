@@ -0,0 +1,50 @@
+import datetime
+import shutil
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from reserver.models import Season
+from reserver.pdfs import get_cruises_between, get_merged_cruise_pdf
+
+class Command(BaseCommand):
+	help = 'Writes the summaries of every approved cruise in a season, or between two dates, to one PDF with a table of contents. Cruise PDFs are rendered in parallel, and cached ones are reused.'
+	
+	def add_arguments(self, parser):
+		parser.add_argument('path', help='Where to write the PDF.')
+		parser.add_argument('--season', help='Name or id of the season to export.')
+		parser.add_argument('--start', help='First day to export, as YYYY-MM-DD. Used with --end instead of --season.')
+		parser.add_argument('--end', help='Last day to export, as YYYY-MM-DD.')
+		parser.add_argument('--host', default='rvgunnerus.no', help='Host name the document QR codes link to.')
+		
+	def handle(self, *args, **options):
+		if options['season']:
+			seasons = Season.objects.select_related('season_event').filter(name=options['season'])
+			if options['season'].isdigit():
+				seasons = seasons | Season.objects.select_related('season_event').filter(pk=int(options['season']))
+			season = seasons.first()
+			if season is None:
+				raise CommandError("There is no season named " + options['season'])
+			if season.season_event is None:
+				raise CommandError("Season " + season.name + " has no dates set")
+			title = 'Cruise summaries for ' + season.name
+			start = season.season_event.start_time
+			end = season.season_event.end_time
+		else:
+			try:
+				start_date = parse_date(options['start'] or '')
+				end_date = parse_date(options['end'] or '')
+			except ValueError:
+				start_date = end_date = None
+			if start_date is None or end_date is None:
+				raise CommandError("Give either --season or both --start and --end as YYYY-MM-DD")
+			title = 'Cruise summaries, ' + str(start_date) + ' to ' + str(end_date)
+			start = timezone.make_aware(datetime.datetime.combine(start_date, datetime.time()))
+			end = timezone.make_aware(datetime.datetime.combine(end_date + datetime.timedelta(days=1), datetime.time()))
+			
+		cruises = list(get_cruises_between(start, end))
+		if len(cruises) == 0:
+			raise CommandError("There are no approved cruises to export in that period")
+		shutil.copyfile(get_merged_cruise_pdf(title, cruises, options['host']), options['path'])
+		self.stdout.write("Wrote the summaries of " + str(len(cruises)) + " cruises to " + options['path'])
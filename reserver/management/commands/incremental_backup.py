@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from reserver.backups import create_incremental_backup
+
+class Command(BaseCommand):
+	help = 'Stores a database snapshot and the uploads and archived actions that are new or changed since the last run in the incremental backup store.'
+	
+	def add_arguments(self, parser):
+		parser.add_argument('--no-uploads', action='store_true', help='Only back up the database and the archived actions.')
+		
+	def handle(self, *args, **options):
+		try:
+			manifest_name, written_count, written_size = create_incremental_backup(include_uploads=not options['no_uploads'])
+		except ValueError as e:
+			raise CommandError(str(e))
+		self.stdout.write("Wrote backup " + manifest_name + ": " + str(written_count) + " new object(s), " + str(written_size) + " bytes")
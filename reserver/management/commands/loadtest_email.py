@@ -0,0 +1,268 @@
+import os
+import random
+import shutil
+import socketserver
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import timedelta
+
+from django.core.mail.backends.smtp import EmailBackend as SMTPEmailBackend
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+
+class SMTPSinkHandler(socketserver.StreamRequestHandler):
+	""" Speaks just enough SMTP for smtplib to deliver messages, then throws them away or rejects them. """
+	
+	def reply(self, line):
+		self.wfile.write(line + b"\r\n")
+		
+	def handle(self):
+		self.reply(b"220 localhost SMTP sink")
+		while True:
+			line = self.rfile.readline()
+			if not line:
+				break
+			command = line.strip().split(b" ", 1)[0].upper()
+			if command == b"DATA":
+				self.reply(b"354 End data with <CR><LF>.<CR><LF>")
+				size = 0
+				while True:
+					data_line = self.rfile.readline()
+					if not data_line or data_line in (b".\r\n", b".\n"):
+						break
+					size += len(data_line)
+				if self.server.should_fail():
+					self.reply(str(self.server.failure_code).encode() + b" Injected failure")
+				else:
+					self.server.record_message(size)
+					self.reply(b"250 OK")
+			elif command == b"QUIT":
+				self.reply(b"221 Bye")
+				break
+			else:
+				self.reply(b"250 OK")
+				
+class SMTPSink(socketserver.ThreadingTCPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+	
+	def __init__(self, delay=0, failure_rate=0, failure_code=451):
+		socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), SMTPSinkHandler)
+		self.delay = delay
+		self.failure_rate = failure_rate
+		self.failure_code = failure_code
+		self.lock = threading.Lock()
+		self.message_count = 0
+		self.byte_count = 0
+		self.failure_count = 0
+		
+	def should_fail(self):
+		if random.random() >= self.failure_rate:
+			return False
+		with self.lock:
+			self.failure_count += 1
+		return True
+		
+	def record_message(self, size):
+		if self.delay:
+			time.sleep(self.delay)
+		with self.lock:
+			self.message_count += 1
+			self.byte_count += size
+			
+class TimingSMTPBackend(SMTPEmailBackend):
+	""" SMTP backend that records how long each batch spends in the transport. """
+	
+	durations = []
+	
+	def send_messages(self, email_messages):
+		start = time.perf_counter()
+		try:
+			return super(TimingSMTPBackend, self).send_messages(email_messages)
+		finally:
+			TimingSMTPBackend.durations.append(time.perf_counter() - start)
+			
+class ImmediateScheduler(object):
+	""" Stands in for the APScheduler instance; collects jobs so they can be run and timed in order. """
+	
+	def __init__(self):
+		self.jobs = []
+		
+	def add_job(self, func, trigger=None, kwargs=None, **options):
+		# recurring jobs such as daily_0800 are not part of the send path, and retries are driven by the command
+		if trigger not in ('cron', 'interval'):
+			self.jobs.append((func, kwargs or {}))
+			
+	def get_jobs(self):
+		return []
+		
+	def print_jobs(self):
+		pass
+		
+def percentile(sorted_values, fraction):
+	if len(sorted_values) == 0:
+		return 0
+	return sorted_values[int(round((len(sorted_values)-1)*fraction))]
+	
+class Command(BaseCommand):
+	help = 'Measures the notification email path end to end against a local SMTP sink, using a throwaway database.'
+	
+	def add_arguments(self, parser):
+		parser.add_argument('--users', type=int, default=200, help='Number of users to create, split between internal and external.')
+		parser.add_argument('--cruises', type=int, default=50, help='Number of cruises to create, each getting one cruise administration notification.')
+		parser.add_argument('--smtp-delay', type=float, default=0, help='Seconds the SMTP sink waits before accepting each message, to simulate a slow provider.')
+		parser.add_argument('--failure-rate', type=float, default=0, help='Fraction of messages the SMTP sink rejects, to exercise retries.')
+		parser.add_argument('--failure-code', type=int, default=451, help='SMTP reply code used for rejected messages; 5xx codes are permanent failures.')
+		parser.add_argument('--retry-delay', type=float, default=0.01, help='Base retry delay in seconds, replacing EMAIL_RETRY_BASE_DELAY so the run finishes quickly.')
+		parser.add_argument('--recipient-rate', type=float, default=None, help='Messages per second per recipient domain, replacing EMAIL_RECIPIENT_DOMAIN_RATE.')
+		parser.add_argument('--sender-rate', type=float, default=None, help='Messages per second per sender domain, replacing EMAIL_SENDER_DOMAIN_RATE.')
+		
+	def handle(self, *args, **options):
+		temp_dir = tempfile.mkdtemp(prefix='reserver-loadtest-')
+		sink = SMTPSink(delay=options['smtp_delay'], failure_rate=options['failure_rate'], failure_code=options['failure_code'])
+		sink_thread = threading.Thread(target=sink.serve_forever, daemon=True)
+		sink_thread.start()
+		
+		# never run against the real database; the test database is a throwaway file in temp_dir
+		connection.settings_dict.setdefault('TEST', {})['NAME'] = os.path.join(temp_dir, 'loadtest.sqlite3')
+		old_database_name = connection.settings_dict['NAME']
+		connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+		rate_settings = {}
+		if options['recipient_rate'] is not None:
+			rate_settings['EMAIL_RECIPIENT_DOMAIN_RATE'] = options['recipient_rate']
+		if options['sender_rate'] is not None:
+			rate_settings['EMAIL_SENDER_DOMAIN_RATE'] = options['sender_rate']
+		try:
+			with override_settings(
+				EMAIL_RETRY_BASE_DELAY=options['retry_delay'],
+				EMAIL_RETRY_MAX_DELAY=max(options['retry_delay']*64, 1),
+				**rate_settings
+			), override_settings(
+				EMAIL_TEE_BACKEND='reserver.management.commands.loadtest_email.TimingSMTPBackend',
+				EMAIL_HOST='127.0.0.1',
+				EMAIL_PORT=sink.server_address[1],
+				EMAIL_HOST_USER='',
+				EMAIL_HOST_PASSWORD='',
+				EMAIL_USE_TLS=False,
+				EMAIL_USE_SSL=False,
+				EMAIL_FILE_PATH=temp_dir,
+			):
+				self.seed(options['users'], options['cruises'])
+				self.run_benchmark(sink)
+		finally:
+			connection.creation.destroy_test_db(old_database_name, verbosity=0)
+			sink.shutdown()
+			sink.server_close()
+			shutil.rmtree(temp_dir, ignore_errors=True)
+			
+	def seed(self, user_count, cruise_count):
+		from django.contrib.auth.models import User
+		from reserver.models import Cruise, CruiseDay, EmailNotification, EmailTemplate, Event, EventCategory, Organization, Season, UserData
+		from reserver.utils import check_default_models
+		
+		self.stdout.write("Seeding " + str(user_count) + " users and " + str(cruise_count) + " cruises...")
+		check_default_models()
+		internal_org = Organization.objects.create(name="Load test internal", is_NTNU=True)
+		external_org = Organization.objects.create(name="Load test external", is_NTNU=False)
+		users = []
+		for index in range(user_count):
+			user = User.objects.create(username="loadtest" + str(index), email="loadtest" + str(index) + "@example.com", first_name="Load", last_name="Test " + str(index))
+			role = "internal" if index % 2 == 0 else "external"
+			UserData.objects.filter(user=user).update(role=role, organization=internal_org if role == "internal" else external_org)
+			users.append(user)
+			
+		now = timezone.now()
+		season_event = Event.objects.create(name="Load test season", start_time=now+timedelta(days=30), end_time=now+timedelta(days=200), category=EventCategory.objects.get(name="Season"))
+		internal_order_event = Event.objects.create(name="Internal opening of load test season", start_time=now-timedelta(minutes=5), category=EventCategory.objects.get(name="Internal season opening"))
+		external_order_event = Event.objects.create(name="External opening of load test season", start_time=now-timedelta(minutes=5), category=EventCategory.objects.get(name="External season opening"))
+		Season.objects.create(name="Load test season", season_event=season_event, internal_order_event=internal_order_event, external_order_event=external_order_event, long_education_price=1, long_research_price=1, long_boa_price=1, long_external_price=1, short_education_price=1, short_research_price=1, short_boa_price=1, short_external_price=1, breakfast_price=1, lunch_price=1, dinner_price=1)
+		EmailNotification.objects.create(event=internal_order_event, template=EmailTemplate.objects.get(title="Internal season opening"))
+		EmailNotification.objects.create(event=external_order_event, template=EmailTemplate.objects.get(title="External season opening"))
+		
+		cruise_day_category = EventCategory.objects.get(name="Cruise day")
+		message_template = EmailTemplate.objects.get(title="Cruise message")
+		for index in range(cruise_count):
+			leader = users[index % len(users)]
+			cruise = Cruise.objects.create(leader=leader, organization=leader.userdata.organization, description="Load test cruise", is_submitted=True, is_approved=True)
+			start_time = now + timedelta(days=31+index)
+			event = Event.objects.create(name="Cruise day " + str(start_time.date()), start_time=start_time, end_time=start_time+timedelta(hours=8), category=cruise_day_category)
+			CruiseDay.objects.create(cruise=cruise, event=event)
+			EmailNotification.objects.create(event=event, template=message_template, extra_message="Load test message")
+			
+	def run_benchmark(self, sink):
+		from reserver import jobs
+		from reserver.email_backends import archive_writer
+		from reserver.models import EmailDelivery, EmailTemplate
+		
+		render_durations = []
+		original_render = EmailTemplate.render
+		def timed_render(template, context):
+			start = time.perf_counter()
+			try:
+				return original_render(template, context)
+			finally:
+				render_durations.append(time.perf_counter() - start)
+				
+		send_durations = []
+		original_send_email = jobs.send_email
+		def timed_send_email(*args, **kwargs):
+			start = time.perf_counter()
+			try:
+				return original_send_email(*args, **kwargs)
+			finally:
+				send_durations.append(time.perf_counter() - start)
+				
+		TimingSMTPBackend.durations = []
+		jobs.rate_limit_buckets.clear()
+		scheduler = ImmediateScheduler()
+		EmailTemplate.render = timed_render
+		jobs.send_email = timed_send_email
+		tracemalloc.start()
+		try:
+			with CaptureQueriesContext(connection) as queries:
+				start = time.perf_counter()
+				# this is the same call daily_0800 makes against the real scheduler
+				jobs.create_jobs(scheduler)
+				for func, kwargs in scheduler.jobs:
+					func(**kwargs)
+				# stands in for the retry job, until every delivery is sent or dead-lettered
+				pending_deliveries = EmailDelivery.objects.filter(status=EmailDelivery.PENDING)
+				while pending_deliveries.exists():
+					next_attempt = pending_deliveries.order_by('next_attempt').values_list('next_attempt', flat=True)[0]
+					time.sleep(max((next_attempt-timezone.now()).total_seconds(), 0))
+					jobs.retry_email_deliveries()
+				elapsed = time.perf_counter() - start
+			current_memory, peak_memory = tracemalloc.get_traced_memory()
+		finally:
+			tracemalloc.stop()
+			EmailTemplate.render = original_render
+			jobs.send_email = original_send_email
+			
+		archive_start = time.perf_counter()
+		archive_writer.flush()
+		archive_elapsed = time.perf_counter() - archive_start
+		
+		message_count = sink.message_count
+		send_durations.sort()
+		query_time = sum(float(query.get('time') or 0) for query in queries.captured_queries)
+		render_time = sum(render_durations)
+		smtp_time = sum(TimingSMTPBackend.durations)
+		
+		self.stdout.write("Jobs run:              " + str(len(scheduler.jobs)))
+		self.stdout.write("Messages delivered:    " + str(message_count) + " (" + str(sink.byte_count) + " bytes)")
+		self.stdout.write("Injected failures:     " + str(sink.failure_count))
+		self.stdout.write("Dead-lettered:         " + str(EmailDelivery.objects.filter(status=EmailDelivery.DEAD).count()))
+		self.stdout.write("Total time:            %.3f s" % elapsed)
+		self.stdout.write("Messages per second:   %.1f" % (message_count/elapsed if elapsed else 0))
+		self.stdout.write("Per-message latency:   p50 %.1f ms, p95 %.1f ms" % (percentile(send_durations, 0.5)*1000, percentile(send_durations, 0.95)*1000))
+		self.stdout.write("Queries per message:   %.1f (%d queries)" % (len(queries.captured_queries)/message_count if message_count else 0, len(queries.captured_queries)))
+		self.stdout.write("Time in DB:            %.3f s" % query_time)
+		self.stdout.write("Time in render:        %.3f s" % render_time)
+		self.stdout.write("Time in SMTP:          %.3f s" % smtp_time)
+		self.stdout.write("Other time:            %.3f s" % max(elapsed-query_time-render_time-smtp_time, 0))
+		self.stdout.write("Peak Python memory:    %.1f MB" % (peak_memory/(1024*1024)))
+		self.stdout.write("Archive flush after:   %.3f s" % archive_elapsed)
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+
+from reserver.utils import check_for_and_fix_users_without_userdata
+
+class Command(BaseCommand):
+	help = 'Creates missing user data for accounts made before user data was created automatically.'
+	
+	def handle(self, *args, **options):
+		fixed_count = check_for_and_fix_users_without_userdata()
+		self.stdout.write("Created user data for " + str(fixed_count) + " user" + ("" if fixed_count == 1 else "s") + ".")
@@ -0,0 +1,33 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from reserver.backups import get_manifest_names, restore_backup
+
+class Command(BaseCommand):
+	help = 'Rebuilds the database, uploads and archived actions of an incremental backup into an empty folder. The running site is left alone.'
+	
+	def add_arguments(self, parser):
+		parser.add_argument('destination', help='Folder to restore into. It must be empty or not exist yet.')
+		parser.add_argument('--backup', help='Name of the backup to restore. Defaults to the newest one.')
+		parser.add_argument('--list', action='store_true', help='List the stored backups instead of restoring one.')
+		
+	def handle(self, *args, **options):
+		manifest_names = get_manifest_names()
+		if options['list']:
+			for manifest_name in manifest_names:
+				self.stdout.write(manifest_name)
+			return
+		if not manifest_names:
+			raise CommandError("There are no stored backups")
+		manifest_name = options['backup'] or manifest_names[-1]
+		if manifest_name not in manifest_names:
+			raise CommandError("There is no backup named " + manifest_name)
+		destination = options['destination']
+		if os.path.exists(destination) and os.listdir(destination):
+			raise CommandError(destination + " isn't empty")
+		try:
+			restored_count = restore_backup(manifest_name, destination)
+		except ValueError as e:
+			raise CommandError(str(e))
+		self.stdout.write("Restored " + str(restored_count) + " file(s) from backup " + manifest_name + " into " + destination)
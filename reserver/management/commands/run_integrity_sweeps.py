@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+
+from reserver.utils import run_integrity_sweeps
+
+class Command(BaseCommand):
+	help = 'Repairs users without user data, cruises without an organization, orphaned cruise day events and outdated main invoices. Also runs nightly.'
+	
+	def handle(self, *args, **options):
+		for sweep, touched_count in run_integrity_sweeps().items():
+			self.stdout.write(sweep + ": " + str(touched_count) + " row(s) fixed")
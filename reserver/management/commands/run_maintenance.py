@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from reserver.maintenance import get_maintenance_task_names, run_maintenance_tasks
+from reserver.utils import print_boot_profile
+
+class Command(BaseCommand):
+	help = 'Runs the maintenance tasks that are due, such as creating default models and repairing old data. Tasks that have already run are skipped.'
+	
+	def add_arguments(self, parser):
+		parser.add_argument('tasks', nargs='*', help='Only run these tasks. Available tasks: ' + ', '.join(get_maintenance_task_names()))
+		parser.add_argument('--force', action='store_true', help='Run the tasks even if they have already run.')
+		
+	def handle(self, *args, **options):
+		unknown_tasks = set(options['tasks']) - set(get_maintenance_task_names())
+		if unknown_tasks:
+			raise CommandError('Unknown maintenance tasks: ' + ', '.join(sorted(unknown_tasks)))
+		print_boot_profile(run_maintenance_tasks(names=options['tasks'] or None, force=options['force']), title="Maintenance")
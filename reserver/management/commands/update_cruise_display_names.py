@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from reserver.utils import update_cruise_display_names
+
+class Command(BaseCommand):
+	help = 'Rebuilds the stored display names of cruises, such as after adding the field to an existing database.'
+	
+	def add_arguments(self, parser):
+		parser.add_argument('--all', action='store_true', help='Rebuild every display name, not only the missing ones.')
+		
+	def handle(self, *args, **options):
+		update_cruise_display_names(update_all=options['all'])
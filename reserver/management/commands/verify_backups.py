@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from reserver.backups import get_manifest_names, verify_backups
+
+class Command(BaseCommand):
+	help = 'Checks that every file in the incremental backups is stored and matches its recorded hash.'
+	
+	def add_arguments(self, parser):
+		parser.add_argument('backups', nargs='*', help='Names of the backups to check. Defaults to all of them.')
+		
+	def handle(self, *args, **options):
+		manifest_names = options['backups'] or get_manifest_names()
+		problems = verify_backups(manifest_names)
+		for problem in problems:
+			self.stderr.write(problem)
+		if problems:
+			raise CommandError(str(len(problems)) + " problem(s) found")
+		self.stdout.write("Checked " + str(len(manifest_names)) + " backup(s), no problems found")
@@ -0,0 +1,20 @@
+from django.utils.functional import SimpleLazyObject
+
+from reserver.models import CruisePermissions
+
+def add_cruise_permissions(user):
+	user.cruise_permissions = CruisePermissions(user)
+	return user
+	
+class UserContextMiddleware(object):
+	""" Attaches a CruisePermissions helper to request.user, so permission checks
+	    made in loops share one lookup of the cruises the user leads or owns. """
+	
+	def __init__(self, get_response):
+		self.get_response = get_response
+		
+	def __call__(self, request):
+		# stays lazy, so requests that never touch the user don't load it
+		user = request.user
+		request.user = SimpleLazyObject(lambda: add_cruise_permissions(user))
+		return self.get_response(request)
@@ -1,14 +1,18 @@
+import copy
 import datetime
+import threading
 import time
-from django.db import models
+from collections import OrderedDict
+from django.db import models, transaction
 from django.utils import timezone
 from django.contrib.auth.models import User
 from django.core.exceptions import ObjectDoesNotExist
 from django.forms.models import model_to_dict
 from django.db.models.signals import post_save
 from django.dispatch import receiver
-from django.db.models.signals import post_delete
+from django.db.models.signals import post_delete, post_init
 from reserver.utils import render_add_cal_button
+from reserver.storage import document_storage, release_document_blob_on_commit
 from django.template.loader import render_to_string
 from decimal import *
 from multiselectfield import MultiSelectField
@@ -16,6 +20,8 @@ from sanitizer.models import SanitizedCharField
 from django.utils.safestring import mark_safe
 
 import base64
+import os
+import zlib
 import pyqrcode
 import random
 import re
@@ -27,10 +33,7 @@ internal_research_regex = re.compile("^ *[78]")
 PRICE_DECIMAL_PLACES = 2
 MAX_PRICE_DIGITS = 10 + PRICE_DECIMAL_PLACES # stores numbers up to 10^10-1 with 2 digits of accuracy
 
-def get_announcements(**kwargs):
-	""" Returns announcements for the user's role if defined,
-	    otherwise returns announcements for unauthorized users """
-	announcements = []
+def get_announcement_role(**kwargs):
 	role = "anon"
 	
 	if kwargs.get("user"):
@@ -38,16 +41,31 @@ def get_announcements(**kwargs):
 		if user.userdata and user.userdata.role != "":
 			role = user.userdata.role
 			
-	for announcement in Announcement.objects.filter(is_active=True):
-		if role in announcement.target_roles:
-			announcements.append(announcement)
-			
-	return announcements
+	return role
+	
+def get_announcements(**kwargs):
+	""" Returns announcements for the user's role if defined,
+	    otherwise returns announcements for unauthorized users """
+	role = get_announcement_role(**kwargs)
+	# target_roles is stored as a comma-separated list, so match whole entries only
+	return list(Announcement.objects.filter(is_active=True, target_roles__regex=r'(^|,)' + re.escape(role) + r'(,|$)'))
+	
+def get_announcements_cache_key(role):
+	return 'announcements_html_' + role
 	
+# changes clear the cache of the process that made them; others pick them up once this runs out, unless CACHES is shared
+ANNOUNCEMENTS_CACHE_TIMEOUT = 30
+
 def render_announcements(**kwargs):
-	announcements_string = ""
-	for announcement in get_announcements(**kwargs):
-		announcements_string += announcement.render()
+	""" Returns the announcement HTML for the user's role, cached per role until an announcement changes or briefly """
+	from django.core.cache import cache
+	cache_key = get_announcements_cache_key(get_announcement_role(**kwargs))
+	announcements_string = cache.get(cache_key)
+	if announcements_string is None:
+		announcements_string = ""
+		for announcement in get_announcements(**kwargs):
+			announcements_string += announcement.render()
+		cache.set(cache_key, announcements_string, ANNOUNCEMENTS_CACHE_TIMEOUT)
 	return announcements_string
 
 def get_cruise_receipt(**kwargs):
@@ -297,9 +315,12 @@ class Event(models.Model):
 	description = models.TextField(max_length=1000, blank=True, default='')
 	category = models.ForeignKey(EventCategory, on_delete=models.SET_NULL, null=True, blank=True)
 	is_hidden_from_users = models.BooleanField(default=False)
+	# only set for generated red days, which are unique per date
+	holiday_date = models.DateField(blank=True, null=True)
 	
 	class Meta:
 		ordering = ['name', 'start_time']
+		unique_together = (('category', 'holiday_date', 'name'),)
 	
 	def __str__(self):
 		return self.name
@@ -472,11 +493,93 @@ class EmailNotification(models.Model):
 				send_time = timezone.now()
 		return send_time
 		
+def get_user_preferences(user):
+	preferences = UserPreferences.objects.filter(user=user).first()
+	if preferences is None:
+		preferences = UserPreferences(user=user)
+		preferences.save()
+	return preferences
+	
+class EmailLog(models.Model):
+	timestamp = models.DateTimeField(db_index=True)
+	subject = models.CharField(max_length=1000, blank=True, default='')
+	recipients = models.TextField(blank=True, default='')
+	notification = models.ForeignKey(EmailNotification, on_delete=models.SET_NULL, blank=True, null=True)
+	file_path = models.CharField(max_length=1000)
+	size = models.PositiveIntegerField(default=0) # in bytes
+	
+	class Meta:
+		ordering = ['-timestamp']
+		
+	def __str__(self):
+		return self.subject + " " + str(self.timestamp)
+		
+	def get_file_name(self):
+		return os.path.basename(self.file_path)
+		
+	def get_url(self):
+		from django.conf import settings
+		return settings.MEDIA_URL + os.path.relpath(self.file_path, settings.MEDIA_ROOT).replace(os.sep, '/')
+
+class EmailDelivery(models.Model):
+	""" One outgoing message to one recipient, retried with backoff until sent or dead-lettered. """
+	PENDING = 'pending'
+	SENT = 'sent'
+	DEAD = 'dead'
+	STATUS_CHOICES = (
+		(PENDING, 'Pending'),
+		(SENT, 'Sent'),
+		(DEAD, 'Failed permanently'),
+	)
+
+	recipient = models.EmailField()
+	notification = models.ForeignKey(EmailNotification, on_delete=models.SET_NULL, blank=True, null=True)
+	subject = models.CharField(max_length=1000, blank=True, default='')
+	message = models.TextField(blank=True, default='')
+	html_message = models.TextField(blank=True, default='')
+	status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+	attempts = models.PositiveSmallIntegerField(default=0)
+	last_error = models.TextField(blank=True, default='')
+	created = models.DateTimeField()
+	next_attempt = models.DateTimeField(db_index=True)
+	sent_time = models.DateTimeField(blank=True, null=True)
+
+	class Meta:
+		ordering = ['next_attempt']
+		index_together = [['status', 'next_attempt']]
+
+	def __str__(self):
+		return self.subject + " to " + self.recipient
+
+	def get_recipient_domain(self):
+		return self.recipient.rpartition('@')[2].lower()
+
 class UserPreferences(models.Model):
 	user = models.ForeignKey(User, on_delete=models.CASCADE, blank=True, null=True)
 	
+	# digest mode collects notification emails and sends them as one email per window
+	email_digest_enabled = models.BooleanField(default=False)
+	digest_window_hours = models.PositiveSmallIntegerField(default=24)
+	# admin notices are time-sensitive, so they're only digested if explicitly requested
+	digest_admin_notices = models.BooleanField(default=False)
+	
 	def __str__(self):
-		return self.user.get_full_name + ' preferences'
+		return self.user.get_full_name() + ' preferences'
+		
+class DigestEntry(models.Model):
+	recipient = models.EmailField()
+	notification = models.ForeignKey(EmailNotification, on_delete=models.SET_NULL, blank=True, null=True)
+	subject = models.CharField(max_length=200, blank=True, default='')
+	group = models.CharField(max_length=200, blank=True, default='')
+	message = models.TextField(blank=True, default='')
+	created = models.DateTimeField(db_index=True)
+	is_sent = models.BooleanField(default=False)
+	
+	class Meta:
+		ordering = ['recipient', 'created']
+		
+	def __str__(self):
+		return self.subject + ' for ' + self.recipient
 
 class Season(models.Model):
 	name = models.CharField(max_length=100)
@@ -530,6 +633,22 @@ class Season(models.Model):
 		season_html = ""
 		return season_html
 
+class CruisePermissions(object):
+	""" Holds the ids of the cruises a user leads or owns, loaded once and reused by every permission check. """
+	
+	def __init__(self, user):
+		self.user = user
+		self.cruise_ids = None
+		
+	def get_cruise_ids(self):
+		if self.cruise_ids is None:
+			if self.user.is_authenticated():
+				self.cruise_ids = set(Cruise.objects.filter(leader=self.user).values_list('pk', flat=True))
+				self.cruise_ids.update(Cruise.objects.filter(owner=self.user).values_list('pk', flat=True))
+			else:
+				self.cruise_ids = set()
+		return self.cruise_ids
+		
 class Cruise(models.Model):
 	terms_accepted = models.BooleanField(default=False)
 	leader = models.ForeignKey(User, related_name='leader')
@@ -555,13 +674,23 @@ class Cruise(models.Model):
 	missing_information_cache_outdated = models.BooleanField(default=True)
 	missing_information_cache = models.TextField(blank=True, default='')
 	
+	# leader name and date range, kept up to date by receivers so __str__ doesn't need to query
+	display_name = models.CharField(max_length=500, blank=True, default='')
+	
+	def is_owned_by(self, user):
+		# uses the request's precomputed cruise ids when available
+		try:
+			return self.pk in user.cruise_permissions.get_cruise_ids()
+		except AttributeError:
+			return (user.pk == self.leader_id or self.owner.filter(pk=user.pk).exists())
+			
 	def is_viewable_by(self, user):
 		# if user is in cruise organization or user is superuser, leader or owner return true
 		# else nope
 		# unapproved users do not get to do anything at all, to prevent users from adding themselves to an org
-		user_is_owner = (user in self.owner.all() or user.pk == self.leader.pk)
-		user_is_in_cruise_organization = (user.userdata.organization.pk == self.organization.pk)
-		user_and_cruise_is_internal = ((user.userdata.role == "internal" or user.userdata.role == "invoicer") and self.organization.is_NTNU)
+		user_is_owner = self.is_owned_by(user)
+		user_is_in_cruise_organization = (user.userdata.organization_id is not None and user.userdata.organization_id == self.organization_id)
+		user_and_cruise_is_internal = ((user.userdata.role == "internal" or user.userdata.role == "invoicer") and self.organization is not None and self.organization.is_NTNU)
 		if user_is_owner or (not user.userdata.role == "" and (user_is_in_cruise_organization or user_and_cruise_is_internal or user.userdata.role == "admin")):
 			return True
 		else:
@@ -573,10 +702,10 @@ class Cruise(models.Model):
 	def is_editable_by(self, user):
 		# if user is leader or owner return true
 		# else return false
-		return (user in self.owner.all() or user.pk == self.leader.pk) and self.is_editable()
+		return self.is_owned_by(user) and self.is_editable()
 	
 	def is_cancellable_by(self, user):
-		return (user in self.owner.all() or user.pk == self.leader.pk) and self.is_cancellable()
+		return self.is_owned_by(user) and self.is_cancellable()
 	
 	def is_editable(self):
 		return not (self.is_approved and self.cruise_start < timezone.now())
@@ -800,23 +929,30 @@ class Cruise(models.Model):
 	def get_invoices(self):
 		return InvoiceInformation.objects.filter(cruise=self.pk)
 		
+	def get_main_invoice_title(self):
+		return "Main invoice for cruise " + str(self)
+		
+	def get_main_invoice_items(self):
+		""" Returns (name, price) of each item the main invoice is generated with, from the receipt. """
+		return [(item["name"] + ", " + str(item["count"]), Decimal(item["list_cost"])) for item in self.get_receipt()["items"] if Decimal(item["list_cost"]) > 0]
+		
+	def get_main_invoice_list_prices(self, invoice_pk):
+		""" Returns the unsaved generated items of the main invoice with the given pk, for bulk_create. """
+		return [ListPrice(invoice_id=invoice_pk, name=name, price=price, is_generated=True) for name, price in self.get_main_invoice_items()]
+		
 	def generate_main_invoice(self):
 		try:
 			invoice = InvoiceInformation.objects.get(cruise=self.pk, is_cruise_invoice=True)
-			receipt = self.get_receipt()
 			invoice_items = ListPrice.objects.filter(invoice=invoice.pk, is_generated=True)
 			
 			# update invoice title without saving to avoid recursion
-			InvoiceInformation.objects.filter(cruise=self.pk, is_cruise_invoice=True).update(title="Main invoice for cruise " + str(self))
+			InvoiceInformation.objects.filter(cruise=self.pk, is_cruise_invoice=True).update(title=self.get_main_invoice_title())
 			
 			# remove old items
 			invoice_items.delete()
 				
 			# generate new invoice items from receipt
-			for item in receipt["items"]:
-				if Decimal(item["list_cost"]) > 0:
-					new_item = ListPrice(invoice=invoice, name=item["name"] + ", " + str(item["count"]), price=Decimal(item["list_cost"]), is_generated=True)
-					new_item.save()
+			ListPrice.objects.bulk_create(self.get_main_invoice_list_prices(invoice.pk))
 		except ObjectDoesNotExist:
 			pass
 			
@@ -908,15 +1044,20 @@ class Cruise(models.Model):
 		return name + cruise_string
 
 	def __str__(self):
-		cruise_days = CruiseDay.objects.filter(cruise=self.pk)
+		if self.display_name:
+			return self.display_name
+		return self.build_display_name()
+		
+	def build_display_name(self):
+		""" Leader name and cruise date range, as stored in display_name. """
 		cruise_dates = []
+		for start_time in CruiseDay.objects.filter(cruise=self.pk).values_list('event__start_time', flat=True):
+			if start_time is not None:
+				cruise_dates.append(start_time)
+			else:
+				cruise_dates.append(datetime.datetime(1980, 1, 1))
 		cruise_string = ""
-		if cruise_days.count() is not 0:
-			for cruise_day in cruise_days:
-				if cruise_day.event is not None:
-					cruise_dates.append(cruise_day.event.start_time)
-				else:
-					cruise_dates.append(datetime.datetime(1980, 1, 1))
+		if len(cruise_dates) != 0:
 			cruise_string = " - "
 			start_string = str(cruise_dates[0].date())
 			end_string = str(cruise_dates[len(cruise_dates)-1].date())
@@ -933,6 +1074,11 @@ class Cruise(models.Model):
 		except:
 			name = "Temporary Cruise Name"
 		return name + cruise_string
+		
+	def update_display_name(self):
+		# saved with update() so the post_save receivers don't run again
+		self.display_name = self.build_display_name()
+		Cruise.objects.filter(pk=self.pk).update(display_name=self.display_name)
 
 	def was_edited_recently(self):
 		now = timezone.now()
@@ -1117,14 +1263,47 @@ class Announcement(models.Model):
 	def render(self):
 		return mark_safe('<div class="alert '+self.type+'">'+self.message+'</div>')
 		
+@receiver(post_save, sender=Announcement, dispatch_uid="invalidate_announcements_cache_receiver")
+@receiver(post_delete, sender=Announcement, dispatch_uid="invalidate_announcements_cache_receiver")
+def invalidate_announcements_cache_receiver(sender, instance, **kwargs):
+	from django.core.cache import cache
+	cache.delete_many([get_announcements_cache_key(role) for role, description in Announcement.USERGROUPS])
+	
 class Document(models.Model):
 	cruise = models.ForeignKey(Cruise, on_delete=models.CASCADE)
 
 	name = models.CharField(max_length=200, blank=True, default='')
-	file = models.FileField(blank=True, null=True)
+	# stored once per distinct content under its hash; see reserver/storage.py
+	file = models.FileField(blank=True, null=True, storage=document_storage)
+	original_name = models.CharField(max_length=255, blank=True, default='')
 	
 	def __str__(self):
 		return self.name
+		
+	def save(self, *args, **kwargs):
+		if self.file and not self.file._committed:
+			self.original_name = os.path.basename(self.file.name)
+		return super(Document, self).save(*args, **kwargs)
+		
+@receiver(post_init, sender=Document, dispatch_uid="remember_document_file_receiver")
+def remember_document_file_receiver(sender, instance, **kwargs):
+	# documents loaded without their file can't tell what they replaced; the dedupe command sweeps up after them
+	if 'file' in instance.get_deferred_fields():
+		instance.stored_file_name = None
+	else:
+		instance.stored_file_name = instance.file.name
+	
+@receiver(post_save, sender=Document, dispatch_uid="release_replaced_document_file_receiver")
+def release_replaced_document_file_receiver(sender, instance, **kwargs):
+	if instance.stored_file_name and instance.stored_file_name != instance.file.name:
+		release_document_blob_on_commit(instance.stored_file_name)
+	# a new document's first file is what its next replacement releases
+	instance.stored_file_name = instance.file.name
+		
+@receiver(post_delete, sender=Document, dispatch_uid="release_deleted_document_file_receiver")
+def release_deleted_document_file_receiver(sender, instance, **kwargs):
+	# also runs for documents deleted along with their cruise
+	release_document_blob_on_commit(instance.file.name)
 	
 class Participant(models.Model):
 	cruise = models.ForeignKey(Cruise, on_delete=models.CASCADE)
@@ -1168,6 +1347,7 @@ def time_is_in_season(time):
 def datetime_in_conflict_with_events(datetime):
 	""" Used with events that already are in the calendar, i.e. they're already in the date dict.
 	    Basically returns: Is there more than one scheduled thing happening on this date? True/False"""
+	ensure_red_days_for_range(datetime, datetime)
 	date_string = str(datetime.date())
 	busy_days_dict = get_event_dict_instance().get_dict()
 	if date_string in busy_days_dict:
@@ -1178,6 +1358,7 @@ def datetime_in_conflict_with_events(datetime):
 def unapproved_datetime_in_conflict_with_events(datetime):
 	""" Used with events that are not yet in the calendar.
 	    Basically returns: Would adding another event here create a conflict? True/False"""
+	ensure_red_days_for_range(datetime, datetime)
 	date_string = str(datetime.date())
 	busy_days_dict = get_event_dict_instance().get_dict()
 	if date_string in busy_days_dict:
@@ -1185,12 +1366,94 @@ def unapproved_datetime_in_conflict_with_events(datetime):
 	else:
 		return False
 		
+# Default objects and singletons are looked up once per process and then served from memory. The
+# registry is tied to a version counter in the cache, which is bumped whenever one of the models it
+# holds is saved or deleted. Processes sharing that cache drop their copies the next time they look;
+# with the default per-process cache only the process that made the change sees the bump, so copies
+# are also reloaded once they're REGISTRY_MAX_AGE old. Configure a shared CACHES backend (memcached,
+# Redis or the database cache) for changes to reach every process at once.
+REGISTRY_VERSION_CACHE_KEY = 'default_object_registry_version'
+REGISTRY_MAX_AGE = 60 # seconds
+registry_objects = {}
+registry_version = None
+registry_lock = threading.Lock()
+
+def get_registry_version():
+	from django.core.cache import cache
+	version = cache.get(REGISTRY_VERSION_CACHE_KEY)
+	if version is None:
+		cache.add(REGISTRY_VERSION_CACHE_KEY, 1, None)
+		version = cache.get(REGISTRY_VERSION_CACHE_KEY, 1)
+	return version
+	
+def bump_registry_version():
+	from django.core.cache import cache
+	try:
+		cache.incr(REGISTRY_VERSION_CACHE_KEY)
+	except ValueError:
+		# the counter was evicted; any value the old one can't have had works
+		cache.set(REGISTRY_VERSION_CACHE_KEY, int(time.time()*1000), None)
+		
+def get_registered_object(key, load):
+	""" Returns a copy of the object stored under key, loading it with load() if this process
+	    doesn't have it for the current registry version. Copies keep callers' changes to their
+	    instance, such as from an unsaved form, out of the registry. """
+	global registry_version
+	version = get_registry_version()
+	now = time.monotonic()
+	with registry_lock:
+		if version != registry_version:
+			registry_objects.clear()
+			registry_version = version
+		if key in registry_objects:
+			loaded_at, registered_object = registry_objects[key]
+			if now-loaded_at < REGISTRY_MAX_AGE:
+				return copy.copy(registered_object)
+	registered_object = load()
+	with registry_lock:
+		if registry_version == version:
+			registry_objects[key] = (now, registered_object)
+	return copy.copy(registered_object)
+	
+def get_event_category(name):
+	""" Returns the event category with the given name, recreating the default categories first if it's missing. """
+	def load():
+		try:
+			return EventCategory.objects.get(name=name)
+		except EventCategory.DoesNotExist:
+			from reserver.utils import check_default_models
+			check_default_models()
+			return EventCategory.objects.get(name=name)
+	return get_registered_object(('event_category', name), load)
+	
+def get_email_template(title):
+	""" Returns the email template with the given title, recreating the default templates first if it's missing. """
+	def load():
+		try:
+			return EmailTemplate.objects.get(title=title)
+		except EmailTemplate.DoesNotExist:
+			from reserver.utils import check_default_models
+			check_default_models()
+			return EmailTemplate.objects.get(title=title)
+	return get_registered_object(('email_template', title), load)
+	
+def ensure_default_models():
+	""" Runs check_default_models once per registry version, i.e. again only after a category or template has changed. """
+	def load():
+		from reserver.utils import check_default_models
+		check_default_models()
+		return True
+	get_registered_object('default_models_checked', load)
+	
 def get_settings_object():
-	settings_object = Settings.objects.all().first()
-	if settings_object is None:
-		settings_object = Settings()
-		settings_object.save()
-	return settings_object
+	def load():
+		with transaction.atomic():
+			settings_object = Settings.objects.select_for_update().order_by('pk').first()
+			if settings_object is None:
+				settings_object = Settings()
+				settings_object.save()
+		return settings_object
+	return get_registered_object('settings', load)
 	 
 class Settings(models.Model):
 	emails_enabled = models.BooleanField(default=True)
@@ -1198,15 +1461,48 @@ class Settings(models.Model):
 	last_cancel_date = models.IntegerField(default=16)
 	internal_order_day_count = models.PositiveSmallIntegerField(default=150)
 	external_order_day_count = models.PositiveSmallIntegerField(default=30)
+	email_log_retention_days = models.PositiveSmallIntegerField(default=90)
+	email_log_max_size_mb = models.PositiveIntegerField(default=100)
+	action_archive_age_days = models.PositiveSmallIntegerField(default=365)
 	
 	def __str__(self):
 		return "Settings object"
 
+class RedDayYear(models.Model):
+	""" A year whose Norwegian red days have been created as events. """
+	year = models.PositiveSmallIntegerField(unique=True)
+	
+	def __str__(self):
+		return str(self.year)
+		
+# years known to have red days, so checking them again costs nothing
+materialized_red_day_years = set()
+
+def ensure_red_days_for_years(years):
+	""" Creates the red day events of the given years that don't have them yet. """
+	from reserver.utils import create_events_from_list, get_red_days_for_year
+	missing_years = set(years) - materialized_red_day_years
+	if len(missing_years) == 0:
+		return
+	done_years = set(RedDayYear.objects.filter(year__in=missing_years).values_list('year', flat=True))
+	for year in sorted(missing_years - done_years):
+		create_events_from_list(get_red_days_for_year(year))
+		RedDayYear.objects.get_or_create(year=year)
+	if len(missing_years - done_years) > 0:
+		set_date_dict_outdated()
+	materialized_red_day_years.update(missing_years)
+	
+def ensure_red_days_for_range(start, end):
+	""" Creates the red days of the years from start to end, which can be dates or datetimes. """
+	ensure_red_days_for_years(range(start.year, end.year+1))
+	
 def get_event_dict_instance():
-	event_dict_instance = EventDictionary.objects.all().first()
-	if event_dict_instance is None:
-		event_dict_instance = EventDictionary()
-		event_dict_instance.save()
+	# read from the database every time; it's marked outdated whenever an event changes, so a copy kept in memory would go stale
+	with transaction.atomic():
+		event_dict_instance = EventDictionary.objects.select_for_update().order_by('pk').first()
+		if event_dict_instance is None:
+			event_dict_instance = EventDictionary()
+			event_dict_instance.save()
 	return event_dict_instance
 	 
 class EventDictionary(models.Model):
@@ -1387,6 +1683,74 @@ def update_cruise_invoice_receiver(sender, instance, **kwargs):
 def set_date_dict_outdated():
 	instance = get_event_dict_instance()
 	instance.make_outdated()
+	
+@receiver(post_save, sender=Cruise, dispatch_uid="update_cruise_display_name_receiver")
+@receiver(post_save, sender=CruiseDay, dispatch_uid="update_cruise_display_name_receiver")
+@receiver(post_delete, sender=CruiseDay, dispatch_uid="update_cruise_display_name_receiver")
+@receiver(post_save, sender=Event, dispatch_uid="update_cruise_display_name_receiver")
+@receiver(post_save, sender=User, dispatch_uid="update_cruise_display_name_receiver")
+def update_cruise_display_name_receiver(sender, instance, raw=False, **kwargs):
+	if raw:
+		return
+	if sender == Cruise:
+		cruises = [instance]
+	elif sender == User:
+		cruises = Cruise.objects.filter(leader=instance)
+	elif sender == Event:
+		# CruiseDay.cruise has related_name="cruise", so that is the way from a cruise to its days
+		cruises = Cruise.objects.filter(cruise__event=instance)
+	else:
+		cruises = Cruise.objects.filter(pk=instance.cruise_id)
+	for cruise in cruises:
+		cruise.update_display_name()
+
+@receiver(post_save, sender=User, dispatch_uid="create_user_data_receiver")
+def create_user_data_receiver(sender, instance, created, raw=False, **kwargs):
+	""" Every user needs user data; accounts made with manage.py or the admin site would otherwise lack it. """
+	if created and not raw:
+		user_data = UserData()
+		user_data.user = instance
+		if instance.is_superuser:
+			user_data.role = "admin"
+			user_data.organization = Organization.objects.filter(name="R/V Gunnerus").first()
+		user_data.save()
+		
+ADMIN_BADGE_COUNTS_CACHE_KEY = 'admin_badge_counts'
+# the counts also depend on the current time through cruise_end, and invalidation only reaches the process
+# that made the change unless CACHES is shared, so they expire after this long regardless
+ADMIN_BADGE_COUNTS_CACHE_TIMEOUT = 30
+
+def get_admin_badge_counts():
+	""" Returns the numbers shown in the admin menu badges, cached until something they depend on changes. """
+	from django.core.cache import cache
+	badge_counts = cache.get(ADMIN_BADGE_COUNTS_CACHE_KEY)
+	if badge_counts is None:
+		now = timezone.now()
+		cruises_badge = Cruise.objects.filter(is_submitted=True, is_approved=True, information_approved=False, cruise_end__gte=now).count()
+		users_badge = UserData.objects.filter(role="", email_confirmed=True, user__is_active=True).count()
+		unapproved_cruises_count = Cruise.objects.filter(is_submitted=True, is_approved=False, cruise_end__gte=now).count()
+		badge_counts = {
+			'cruises_badge': cruises_badge,
+			'users_badge': users_badge,
+			'overview_badge': cruises_badge + users_badge + unapproved_cruises_count,
+			'unfinalized_invoices_badge': InvoiceInformation.objects.filter(is_finalized=False, cruise__is_approved=True, cruise__cruise_end__lte=now).count()
+		}
+		cache.set(ADMIN_BADGE_COUNTS_CACHE_KEY, badge_counts, ADMIN_BADGE_COUNTS_CACHE_TIMEOUT)
+	return badge_counts
+	
+@receiver(post_save, sender=Cruise, dispatch_uid="invalidate_admin_badge_counts_receiver")
+@receiver(post_delete, sender=Cruise, dispatch_uid="invalidate_admin_badge_counts_receiver")
+@receiver(post_save, sender=CruiseDay, dispatch_uid="invalidate_admin_badge_counts_receiver")
+@receiver(post_delete, sender=CruiseDay, dispatch_uid="invalidate_admin_badge_counts_receiver")
+@receiver(post_save, sender=User, dispatch_uid="invalidate_admin_badge_counts_receiver")
+@receiver(post_delete, sender=User, dispatch_uid="invalidate_admin_badge_counts_receiver")
+@receiver(post_save, sender=UserData, dispatch_uid="invalidate_admin_badge_counts_receiver")
+@receiver(post_delete, sender=UserData, dispatch_uid="invalidate_admin_badge_counts_receiver")
+@receiver(post_save, sender=InvoiceInformation, dispatch_uid="invalidate_admin_badge_counts_receiver")
+@receiver(post_delete, sender=InvoiceInformation, dispatch_uid="invalidate_admin_badge_counts_receiver")
+def invalidate_admin_badge_counts_receiver(sender, instance, **kwargs):
+	from django.core.cache import cache
+	cache.delete(ADMIN_BADGE_COUNTS_CACHE_KEY)
 			
 class WebPageText(models.Model):
 	name = models.CharField(max_length=50, blank=True, default='')
@@ -1414,7 +1778,7 @@ class GeographicalArea(models.Model):
 		return self.name
 		
 class Action(models.Model):
-	timestamp = models.DateTimeField()
+	timestamp = models.DateTimeField(db_index=True)
 	user = models.ForeignKey(User)
 	target = models.TextField(max_length=1000, blank=True, default='')
 	action = models.TextField(max_length=1000, blank=True, default='')
@@ -1433,17 +1797,58 @@ class ListPrice(models.Model):
 	def __str__(self):
 		return self.name
 	
+class MaintenanceTask(models.Model):
+	""" Records that a maintenance task in reserver.maintenance has run, so it isn't run again until its version or fingerprint changes. """
+	name = models.CharField(max_length=200, unique=True)
+	version = models.PositiveIntegerField(default=0)
+	fingerprint = models.CharField(max_length=200, blank=True, default='')
+	completed = models.DateTimeField()
+	duration = models.FloatField(default=0) # seconds
+	
+	def __str__(self):
+		return self.name + " v" + str(self.version)
+		
+DEBUG_DATA_COMPRESSED_PREFIX = 'zlib:'
+
+def compress_debug_text(text):
+	return DEBUG_DATA_COMPRESSED_PREFIX + base64.b64encode(zlib.compress(text.encode('utf-8'))).decode('ascii')
+	
+def decompress_debug_text(text):
+	# rows logged before compression was added are stored as plain text
+	if not text.startswith(DEBUG_DATA_COMPRESSED_PREFIX):
+		return text
+	try:
+		return zlib.decompress(base64.b64decode(text[len(DEBUG_DATA_COMPRESSED_PREFIX):])).decode('utf-8')
+	except (ValueError, zlib.error):
+		return '[unreadable]'
+
 class DebugData(models.Model):
 	label = models.TextField(max_length=1000, blank=True, default='')
 	timestamp = models.DateTimeField()
+	# both are stored zlib-compressed; use the getters and setters below
 	data = models.TextField(max_length=75000, blank=True, default='')
 	request_metadata = models.TextField(max_length=75000, blank=True, default='')
 	
 	def __str__(self):
 		return self.label + " " + str(self.timestamp)
 		
+	def get_data(self):
+		return decompress_debug_text(self.data)
+		
+	def set_data(self, data):
+		self.data = compress_debug_text(data)
+		
+	def get_request_metadata(self):
+		return decompress_debug_text(self.request_metadata)
+		
+	def set_request_metadata(self, request_metadata):
+		self.request_metadata = compress_debug_text(request_metadata)
+		
 class Statistics(models.Model):
+	""" Daily totals as collected before StatisticValue; kept for the history, which is copied over at startup. """
 	timestamp = models.DateTimeField(blank=True, null=True)
+	# statistics are collected once per day; rows from before this was enforced have no day until deduplicated
+	day = models.DateField(unique=True, blank=True, null=True)
 	event_count = models.PositiveIntegerField(blank=True, default=0)
 	cruise_count = models.PositiveIntegerField(blank=True, default=0)
 	approved_cruise_count = models.PositiveIntegerField(blank=True, default=0)
@@ -1452,4 +1857,150 @@ class Statistics(models.Model):
 	user_count = models.PositiveIntegerField(blank=True, default=0)
 	emailconfirmed_user_count = models.PositiveIntegerField(blank=True, default=0)
 	organization_count = models.PositiveIntegerField(blank=True, default=0)
-	email_notification_count = models.PositiveIntegerField(blank=True, default=0)
\ No newline at end of file
+	email_notification_count = models.PositiveIntegerField(blank=True, default=0)
+	
+class StatisticValue(models.Model):
+	""" One day's value of one metric. New metrics need no schema changes. """
+	metric = models.CharField(max_length=200)
+	day = models.DateField()
+	value = models.FloatField()
+	
+	class Meta:
+		unique_together = (('metric', 'day'),)
+		
+	def __str__(self):
+		return self.metric + " on " + str(self.day) + ": " + str(self.value)
+		
+# metrics shown in the statistics table, in order, and their labels; table row counts are recorded as "rows:<table>"
+STATISTICS_METRIC_LABELS = OrderedDict([
+	('event_count', 'Events'),
+	('cruise_count', 'Cruises'),
+	('approved_cruise_count', 'Approved cruises'),
+	('cruise_day_count', 'Cruise days'),
+	('approved_cruise_day_count', 'Approved cruise days'),
+	('user_count', 'Users'),
+	('emailconfirmed_user_count', 'Users, email confirmed'),
+	('organization_count', 'Organizations'),
+	('email_notification_count', 'Email notifications'),
+	('emails_sent', 'Emails sent the last day'),
+	('emails_pending', 'Emails waiting to be sent'),
+	('emails_failed', 'Emails failed permanently'),
+	('validation_ms', 'Average cruise validation time (ms)'),
+	('calendar_feed_bytes', 'Calendar feed size (bytes)'),
+	('database_bytes', 'Database size (bytes)'),
+])
+STATISTICS_SERIES_RESOLUTIONS = ['day', 'week', 'month']
+
+def get_statistic_metric_label(metric):
+	if metric.startswith('rows:'):
+		return 'Rows in ' + metric[len('rows:'):]
+	return STATISTICS_METRIC_LABELS.get(metric, metric)
+	
+def store_statistic_values(day, values):
+	""" Stores the given {metric: value} for the day, replacing values already stored for it. """
+	from django.db import transaction
+	with transaction.atomic():
+		StatisticValue.objects.filter(day=day, metric__in=list(values.keys())).delete()
+		StatisticValue.objects.bulk_create([StatisticValue(metric=metric, day=day, value=value) for metric, value in values.items()])
+		
+def get_statistics_series(resolution, metrics, start=None, end=None):
+	""" Returns the period start dates and a list of values per metric, with one point per day, week or
+	    month between start and end. A week or month shows its highest value, as most metrics only grow.
+	    Periods where a metric wasn't recorded are None. """
+	from django.db.models import Max, Min
+	from django.db.models.functions import ExtractMonth, ExtractWeek, ExtractYear, TruncMonth
+	values = StatisticValue.objects.filter(metric__in=metrics)
+	if start is not None:
+		values = values.filter(day__gte=start)
+	if end is not None:
+		values = values.filter(day__lte=end)
+		
+	if resolution == 'month':
+		rows = values.annotate(period=TruncMonth('day')).values('metric', 'period')
+	elif resolution == 'week':
+		# grouping by month as well keeps late December days of week 1 apart from the January ones
+		rows = values.annotate(period_year=ExtractYear('day'), period_month=ExtractMonth('day'), period_week=ExtractWeek('day')).values('metric', 'period_year', 'period_month', 'period_week')
+	else:
+		rows = values.values('metric', 'day')
+	rows = rows.annotate(period_start=Min('day'), max_value=Max('value')).order_by('period_start')
+	
+	periods = OrderedDict()
+	for row in rows:
+		period = row['period_start']
+		if resolution == 'month':
+			period = period.replace(day=1)
+		elif resolution == 'week':
+			# a week split across months comes out as two groups, merged here by the week's monday
+			period -= datetime.timedelta(days=period.weekday())
+		period_values = periods.setdefault(period, {})
+		period_values[row['metric']] = max(row['max_value'], period_values.get(row['metric'], row['max_value']))
+		
+	series = {metric: [period_values.get(metric) for period_values in periods.values()] for metric in metrics}
+	return [period.isoformat() for period in periods.keys()], series
+
+ADMIN_OVERVIEW_CACHE_KEY = 'admin_overview_snapshot'
+# the receivers below only clear the cache of the process that made the change unless CACHES is shared,
+# so the snapshot is kept briefly and other processes catch up within this long
+ADMIN_OVERVIEW_CACHE_TIMEOUT = 30
+
+def get_admin_overview_snapshot():
+	""" Returns the day quotas, counts and recent actions shown on the admin overview, cached briefly and until something they depend on changes. """
+	from django.core.cache import cache
+	from django.db.models import Count
+	from django.db.models.functions import ExtractYear
+	overview = cache.get(ADMIN_OVERVIEW_CACHE_KEY)
+	if overview is None:
+		now = timezone.now()
+		current_year = now.year
+		next_year = now.year+1
+		settings_object = get_settings_object()
+		
+		# approved cruise days per year, split by whether the leader's organization is internal
+		day_counts = {}
+		approved_cruise_days = CruiseDay.objects.filter(event__start_time__year__gte=current_year, event__start_time__year__lte=next_year, cruise__is_approved=True)
+		for row in approved_cruise_days.annotate(year=ExtractYear('event__start_time')).values('year', 'cruise__leader__userdata__organization__is_NTNU').annotate(day_count=Count('pk')):
+			day_counts[(row['year'], row['cruise__leader__userdata__organization__is_NTNU'])] = row['day_count']
+			
+		overview = {
+			'current_year': current_year,
+			'next_year': next_year,
+			'internal_order_day_count': settings_object.internal_order_day_count,
+			'external_order_day_count': settings_object.external_order_day_count,
+			'internal_days_remaining': settings_object.internal_order_day_count-day_counts.get((current_year, True), 0),
+			'external_days_remaining': settings_object.external_order_day_count-day_counts.get((current_year, False), 0),
+			'internal_days_remaining_next_year': settings_object.internal_order_day_count-day_counts.get((next_year, True), 0),
+			'external_days_remaining_next_year': settings_object.external_order_day_count-day_counts.get((next_year, False), 0),
+			'last_actions': list(Action.objects.filter(timestamp__lte=now, timestamp__gt=now-datetime.timedelta(days=30)).select_related('user').order_by('-timestamp')[:3]),
+			'cruises_need_attention_count': Cruise.objects.filter(is_submitted=True, is_approved=True, information_approved=False, cruise_end__gte=now).count(),
+			'upcoming_cruises_count': Cruise.objects.filter(is_submitted=True, is_approved=True, information_approved=True, cruise_end__gte=now).count(),
+			'unapproved_cruises_count': Cruise.objects.filter(is_submitted=True, is_approved=False, cruise_end__gte=now).count(),
+			'users_not_approved_count': UserData.objects.filter(role="", email_confirmed=True, user__is_active=True).count(),
+		}
+		cache.set(ADMIN_OVERVIEW_CACHE_KEY, overview, ADMIN_OVERVIEW_CACHE_TIMEOUT)
+	return overview
+	
+@receiver(post_save, sender=Cruise, dispatch_uid="invalidate_admin_overview_receiver")
+@receiver(post_delete, sender=Cruise, dispatch_uid="invalidate_admin_overview_receiver")
+@receiver(post_save, sender=CruiseDay, dispatch_uid="invalidate_admin_overview_receiver")
+@receiver(post_delete, sender=CruiseDay, dispatch_uid="invalidate_admin_overview_receiver")
+@receiver(post_save, sender=Event, dispatch_uid="invalidate_admin_overview_receiver")
+@receiver(post_save, sender=User, dispatch_uid="invalidate_admin_overview_receiver")
+@receiver(post_delete, sender=User, dispatch_uid="invalidate_admin_overview_receiver")
+@receiver(post_save, sender=UserData, dispatch_uid="invalidate_admin_overview_receiver")
+@receiver(post_delete, sender=UserData, dispatch_uid="invalidate_admin_overview_receiver")
+@receiver(post_save, sender=Organization, dispatch_uid="invalidate_admin_overview_receiver")
+@receiver(post_save, sender=Action, dispatch_uid="invalidate_admin_overview_receiver")
+@receiver(post_delete, sender=Action, dispatch_uid="invalidate_admin_overview_receiver")
+@receiver(post_save, sender=Settings, dispatch_uid="invalidate_admin_overview_receiver")
+def invalidate_admin_overview_receiver(sender, instance, **kwargs):
+	from django.core.cache import cache
+	cache.delete(ADMIN_OVERVIEW_CACHE_KEY)
+
+@receiver(post_save, sender=EventCategory, dispatch_uid="bump_registry_version_receiver")
+@receiver(post_delete, sender=EventCategory, dispatch_uid="bump_registry_version_receiver")
+@receiver(post_save, sender=EmailTemplate, dispatch_uid="bump_registry_version_receiver")
+@receiver(post_delete, sender=EmailTemplate, dispatch_uid="bump_registry_version_receiver")
+@receiver(post_save, sender=Settings, dispatch_uid="bump_registry_version_receiver")
+@receiver(post_delete, sender=Settings, dispatch_uid="bump_registry_version_receiver")
+def bump_registry_version_receiver(sender, instance, **kwargs):
+	bump_registry_version()
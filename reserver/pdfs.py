@@ -0,0 +1,193 @@
+import hashlib
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.template.loader import render_to_string
+
+CRUISE_PDF_TEMPLATE = 'reserver/pdfs/cruise_pdf.html'
+# bump when the template changes, so PDFs rendered from the old one aren't served
+CRUISE_PDF_VERSION = 1
+
+pdf_process_pool = None
+pdf_pool_lock = threading.Lock()
+# cache path -> future, so a PDF that's already being rendered isn't rendered again
+pending_pdf_renders = {}
+# merged PDFs of sets of cruises nobody has asked for in this long are removed when another is made
+MERGED_PDF_MAX_AGE = 24*60*60 # seconds
+
+def get_cruise_pdf_fingerprint(cruise, http_host):
+	""" Returns a hash of everything the cruise PDF shows, which changes whenever the cruise or
+	    anything listed on it does. """
+	from reserver.models import CruiseDay, Document, Equipment, User
+	people_fields = ('pk', 'first_name', 'last_name', 'email', 'userdata__organization__name')
+	content = {
+		'version': CRUISE_PDF_VERSION,
+		'http_host': http_host,
+		# the missing information cache is bookkeeping, not something the PDF shows
+		'cruise': [(field.attname, getattr(cruise, field.attname)) for field in cruise._meta.concrete_fields if not field.name.startswith('missing_information')],
+		'organization': [cruise.organization.name, cruise.organization.is_NTNU] if cruise.organization_id is not None else None,
+		'leader': list(User.objects.filter(pk=cruise.leader_id).values_list(*people_fields)),
+		'owners': list(cruise.owner.order_by('pk').values_list(*people_fields)),
+		'days': list(CruiseDay.objects.filter(cruise=cruise.pk).order_by('pk').values_list('pk', 'event__start_time', 'is_long_day', 'destination', 'description', 'breakfast_count', 'lunch_count', 'dinner_count', 'overnight_count')),
+		'equipment': list(Equipment.objects.filter(cruise=cruise.pk).order_by('pk').values()),
+		'documents': list(Document.objects.filter(cruise=cruise.pk).order_by('pk').values_list('pk', 'name', 'file')),
+	}
+	return hashlib.sha256(json.dumps(content, cls=DjangoJSONEncoder, default=str).encode()).hexdigest()
+
+def get_cruise_pdf_path(cruise_pk, fingerprint):
+	return os.path.join(settings.CRUISE_PDF_CACHE_PATH, 'cruise-' + str(cruise_pk) + '-' + fingerprint + '.pdf')
+
+def render_cruise_pdf_html(cruise, http_host):
+	context = {
+		'pagesize': 'A4',
+		'title': 'Cruise summary for ' + str(cruise),
+		'cruise': cruise,
+		'http_host': http_host,
+	}
+	return render_to_string(CRUISE_PDF_TEMPLATE, context)
+
+def write_pdf_file(html, path):
+	""" Converts the HTML to a PDF at path and removes the cruise's older PDFs. Runs in a pool process. """
+	from easy_pdf.rendering import html_to_pdf
+	pdf = html_to_pdf(html)
+	folder = os.path.dirname(path)
+	os.makedirs(folder, exist_ok=True)
+	with tempfile.NamedTemporaryFile(dir=folder, suffix='.partial', delete=False) as partial_file:
+		partial_file.write(pdf)
+	os.replace(partial_file.name, path)
+	# cache files are named cruise-<pk>-<fingerprint>.pdf
+	prefix = os.path.basename(path).rsplit('-', 1)[0] + '-'
+	for filename in os.listdir(folder):
+		if filename.startswith(prefix) and filename.endswith('.pdf') and filename != os.path.basename(path):
+			try:
+				os.remove(os.path.join(folder, filename))
+			except FileNotFoundError:
+				pass
+
+def forget_pdf_render(path):
+	with pdf_pool_lock:
+		pending_pdf_renders.pop(path, None)
+
+def submit_to_pdf_pool(path, function, *args):
+	""" Runs function(*args) in the process pool, so rendering doesn't hold up this process, unless
+	    the file at path is being made already. Returns a future that's done once the file is written. """
+	global pdf_process_pool
+	with pdf_pool_lock:
+		future = pending_pdf_renders.get(path)
+		if future is not None:
+			return future
+		if pdf_process_pool is None:
+			pdf_process_pool = ProcessPoolExecutor(max_workers=settings.CRUISE_PDF_WORKERS)
+		try:
+			future = pdf_process_pool.submit(function, *args)
+		except BrokenProcessPool:
+			# a worker died, which breaks the whole pool; start over with a fresh one
+			pdf_process_pool = ProcessPoolExecutor(max_workers=settings.CRUISE_PDF_WORKERS)
+			future = pdf_process_pool.submit(function, *args)
+		pending_pdf_renders[path] = future
+	future.add_done_callback(lambda future: forget_pdf_render(path))
+	return future
+
+def submit_pdf_render(html, path):
+	return submit_to_pdf_pool(path, write_pdf_file, html, path)
+
+def get_cruise_pdf(cruise, http_host):
+	""" Returns the path of the cruise's PDF, rendering it first unless an up-to-date one is cached. """
+	path = get_cruise_pdf_path(cruise.pk, get_cruise_pdf_fingerprint(cruise, http_host))
+	if not os.path.exists(path):
+		submit_pdf_render(render_cruise_pdf_html(cruise, http_host), path).result()
+	return path
+
+def queue_cruise_pdf(cruise, request):
+	""" Starts rendering the cruise's PDF in the background unless an up-to-date one is cached,
+	    so it's ready by the time someone downloads it. Called after a cruise is saved, so it never
+	    raises; a PDF that can't be queued is rendered when it's downloaded instead. """
+	try:
+		http_host = request.get_host()
+		path = get_cruise_pdf_path(cruise.pk, get_cruise_pdf_fingerprint(cruise, http_host))
+		if not os.path.exists(path):
+			submit_pdf_render(render_cruise_pdf_html(cruise, http_host), path)
+	except Exception as e:
+		print("Could not queue PDF for cruise " + str(cruise.pk) + ": " + str(e))
+
+def get_cruises_between(start, end):
+	""" Returns the approved cruises with days between start and end, in the order they sail. """
+	from reserver.models import Cruise
+	return Cruise.objects.filter(is_approved=True, cruise_start__lt=end, cruise_end__gt=start).select_related('leader', 'organization').order_by('cruise_start', 'pk')
+
+def get_cruise_pdfs(cruises, http_host):
+	""" Returns (cruise, PDF path) for each cruise. Cached PDFs are reused, and the rest are rendered
+	    across the process pool at the same time. """
+	cruise_paths = []
+	futures = []
+	for cruise in cruises:
+		path = get_cruise_pdf_path(cruise.pk, get_cruise_pdf_fingerprint(cruise, http_host))
+		if not os.path.exists(path):
+			futures.append(submit_pdf_render(render_cruise_pdf_html(cruise, http_host), path))
+		cruise_paths.append((cruise, path))
+	for future in futures:
+		future.result()
+	return cruise_paths
+
+def write_merged_pdf_file(title, entries, path):
+	""" Merges the PDFs of entries, a list of (heading, PDF path), into one PDF at path, after a table
+	    of contents page listing where each starts. Each is also bookmarked. Runs in a pool process. """
+	from easy_pdf.rendering import html_to_pdf
+	from PyPDF2 import PdfFileMerger, PdfFileReader
+	page_counts = []
+	for heading, entry_path in entries:
+		with open(entry_path, 'rb') as entry_file:
+			page_counts.append(PdfFileReader(entry_file, strict=False).getNumPages())
+	# the contents only push the page numbers back if they don't fit on one page, so render them again if so
+	contents_page_count = 1
+	while True:
+		rows = []
+		page = contents_page_count+1
+		for (heading, entry_path), page_count in zip(entries, page_counts):
+			rows.append((heading, page))
+			page += page_count
+		contents_pdf = html_to_pdf(render_to_string('reserver/pdfs/contents_pdf.html', {'pagesize': 'A4', 'title': title, 'rows': rows}))
+		rendered_page_count = PdfFileReader(io.BytesIO(contents_pdf), strict=False).getNumPages()
+		if rendered_page_count == contents_page_count:
+			break
+		contents_page_count = rendered_page_count
+
+	merger = PdfFileMerger(strict=False)
+	merger.append(io.BytesIO(contents_pdf), bookmark='Contents', import_bookmarks=False)
+	for heading, entry_path in entries:
+		merger.append(entry_path, bookmark=heading, import_bookmarks=False)
+	folder = os.path.dirname(path)
+	os.makedirs(folder, exist_ok=True)
+	with tempfile.NamedTemporaryFile(dir=folder, suffix='.partial', delete=False) as partial_file:
+		merger.write(partial_file)
+	merger.close()
+	os.replace(partial_file.name, path)
+	for filename in os.listdir(folder):
+		merged_path = os.path.join(folder, filename)
+		if filename.startswith('merged-') and filename.endswith('.pdf') and time.time()-os.path.getmtime(merged_path) > MERGED_PDF_MAX_AGE:
+			try:
+				os.remove(merged_path)
+			except FileNotFoundError:
+				pass
+
+def get_merged_cruise_pdf(title, cruises, http_host):
+	""" Returns the path of one PDF with the summaries of all the cruises and a table of contents.
+	    The merged PDF is cached too, keyed by the PDFs it's made from. """
+	cruise_paths = get_cruise_pdfs(cruises, http_host)
+	fingerprint = hashlib.sha256(json.dumps([title] + [path for cruise, path in cruise_paths]).encode()).hexdigest()
+	path = os.path.join(settings.CRUISE_PDF_CACHE_PATH, 'merged-' + fingerprint + '.pdf')
+	if os.path.exists(path):
+		# counts as used, so it isn't cleaned up while people keep asking for it
+		os.utime(path)
+	else:
+		entries = [(str(cruise), cruise_path) for cruise, cruise_path in cruise_paths]
+		submit_to_pdf_pool(path, write_merged_pdf_file, title, entries, path).result()
+	return path
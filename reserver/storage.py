@@ -0,0 +1,150 @@
+import contextlib
+import fcntl
+import hashlib
+import os
+import re
+import tempfile
+import time
+
+from django.core.files.storage import FileSystemStorage
+from django.db import transaction
+from django.utils.deconstruct import deconstructible
+
+# cruise documents are stored once per distinct content, as documents/<first two hash characters>/<hash><extension>
+BLOB_FOLDER = 'documents'
+EXTENSION_PATTERN = re.compile(r'^\.[a-z0-9]{1,10}$')
+# blobs nothing refers to are only swept once they're this old, so uploads whose Document isn't saved yet are left alone
+ORPHANED_BLOB_MIN_AGE = 60*60 # seconds
+
+@contextlib.contextmanager
+def blob_store_lock(location):
+	""" Holds a lock shared by every process, so a blob being reused by an upload can't be deleted
+	    between the upload finding it and touching it. """
+	folder = os.path.join(location, BLOB_FOLDER)
+	os.makedirs(folder, exist_ok=True)
+	with open(os.path.join(folder, '.lock'), 'a') as lock_file:
+		fcntl.flock(lock_file, fcntl.LOCK_EX)
+		try:
+			yield
+		finally:
+			fcntl.flock(lock_file, fcntl.LOCK_UN)
+			
+def get_blob_name(digest, name):
+	extension = os.path.splitext(name)[1].lower()
+	if not EXTENSION_PATTERN.match(extension):
+		extension = ''
+	return BLOB_FOLDER + '/' + digest[:2] + '/' + digest + extension
+
+def is_blob_name(name):
+	return bool(name) and name.startswith(BLOB_FOLDER + '/')
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+	""" Hashes uploads while writing them to disk, and keeps each distinct file once under its hash.
+	    Saving a file that's stored already just returns the name of the stored copy. """
+
+	def get_available_name(self, name, max_length=None):
+		# the name is chosen from the contents in _save, so there's nothing to avoid here
+		return name
+
+	def _save(self, name, content):
+		partial_folder = os.path.join(self.location, BLOB_FOLDER, 'partial')
+		os.makedirs(partial_folder, exist_ok=True)
+		digest = hashlib.sha256()
+		partial_file = tempfile.NamedTemporaryFile(dir=partial_folder, delete=False)
+		try:
+			with partial_file:
+				for chunk in content.chunks():
+					digest.update(chunk)
+					partial_file.write(chunk)
+			blob_name = get_blob_name(digest.hexdigest(), name)
+			blob_path = self.path(blob_name)
+			with blob_store_lock(self.location):
+				if os.path.exists(blob_path):
+					os.remove(partial_file.name)
+					# counts as new again, so releases and the orphan sweep leave it alone until its Document is saved
+					os.utime(blob_path)
+				else:
+					os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+					os.replace(partial_file.name, blob_path)
+					if self.file_permissions_mode is not None:
+						os.chmod(blob_path, self.file_permissions_mode)
+		except BaseException:
+			if os.path.exists(partial_file.name):
+				os.remove(partial_file.name)
+			raise
+		return blob_name
+
+document_storage = ContentAddressedStorage()
+
+def is_recently_stored(path):
+	try:
+		return time.time()-os.path.getmtime(path) < ORPHANED_BLOB_MIN_AGE
+	except FileNotFoundError:
+		return False
+		
+def release_document_blob(name):
+	""" Deletes a stored document file once no Document refers to it any more. The references are
+	    counted from the Document table itself, so the count can't drift from the documents that exist.
+	    Run it after the transaction that dropped the reference has committed. A blob an upload has
+	    just stored or reused is kept, since its Document may not be committed yet; the orphan sweep
+	    in deduplicate_documents removes it later if nothing ends up referring to it. """
+	from reserver.models import Document
+	if not is_blob_name(name):
+		return False
+	with blob_store_lock(document_storage.location):
+		if is_recently_stored(document_storage.path(name)) or Document.objects.filter(file=name).exists():
+			return False
+		document_storage.delete(name)
+	return True
+	
+def release_document_blob_on_commit(name):
+	""" Releases the blob once the current transaction commits, so a rolled back delete or
+	    replacement never loses a file that's still referred to. """
+	if is_blob_name(name):
+		transaction.on_commit(lambda: release_document_blob(name))
+
+def deduplicate_documents():
+	""" Moves document files stored under their upload names into the content-addressed store, pointing
+	    every Document at the shared copy, then deletes the old files and any blobs nothing refers to.
+	    Returns (documents moved, files deleted, bytes freed, [(pk, file name) of documents skipped because
+	    their file is missing]). """
+	from reserver.models import Document
+	moved_count = 0
+	skipped_documents = []
+	blob_names = {}
+	for pk, name in Document.objects.exclude(file='').exclude(file=None).exclude(file__startswith=BLOB_FOLDER + '/').values_list('pk', 'file'):
+		if not document_storage.exists(name):
+			skipped_documents.append((pk, name))
+			continue
+		if name not in blob_names:
+			with document_storage.open(name) as content:
+				blob_names[name] = document_storage.save(name, content)
+		blob_name = blob_names[name]
+		# update() rather than save(), so no blobs are released while documents are being moved
+		Document.objects.filter(pk=pk, original_name='').update(original_name=os.path.basename(name))
+		Document.objects.filter(pk=pk).update(file=blob_name)
+		moved_count += 1
+
+	deleted_count = 0
+	freed_size = 0
+	referenced_names = set(Document.objects.values_list('file', flat=True))
+	for name in sorted(set(blob_names) - referenced_names):
+		freed_size += document_storage.size(name)
+		document_storage.delete(name)
+		deleted_count += 1
+
+	blob_folder = document_storage.path(BLOB_FOLDER)
+	for folder, subfolders, filenames in os.walk(blob_folder):
+		for filename in filenames:
+			path = os.path.join(folder, filename)
+			name = os.path.relpath(path, document_storage.location).replace(os.sep, '/')
+			if filename == '.lock' or name in referenced_names:
+				continue
+			with blob_store_lock(document_storage.location):
+				if is_recently_stored(path) or not os.path.exists(path):
+					continue
+				freed_size += os.path.getsize(path)
+				os.remove(path)
+			deleted_count += 1
+	return moved_count, deleted_count, freed_size, skipped_documents
@@ -2,6 +2,7 @@ from django import template
 import pyqrcode
 import io
 import base64
+import functools
 from django.urls import reverse_lazy
 
 register = template.Library()
@@ -14,7 +15,12 @@ def path_to_b64_qr_url(path):
 	
 @register.simple_tag
 def path_to_b64_qr(path, http_host_string):
-	qr = pyqrcode.create(http_host_string+path)
+	return get_qr_data_uri(http_host_string+path)
+
+# the same documents are linked from PDF after PDF, so their codes are only drawn once
+@functools.lru_cache(maxsize=256)
+def get_qr_data_uri(text):
+	qr = pyqrcode.create(text)
 	buffer = io.BytesIO()
 	qr.png(buffer, scale=15)
 	encoded_qr = base64.b64encode(buffer.getvalue())
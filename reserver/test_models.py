@@ -63,13 +63,13 @@ def create_test_models():
 	u4 = User.objects.create_user(username='arry', email='noone@faceless.se', password='the hound merryn trant queen cersei joffrey the tickler the mountain')
 	u5 = User.objects.create_user(username='bran_not_the_builder', email='brandon.stark@winterfell.gov', password='rip legs now i fly')
 	
-	#Creating user data
+	#Filling in user data, which is created along with the users
 	#u = UserData.objects.create(organization=, user=User.objects.create(username=, email=, password=), role=, phone_number=, nationality=, is_crew=, date_of_birth=)
-	u_d1 = UserData.objects.create(organization=org7, user=u1, role='internal', phone_number='0000', nationality='The North', is_crew=False, date_of_birth=date(281, 2, 15))
-	u_d2 = UserData.objects.create(organization=org1, user=u2, role='external', phone_number='1111', nationality='The Crownlands', is_crew=False, date_of_birth=date(287, 6, 3))
-	u_d3 = UserData.objects.create(organization=org5, user=u3, role='not_approved', phone_number='1234', nationality='The North', is_crew=True, date_of_birth=date(269, 8, 24))
-	u_d4 = UserData.objects.create(organization=org6, user=u4, role='internal', phone_number='5432', nationality='The North', is_crew=True, date_of_birth=date(288, 5, 5))
-	u_d5 = UserData.objects.create(organization=org4, user=u5, role='internal', phone_number='7345', nationality='The North', is_crew=False, date_of_birth=date(290, 1, 1))
+	UserData.objects.filter(user=u1).update(organization=org7, role='internal', phone_number='0000', nationality='The North', is_crew=False, date_of_birth=date(281, 2, 15))
+	UserData.objects.filter(user=u2).update(organization=org1, role='external', phone_number='1111', nationality='The Crownlands', is_crew=False, date_of_birth=date(287, 6, 3))
+	UserData.objects.filter(user=u3).update(organization=org5, role='not_approved', phone_number='1234', nationality='The North', is_crew=True, date_of_birth=date(269, 8, 24))
+	UserData.objects.filter(user=u4).update(organization=org6, role='internal', phone_number='5432', nationality='The North', is_crew=True, date_of_birth=date(288, 5, 5))
+	UserData.objects.filter(user=u5).update(organization=org4, role='internal', phone_number='7345', nationality='The North', is_crew=False, date_of_birth=date(290, 1, 1))
 	
 	#Creating user preferences
 	#u = UserPreferences.objects.create(user=)
@@ -1,3 +1,552 @@
-from django.test import TestCase
+import datetime
+import gzip
+import io
+import os
+import shutil
+import smtplib
+import sqlite3
+import tempfile
+import time
+import zipfile
+from unittest import mock
 
-# Create your tests here.
+import requests
+from anymail.exceptions import AnymailAPIError
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.core.mail import EmailMessage
+from django.db import transaction
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from PyPDF2 import PdfFileReader
+
+from reserver import backups, models
+from reserver.email_backends import TeeEmailBackend
+from reserver.jobs import queue_email_delivery, retry_email_deliveries, send_digest_email
+from reserver.listings import AdminListing, EARLIEST_DATETIME
+from reserver.models import Cruise, CruiseDay, DigestEntry, Document, EmailDelivery, Event, EventCategory, EventDictionary, InvoiceInformation, ListPrice, Organization, Season
+from reserver.storage import ORPHANED_BLOB_MIN_AGE, document_storage, release_document_blob
+from reserver.utils import update_cruise_main_invoices
+
+class TemporaryMediaMixin(object):
+	""" Runs each test with uploads and the PDF cache in a temporary folder. """
+	
+	def setUp(self):
+		self.media_root = tempfile.mkdtemp()
+		self.settings_override = override_settings(
+			MEDIA_ROOT=self.media_root,
+			EMAIL_FILE_PATH=os.path.join(self.media_root, 'debug-emails/'),
+			CRUISE_PDF_CACHE_PATH=os.path.join(self.media_root, 'pdf-cache/'),
+			UPLOAD_SENDFILE_HEADER=None,
+		)
+		self.settings_override.enable()
+		
+	def tearDown(self):
+		self.settings_override.disable()
+		shutil.rmtree(self.media_root, ignore_errors=True)
+		
+class TemporaryMediaTestCase(TemporaryMediaMixin, TestCase):
+	pass
+	
+def create_test_cruise(leader_username='leader', day=None, **kwargs):
+	""" Creates a cruise with its own leader and organization, and a cruise day on day if given. """
+	organization = Organization.objects.create(name='Institutt for havforskning', is_NTNU=True)
+	leader = User.objects.create_user(username=leader_username, email=leader_username + '@example.com', password='password')
+	leader.userdata.organization = organization
+	leader.userdata.role = 'internal'
+	leader.userdata.save()
+	cruise = Cruise.objects.create(leader=leader, organization=organization, description='Test cruise', **kwargs)
+	if day is not None:
+		start_time = timezone.make_aware(datetime.datetime.combine(day, datetime.time(8)))
+		event = Event.objects.create(name='Cruise day', start_time=start_time, end_time=start_time + datetime.timedelta(hours=8))
+		CruiseDay.objects.create(cruise=cruise, event=event)
+	return Cruise.objects.get(pk=cruise.pk)
+	
+def create_test_season():
+	""" Creates a season from April to September 2030 where everything costs 1000. """
+	start = timezone.make_aware(datetime.datetime(2030, 4, 1))
+	season_event = Event.objects.create(name='Summer 2030', start_time=start, end_time=start + datetime.timedelta(days=180))
+	prices = {field: 1000 for field in ['long_education_price', 'long_research_price', 'long_boa_price', 'long_external_price', 'short_education_price', 'short_research_price', 'short_boa_price', 'short_external_price', 'breakfast_price', 'lunch_price', 'dinner_price']}
+	return Season.objects.create(name='Summer 2030', season_event=season_event, **prices)
+	
+class CruiseDisplayNameTests(TestCase):
+	def test_moving_a_cruise_day_updates_display_name(self):
+		cruise = create_test_cruise()
+		event = Event.objects.create(name='Cruise day', start_time=timezone.make_aware(datetime.datetime(2030, 5, 2, 8)), end_time=timezone.make_aware(datetime.datetime(2030, 5, 2, 16)))
+		CruiseDay.objects.create(cruise=cruise, event=event)
+		self.assertIn('2030-05-02', Cruise.objects.get(pk=cruise.pk).display_name)
+		event.start_time = timezone.make_aware(datetime.datetime(2030, 6, 7, 8))
+		event.save()
+		self.assertIn('2030-06-07', Cruise.objects.get(pk=cruise.pk).display_name)
+		
+@override_settings(EMAIL_TEE_BACKEND='django.core.mail.backends.locmem.EmailBackend')
+class TeeEmailBackendTests(TestCase):
+	def test_only_sent_messages_are_archived(self):
+		backend = TeeEmailBackend()
+		sent_message = EmailMessage('Sent', 'Body', 'from@example.com', ['to@example.com'])
+		refused_message = EmailMessage('Refused', 'Body', 'from@example.com', ['to@example.com'])
+		with mock.patch.object(backend.connection, 'send_messages', side_effect=[1, 0]), mock.patch('reserver.email_backends.archive_writer.put') as put:
+			self.assertEqual(backend.send_messages([sent_message, refused_message]), 1)
+		put.assert_called_once_with([sent_message], None)
+		
+	def test_nothing_is_archived_when_sending_fails(self):
+		backend = TeeEmailBackend()
+		message = EmailMessage('Failed', 'Body', 'from@example.com', ['to@example.com'])
+		with mock.patch.object(backend.connection, 'send_messages', side_effect=OSError("connection refused")), mock.patch('reserver.email_backends.archive_writer.put') as put:
+			with self.assertRaises(OSError):
+				backend.send_messages([message])
+		put.assert_not_called()
+		
+class MainInvoiceSweepTests(TestCase):
+	def test_sweep_regenerates_only_outdated_invoices(self):
+		season = create_test_season()
+		cruise = create_test_cruise(day=datetime.date(2030, 5, 2))
+		CruiseDay.objects.filter(cruise=cruise).update(season=season)
+		invoice = InvoiceInformation.objects.create(cruise=cruise, is_cruise_invoice=True)
+		cruise.generate_main_invoice()
+		items = list(ListPrice.objects.filter(invoice=invoice, is_generated=True).values_list('name', 'price'))
+		self.assertTrue(items)
+		self.assertEqual(update_cruise_main_invoices(), 0)
+		ListPrice.objects.filter(invoice=invoice, is_generated=True).update(price=1)
+		self.assertEqual(update_cruise_main_invoices(), 1)
+		self.assertEqual(list(ListPrice.objects.filter(invoice=invoice, is_generated=True).values_list('name', 'price')), items)
+		
+	def test_sweep_updates_outdated_titles_and_keeps_added_items(self):
+		season = create_test_season()
+		invoices = []
+		for leader_username, day in [('leader', datetime.date(2030, 5, 2)), ('other-leader', datetime.date(2030, 5, 9))]:
+			cruise = create_test_cruise(leader_username, day=day)
+			CruiseDay.objects.filter(cruise=cruise).update(season=season)
+			invoice = InvoiceInformation.objects.create(cruise=cruise, is_cruise_invoice=True)
+			cruise.generate_main_invoice()
+			invoices.append(invoice)
+		added_item = ListPrice.objects.create(invoice=invoices[0], name='Extra equipment', price=100)
+		InvoiceInformation.objects.filter(pk=invoices[0].pk).update(title='Old title')
+		ListPrice.objects.filter(invoice=invoices[1], is_generated=True).delete()
+		self.assertEqual(update_cruise_main_invoices(), 2)
+		self.assertEqual(InvoiceInformation.objects.get(pk=invoices[0].pk).title, invoices[0].cruise.get_main_invoice_title())
+		self.assertTrue(ListPrice.objects.filter(pk=added_item.pk).exists())
+		self.assertTrue(ListPrice.objects.filter(invoice=invoices[1], is_generated=True).exists())
+		self.assertEqual(update_cruise_main_invoices(), 0)
+		
+class DigestEmailTests(TestCase):
+	def test_digest_is_sent_with_a_plain_text_body(self):
+		now = timezone.now()
+		entries = [
+			DigestEntry.objects.create(recipient='leader@example.com', subject='Cruise approved', message='<p>Your cruise was <b>approved</b>.</p>', created=now),
+			DigestEntry.objects.create(recipient='leader@example.com', subject='Cruise departing', message='<p>Your cruise leaves soon.</p>', created=now),
+		]
+		delivery = send_digest_email('leader@example.com', entries)
+		self.assertEqual(delivery.subject, 'Notification digest (2 notifications)')
+		self.assertEqual(len(mail.outbox), 1)
+		self.assertEqual(mail.outbox[0].body, 'Cruise approved\nYour cruise was approved.\n\nCruise departing\nYour cruise leaves soon.')
+		
+class EmailDeliveryTests(TestCase):
+	def test_connection_failure_is_retried(self):
+		with mock.patch('reserver.jobs.send_mail', side_effect=smtplib.SMTPServerDisconnected("connection lost")):
+			delivery = queue_email_delivery('leader@example.com', 'Subject', 'Message', '')
+		self.assertEqual(delivery.status, EmailDelivery.PENDING)
+		self.assertEqual(delivery.attempts, 1)
+		self.assertEqual(delivery.last_error, 'connection lost')
+		
+	def test_refused_recipient_is_not_retried(self):
+		error = smtplib.SMTPRecipientsRefused({'leader@example.com': (550, b'No such user')})
+		with mock.patch('reserver.jobs.send_mail', side_effect=error):
+			delivery = queue_email_delivery('leader@example.com', 'Subject', 'Message', '')
+		self.assertEqual(delivery.status, EmailDelivery.DEAD)
+		
+	def api_error(self, status_code, reason):
+		response = requests.Response()
+		response.status_code = status_code
+		response.reason = reason
+		return AnymailAPIError("The ESP rejected the request", status_code=status_code, response=response)
+		
+	def test_rejected_api_request_is_not_retried(self):
+		with mock.patch('reserver.jobs.send_mail', side_effect=self.api_error(400, "BAD REQUEST")):
+			delivery = queue_email_delivery('leader@example.com', 'Subject', 'Message', '')
+		self.assertEqual(delivery.status, EmailDelivery.DEAD)
+		
+	def test_throttled_api_request_is_retried(self):
+		with mock.patch('reserver.jobs.send_mail', side_effect=self.api_error(429, "TOO MANY REQUESTS")):
+			delivery = queue_email_delivery('leader@example.com', 'Subject', 'Message', '')
+		self.assertEqual(delivery.status, EmailDelivery.PENDING)
+		
+	def test_slow_first_attempt_is_not_sent_again(self):
+		later = timezone.now() + datetime.timedelta(seconds=settings.EMAIL_RETRY_BASE_DELAY*2)
+		def slow_send(*args, **kwargs):
+			# the retry job runs while the first attempt is still waiting on the server
+			if send.call_count == 1:
+				with mock.patch('reserver.jobs.timezone.now', return_value=later):
+					retry_email_deliveries()
+			return 1
+		with mock.patch('reserver.jobs.send_mail', side_effect=slow_send) as send:
+			delivery = queue_email_delivery('leader@example.com', 'Subject', 'Message', '')
+		self.assertEqual(send.call_count, 1)
+		self.assertEqual(EmailDelivery.objects.get(pk=delivery.pk).status, EmailDelivery.SENT)
+		
+	def test_other_errors_are_raised(self):
+		with mock.patch('reserver.jobs.send_mail', side_effect=TypeError("bad argument")):
+			with self.assertRaises(TypeError):
+				queue_email_delivery('leader@example.com', 'Subject', 'Message', '')
+				
+class RegistryTests(TestCase):
+	def setUp(self):
+		# the registry outlives each test's database, so start every test from an empty one
+		cache.clear()
+		models.registry_objects.clear()
+		models.registry_version = None
+		
+	def test_saving_a_category_replaces_registered_copies(self):
+		category = EventCategory.objects.create(name='Test category', colour='red')
+		self.assertEqual(models.get_event_category('Test category').colour, 'red')
+		category.colour = 'green'
+		category.save()
+		self.assertEqual(models.get_event_category('Test category').colour, 'green')
+		
+	def test_changes_to_a_copy_stay_out_of_the_registry(self):
+		EventCategory.objects.create(name='Test category', colour='red')
+		models.get_event_category('Test category').colour = 'green'
+		self.assertEqual(models.get_event_category('Test category').colour, 'red')
+		
+	def test_copies_are_reloaded_once_they_expire(self):
+		# update() sends no signals, like a change made by a process that doesn't share this cache
+		EventCategory.objects.create(name='Test category', colour='red')
+		self.assertEqual(models.get_event_category('Test category').colour, 'red')
+		EventCategory.objects.filter(name='Test category').update(colour='green')
+		self.assertEqual(models.get_event_category('Test category').colour, 'red')
+		with mock.patch('reserver.models.time.monotonic', return_value=time.monotonic() + models.REGISTRY_MAX_AGE):
+			self.assertEqual(models.get_event_category('Test category').colour, 'green')
+			
+	def test_event_dictionary_is_read_from_the_database(self):
+		version = models.get_registry_version()
+		event_dict_instance = models.get_event_dict_instance()
+		event_dict_instance.make_outdated()
+		self.assertEqual(models.get_registry_version(), version)
+		EventDictionary.objects.filter(pk=event_dict_instance.pk).update(needs_update=False)
+		self.assertFalse(models.get_event_dict_instance().needs_update)
+		
+class AdminOverviewTests(TestCase):
+	def setUp(self):
+		cache.clear()
+		User.objects.create_superuser(username='admin', email='admin@example.com', password='password')
+		self.client.login(username='admin', password='password')
+		
+	def test_long_lists_link_to_their_listing(self):
+		first_cruise = create_test_cruise(leader_username='first_leader', day=datetime.date(2030, 5, 2), is_submitted=True)
+		second_cruise = create_test_cruise(leader_username='second_leader', day=datetime.date(2030, 6, 7), is_submitted=True)
+		with mock.patch('reserver.views.ADMIN_OVERVIEW_LIST_SIZE', 1):
+			response = self.client.get(reverse('admin'))
+		self.assertEqual(list(response.context['unapproved_cruises']), [first_cruise])
+		self.assertContains(response, 'Showing the first 1 of 2.')
+		response = self.client.get(response.context['all_unapproved_cruises_url'])
+		self.assertEqual({cruise.pk for cruise in response.context['listing']}, {first_cruise.pk, second_cruise.pk})
+		
+	def test_users_awaiting_approval_are_listed(self):
+		user = User.objects.create_user(username='new_user', email='new_user@example.com', password='password')
+		user.userdata.email_confirmed = True
+		user.userdata.save()
+		response = self.client.get(reverse('admin-users'))
+		self.assertNotIn(user.userdata.pk, [userdata.pk for userdata in response.context['listing']])
+		response = self.client.get(reverse('admin-users'), {'awaiting_approval': 'True'})
+		self.assertEqual([userdata.pk for userdata in response.context['listing']], [user.userdata.pk])
+		
+class AdminListingTests(TestCase):
+	def get_listing(self, **parameters):
+		request = RequestFactory().get('/admin/cruises/', parameters)
+		return AdminListing(request, Cruise.objects.all(), sort_options={'submitted': ('Submit date', 'submit_date', EARLIEST_DATETIME)}, default_sort='submitted', page_size=1)
+		
+	def test_cursor_pages_through_rows_submitted_microseconds_apart(self):
+		submit_date = timezone.make_aware(datetime.datetime(2030, 5, 2, 8, 0, 0, 500))
+		cruises = []
+		for i in range(3):
+			cruises.append(create_test_cruise(leader_username='leader' + str(i), submit_date=submit_date + datetime.timedelta(microseconds=i)))
+		listing = self.get_listing()
+		seen = [item.pk for item in listing]
+		# bounded, so a cursor that repeats a row fails the test rather than looping forever
+		while listing.has_next and len(seen) <= len(cruises):
+			listing = self.get_listing(sort='submitted', after=listing.encode_cursor(listing.items[-1]))
+			seen += [item.pk for item in listing]
+		self.assertEqual(seen, [cruise.pk for cruise in cruises])
+		listing = self.get_listing(sort='submitted', before=listing.encode_cursor(listing.items[0]))
+		self.assertEqual([item.pk for item in listing], [cruises[1].pk])
+		
+	def test_admin_cruise_view_lists_approved_cruises(self):
+		cruise = create_test_cruise(day=datetime.date(2030, 5, 2), is_approved=True)
+		User.objects.create_superuser(username='admin', email='admin@example.com', password='password')
+		self.client.login(username='admin', password='password')
+		response = self.client.get(reverse('admin-cruises'))
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual([item.pk for item in response.context['listing']], [cruise.pk])
+		
+class DocumentStorageTests(TemporaryMediaMixin, TransactionTestCase):
+	""" Blobs are released after commit, so these run in real transactions. """
+	
+	def create_document(self, cruise, content, name='report.pdf'):
+		# assigned rather than saved through the field, like a form's upload
+		document = Document(cruise=cruise, name=name, file=ContentFile(content, name=name))
+		document.save()
+		return document
+		
+	def age_blob(self, name):
+		# past the grace period uploads get, as if it was stored long ago
+		old_time = time.time() - ORPHANED_BLOB_MIN_AGE - 1
+		os.utime(document_storage.path(name), (old_time, old_time))
+		
+	def test_identical_uploads_share_a_blob_until_both_are_deleted(self):
+		cruise = create_test_cruise()
+		first_document = self.create_document(cruise, b'same contents', 'first.pdf')
+		second_document = self.create_document(cruise, b'same contents', 'second.pdf')
+		self.assertEqual(first_document.file.name, second_document.file.name)
+		self.assertEqual(second_document.original_name, 'second.pdf')
+		name = first_document.file.name
+		self.age_blob(name)
+		first_document.delete()
+		self.assertTrue(document_storage.exists(name))
+		second_document.delete()
+		self.assertFalse(document_storage.exists(name))
+		
+	def test_replaced_file_is_released(self):
+		document = self.create_document(create_test_cruise(), b'old contents')
+		old_name = document.file.name
+		self.age_blob(old_name)
+		document.file = ContentFile(b'new contents', name='report.pdf')
+		document.save()
+		self.assertFalse(document_storage.exists(old_name))
+		self.assertTrue(document_storage.exists(document.file.name))
+		
+	def test_rolled_back_delete_keeps_the_file(self):
+		document = self.create_document(create_test_cruise(), b'contents')
+		name = document.file.name
+		self.age_blob(name)
+		try:
+			with transaction.atomic():
+				document.delete()
+				raise RuntimeError("rolled back")
+		except RuntimeError:
+			pass
+		self.assertTrue(document_storage.exists(name))
+		
+	def test_blob_reused_by_an_upload_is_kept(self):
+		# the new upload's Document isn't saved yet, so nothing refers to the blob in the database
+		name = document_storage.save('report.pdf', ContentFile(b'contents'))
+		self.assertFalse(release_document_blob(name))
+		self.assertTrue(document_storage.exists(name))
+		self.age_blob(name)
+		self.assertTrue(release_document_blob(name))
+		self.assertFalse(document_storage.exists(name))
+		
+	def test_deduplicate_documents_reports_missing_files(self):
+		document = self.create_document(create_test_cruise(), b'contents')
+		Document.objects.filter(pk=document.pk).update(file='missing.pdf')
+		output = io.StringIO()
+		call_command('deduplicate_documents', stdout=output)
+		self.assertIn("Document " + str(document.pk) + " refers to missing file missing.pdf, skipped", output.getvalue())
+		self.assertEqual(Document.objects.get(pk=document.pk).file.name, 'missing.pdf')
+		
+class BackupTests(TemporaryMediaTestCase):
+	def setUp(self):
+		super(BackupTests, self).setUp()
+		# the test database lives in memory, so the backups are made of a database file of their own
+		self.backup_folder = tempfile.mkdtemp()
+		self.database_path = os.path.join(self.backup_folder, 'source.sqlite3')
+		database = sqlite3.connect(self.database_path)
+		database.execute("CREATE TABLE cruise (name TEXT)")
+		database.execute("INSERT INTO cruise VALUES ('Test cruise')")
+		database.commit()
+		database.close()
+		self.database_patch = mock.patch.dict(settings.DATABASES, {'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': self.database_path}})
+		self.database_patch.start()
+		self.backup_settings = override_settings(BACKUP_PATH=os.path.join(self.backup_folder, 'backups'), ACTION_ARCHIVE_PATH=os.path.join(self.backup_folder, 'action-archive'))
+		self.backup_settings.enable()
+		self.write_upload('documents/ab/report.txt', b'report contents')
+		self.write_upload('pdf-cache/cruise-1-abc.pdf', b'rendered PDF')
+		os.makedirs(settings.ACTION_ARCHIVE_PATH)
+		with gzip.open(os.path.join(settings.ACTION_ARCHIVE_PATH, 'actions-2030-05.jsonl.gz'), 'wb') as archive_file:
+			archive_file.write(b'{"id": 1}\n')
+		
+	def tearDown(self):
+		self.backup_settings.disable()
+		self.database_patch.stop()
+		shutil.rmtree(self.backup_folder, ignore_errors=True)
+		super(BackupTests, self).tearDown()
+		
+	def write_upload(self, name, contents):
+		path = os.path.join(self.media_root, *name.split('/'))
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		with open(path, 'wb') as upload:
+			upload.write(contents)
+			
+	def test_streamed_archive_has_database_and_uploads(self):
+		archive = zipfile.ZipFile(io.BytesIO(b''.join(backups.iter_backup_archive())))
+		self.assertIn('db.sqlite3', archive.namelist())
+		self.assertEqual(archive.read('uploads/documents/ab/report.txt'), b'report contents')
+		self.assertNotIn('uploads/pdf-cache/cruise-1-abc.pdf', archive.namelist())
+		self.assertIn('action-archive/actions-2030-05.jsonl.gz', archive.namelist())
+		
+	def test_backup_download_has_archived_actions(self):
+		User.objects.create_superuser(username='admin', email='admin@example.com', password='password')
+		self.client.login(username='admin', password='password')
+		response = self.client.get(reverse('backup-view'))
+		archive = zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content)))
+		self.assertIn('action-archive/actions-2030-05.jsonl.gz', archive.namelist())
+		self.assertIn('uploads/documents/ab/report.txt', archive.namelist())
+		
+	def test_archived_actions_are_backed_up_without_uploads(self):
+		archive = zipfile.ZipFile(io.BytesIO(b''.join(backups.iter_backup_archive(include_uploads=False))))
+		self.assertIn('action-archive/actions-2030-05.jsonl.gz', archive.namelist())
+		self.assertNotIn('uploads/documents/ab/report.txt', archive.namelist())
+		
+	def test_restore_rebuilds_database_and_uploads(self):
+		manifest_name, written_count, written_size = backups.create_incremental_backup()
+		destination = os.path.join(self.backup_folder, 'restored')
+		backups.restore_backup(manifest_name, destination)
+		with open(os.path.join(destination, 'uploads', 'documents', 'ab', 'report.txt'), 'rb') as restored_upload:
+			self.assertEqual(restored_upload.read(), b'report contents')
+		self.assertFalse(os.path.exists(os.path.join(destination, 'uploads', 'pdf-cache')))
+		with gzip.open(os.path.join(destination, 'action-archive', 'actions-2030-05.jsonl.gz'), 'rb') as restored_archive:
+			self.assertEqual(restored_archive.read(), b'{"id": 1}\n')
+		database = sqlite3.connect(os.path.join(destination, 'db.sqlite3'))
+		self.assertEqual(database.execute("SELECT name FROM cruise").fetchall(), [('Test cruise',)])
+		database.close()
+		self.assertEqual(backups.verify_backups(), [])
+		
+	def test_unchanged_files_are_stored_once(self):
+		first_manifest_name, written_count, written_size = backups.create_incremental_backup()
+		self.write_upload('documents/cd/new.txt', b'new contents')
+		second_manifest_name, written_count, written_size = backups.create_incremental_backup()
+		first_manifest = backups.read_manifest(first_manifest_name)
+		second_manifest = backups.read_manifest(second_manifest_name)
+		self.assertEqual(second_manifest['previous'], first_manifest_name)
+		self.assertEqual(second_manifest['files']['uploads/documents/ab/report.txt'], first_manifest['files']['uploads/documents/ab/report.txt'])
+		self.assertIn('uploads/documents/cd/new.txt', second_manifest['files'])
+		# the new upload, and the database snapshot if its bytes differ
+		self.assertIn(written_count, (1, 2))
+		
+	def test_existing_manifest_is_not_replaced(self):
+		now = timezone.now()
+		with mock.patch('reserver.backups.timezone.now', return_value=now):
+			manifest_name, written_count, written_size = backups.create_incremental_backup()
+			with self.assertRaises(ValueError):
+				backups.create_incremental_backup()
+		self.assertEqual(backups.get_manifest_names(), [manifest_name])
+		
+	def test_corrupt_objects_are_found(self):
+		manifest_name, written_count, written_size = backups.create_incremental_backup()
+		digest = backups.read_manifest(manifest_name)['files']['uploads/documents/ab/report.txt']['sha256']
+		with gzip.open(backups.find_object(digest), 'wb') as stored_object:
+			stored_object.write(b'something else')
+		self.assertEqual(len(backups.verify_backups()), 1)
+		with self.assertRaises(ValueError):
+			backups.restore_backup(manifest_name, os.path.join(self.backup_folder, 'restored'))
+			
+class UploadViewTests(TemporaryMediaTestCase):
+	def setUp(self):
+		super(UploadViewTests, self).setUp()
+		self.cruise = create_test_cruise()
+		self.document = Document(cruise=self.cruise, name='Report', file=ContentFile(b'0123456789', name='report.txt'))
+		self.document.save()
+		self.url = reverse('upload', args=[self.document.file.name])
+		
+	def test_document_is_sent_with_its_original_name(self):
+		self.client.login(username='leader', password='password')
+		response = self.client.get(self.url)
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual(b''.join(response.streaming_content), b'0123456789')
+		self.assertEqual(response['Content-Disposition'], "inline; filename*=UTF-8''report.txt")
+		self.assertIn('private', response['Cache-Control'])
+		
+	def test_document_is_hidden_from_other_users(self):
+		User.objects.create_user(username='outsider', email='outsider@example.com', password='password')
+		self.client.login(username='outsider', password='password')
+		self.assertEqual(self.client.get(self.url).status_code, 403)
+		
+	def test_paths_outside_uploads_are_not_found(self):
+		User.objects.create_superuser(username='admin', email='admin@example.com', password='password')
+		self.client.login(username='admin', password='password')
+		self.assertEqual(self.client.get(reverse('upload', args=['../manage.py'])).status_code, 404)
+		
+	def test_byte_ranges(self):
+		self.client.login(username='leader', password='password')
+		response = self.client.get(self.url, HTTP_RANGE='bytes=2-5')
+		self.assertEqual(response.status_code, 206)
+		self.assertEqual(b''.join(response.streaming_content), b'2345')
+		self.assertEqual(response['Content-Range'], 'bytes 2-5/10')
+		response = self.client.get(self.url, HTTP_RANGE='bytes=-3')
+		self.assertEqual(b''.join(response.streaming_content), b'789')
+		response = self.client.get(self.url, HTTP_RANGE='bytes=10-')
+		self.assertEqual(response.status_code, 416)
+		self.assertEqual(response['Content-Range'], 'bytes */10')
+		
+	def test_range_is_ignored_once_the_file_has_changed(self):
+		self.client.login(username='leader', password='password')
+		response = self.client.get(self.url, HTTP_RANGE='bytes=2-5', HTTP_IF_RANGE='"outdated"')
+		self.assertEqual(response.status_code, 200)
+		
+	def test_unchanged_file_is_not_sent_again(self):
+		self.client.login(username='leader', password='password')
+		etag = self.client.get(self.url)['ETag']
+		self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+		
+	@override_settings(UPLOAD_SENDFILE_HEADER='X-Accel-Redirect', UPLOAD_ACCEL_REDIRECT_PREFIX='/protected-uploads/')
+	def test_front_end_server_sends_the_file(self):
+		self.client.login(username='leader', password='password')
+		response = self.client.get(self.url)
+		self.assertEqual(response['X-Accel-Redirect'], '/protected-uploads/' + self.document.file.name)
+		
+class CruisePDFTests(TemporaryMediaTestCase):
+	def test_cruise_pdf_view_sends_pdf(self):
+		cruise = create_test_cruise()
+		self.client.login(username='leader', password='password')
+		response = self.client.get(reverse('cruise-pdf-view', args=[cruise.pk]))
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual(response['Content-Type'], 'application/pdf')
+		self.assertTrue(b''.join(response.streaming_content).startswith(b'%PDF'))
+		
+	def test_cruise_pdf_view_is_served_from_cache_until_cruise_changes(self):
+		cruise = create_test_cruise()
+		self.client.login(username='leader', password='password')
+		first_response = self.client.get(reverse('cruise-pdf-view', args=[cruise.pk]))
+		second_response = self.client.get(reverse('cruise-pdf-view', args=[cruise.pk]))
+		self.assertEqual(first_response['ETag'], second_response['ETag'])
+		cruise.description = 'Changed description'
+		cruise.save()
+		third_response = self.client.get(reverse('cruise-pdf-view', args=[cruise.pk]))
+		self.assertNotEqual(first_response['ETag'], third_response['ETag'])
+		self.assertEqual(len(os.listdir(os.path.join(self.media_root, 'pdf-cache'))), 1)
+		
+	def test_cruise_pdf_view_requires_permission(self):
+		cruise = create_test_cruise()
+		User.objects.create_user(username='outsider', email='outsider@example.com', password='password')
+		self.client.login(username='outsider', password='password')
+		response = self.client.get(reverse('cruise-pdf-view', args=[cruise.pk]))
+		self.assertEqual(response.status_code, 403)
+		
+	def test_cruise_approval_survives_failing_pdf_render(self):
+		cruise = create_test_cruise(day=datetime.date(2030, 5, 2))
+		User.objects.create_superuser(username='admin', email='admin@example.com', password='password')
+		self.client.login(username='admin', password='password')
+		with mock.patch('reserver.pdfs.render_cruise_pdf_html', side_effect=RuntimeError("broken template")):
+			response = self.client.post(reverse('cruise-approve', args=[cruise.pk]), '{}', content_type='application/json')
+		self.assertEqual(response.status_code, 200)
+		self.assertTrue(Cruise.objects.get(pk=cruise.pk).is_approved)
+		
+	def test_season_export_merges_cruise_pdfs(self):
+		season = create_test_season()
+		first_cruise = create_test_cruise(leader_username='first_leader', day=datetime.date(2030, 5, 2))
+		second_cruise = create_test_cruise(leader_username='second_leader', day=datetime.date(2030, 6, 7))
+		Cruise.objects.filter(pk__in=[first_cruise.pk, second_cruise.pk]).update(is_approved=True)
+		# not approved, so left out
+		create_test_cruise(leader_username='third_leader', day=datetime.date(2030, 7, 1))
+		User.objects.create_superuser(username='admin', email='admin@example.com', password='password')
+		self.client.login(username='admin', password='password')
+		response = self.client.get(reverse('admin-cruise-pdf-export'), {'season': season.pk})
+		self.assertEqual(response.status_code, 200)
+		merged = PdfFileReader(io.BytesIO(b''.join(response.streaming_content)))
+		# the contents page, then one page for each cruise
+		self.assertGreaterEqual(merged.getNumPages(), 3)
+		self.assertEqual([bookmark.title for bookmark in merged.getOutlines()], ['Contents', str(first_cruise), str(second_cruise)])
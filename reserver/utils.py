@@ -1,6 +1,8 @@
 import urllib.parse
+from collections import OrderedDict
 from datetime import timedelta
 import datetime
+import time
 import pytz
 from django.utils import timezone
 from django.utils.encoding import force_text
@@ -9,7 +11,8 @@ from django.contrib.auth.tokens import PasswordResetTokenGenerator
 from django.contrib.sites.shortcuts import get_current_site
 from django.utils.encoding import force_bytes
 from django.utils import six
-from django.core.mail import send_mail, get_connection
+from django.core.mail import send_mail
+from smtplib import SMTPException
 from django.contrib import messages
 from dateutil.easter import *
 
@@ -24,14 +27,12 @@ account_activation_token = AccountActivationTokenGenerator()
 def send_activation_email(request, user):
 	from django.conf import settings
 	from django.contrib.auth.models import User
-	from reserver.models import UserData, EmailTemplate
-	file_backend = get_connection('django.core.mail.backends.filebased.EmailBackend')
-	smtp_backend = get_connection(settings.EMAIL_BACKEND)
+	from reserver.models import get_email_template
 	
 	user.userdata.email_confirmed = False
 	user.userdata.save()
 	current_site = get_current_site(request)
-	template = EmailTemplate.objects.get(title="Confirm email address")
+	template = get_email_template("Confirm email address")
 	subject = template.title
 	context = {
 		'user': user,
@@ -41,24 +42,14 @@ def send_activation_email(request, user):
 	}
 	message = template.render_message_body(context)
 	
-	send_mail(
-		subject,
-		message,
-		settings.DEFAULT_FROM_EMAIL,
-		[user.email],
-		fail_silently=False,
-		connection=file_backend,
-		html_message=template.render(context)
-	)
-	
 	try:
+		# archived copy is written to EMAIL_FILE_PATH by the tee backend
 		send_mail(
 			subject,
 			message,
 			settings.DEFAULT_FROM_EMAIL,
 			[user.email],
 			fail_silently=False,
-			connection=smtp_backend,
 			html_message=template.render(context)
 		)
 	except SMTPException as e:
@@ -69,9 +60,9 @@ def send_activation_email(request, user):
 def send_user_approval_email(request, user):
 	from django.conf import settings
 	from django.contrib.auth.models import User
-	from reserver.models import EmailTemplate
+	from reserver.models import get_email_template
 	current_site = get_current_site(request)
-	template = EmailTemplate.objects.get(title="Account approved")
+	template = get_email_template("Account approved")
 	subject = template.title
 	context = {
 		'user': user,
@@ -91,32 +82,74 @@ def server_starting():
 	return ('runserver' in sys.argv)
 
 def init():
-	check_default_models()
-	check_for_and_fix_users_without_userdata()
-	check_for_and_fix_cruises_without_organizations()
-	check_if_upload_folders_exist()
-	remove_orphaned_cruisedays()
-	invalidate_cruise_info_caches()
-	update_cruise_main_invoices()
-	
-	current_year = datetime.datetime.now().year
-	for year in range(current_year,current_year+5):
-		print("Creating red day events for " + str(year))
-		create_events_from_list(get_red_days_for_year(year))
-	
+	from django.conf import settings
+	from reserver.maintenance import run_maintenance_tasks
 	from reserver import jobs
+	boot_profile = []
+	if settings.RUN_MAINTENANCE_ON_BOOT:
+		boot_profile += run_maintenance_tasks()
+	else:
+		print("Skipping maintenance tasks; run them with manage.py run_maintenance")
+		
+	started = time.perf_counter()
 	jobs.main()
+	boot_profile.append(("scheduler", "started", time.perf_counter()-started))
+	print_boot_profile(boot_profile)
+	
+def print_boot_profile(boot_profile, title="Startup profile"):
+	""" Prints how long each startup step took, given (step, outcome, seconds) tuples. """
+	print(title + ":")
+	for step, outcome, duration in boot_profile:
+		print("  {:<32} {:<8} {:8.3f} s".format(step, outcome, duration))
+	print("  {:<32} {:<8} {:8.3f} s".format("total", "", sum(duration for step, outcome, duration in boot_profile)))
 	
-def update_cruise_main_invoices():
-	from reserver.models import Cruise, InvoiceInformation
-	for cruise in Cruise.objects.all():
-		if InvoiceInformation.objects.filter(cruise=cruise).exists():
-			cruise.generate_main_invoice()
-
 def invalidate_cruise_info_caches():
 	from reserver.models import Cruise
 	Cruise.objects.all().update(missing_information_cache_outdated=True)
 	
+def update_cruise_display_names(**kwargs):
+	""" Fills in display names for cruises that don't have one yet, or for every cruise if update_all is set. """
+	from reserver.models import Cruise
+	cruises = Cruise.objects.select_related('leader')
+	if not kwargs.get("update_all"):
+		cruises = cruises.filter(display_name='')
+	for cruise in cruises:
+		cruise.update_display_name()
+	
+def deduplicate_statistics():
+	""" Gives statistics collected before they were limited to one per day their day, keeping the first
+	    row of each day and deleting the rest. Returns the number of deleted rows. """
+	from django.db import transaction
+	from reserver.models import Statistics
+	with transaction.atomic():
+		taken_days = set(Statistics.objects.filter(day__isnull=False).values_list('day', flat=True))
+		duplicate_pks = []
+		for pk, timestamp in Statistics.objects.filter(day__isnull=True, timestamp__isnull=False).order_by('timestamp', 'pk').values_list('pk', 'timestamp'):
+			day = timezone.localtime(timestamp).date()
+			if day in taken_days:
+				duplicate_pks.append(pk)
+			else:
+				Statistics.objects.filter(pk=pk).update(day=day)
+				taken_days.add(day)
+		for index in range(0, len(duplicate_pks), 500):
+			Statistics.objects.filter(pk__in=duplicate_pks[index:index+500]).delete()
+	return len(duplicate_pks)
+	
+def copy_legacy_statistics():
+	""" Copies days of the old wide statistics table into StatisticValue, unless that day is already there. Returns the number of copied days. """
+	from reserver.models import Statistics, StatisticValue
+	legacy_fields = ['event_count', 'cruise_count', 'approved_cruise_count', 'cruise_day_count', 'approved_cruise_day_count', 'user_count', 'emailconfirmed_user_count', 'organization_count', 'email_notification_count']
+	copied_days = set(StatisticValue.objects.filter(metric='cruise_count').values_list('day', flat=True))
+	new_values = []
+	copied_count = 0
+	for statistics in Statistics.objects.filter(day__isnull=False).values('day', *legacy_fields).iterator():
+		if statistics['day'] in copied_days:
+			continue
+		new_values += [StatisticValue(metric=field, day=statistics['day'], value=statistics[field]) for field in legacy_fields]
+		copied_count += 1
+	StatisticValue.objects.bulk_create(new_values, batch_size=500)
+	return copied_count
+	
 def get_red_days_for_year(year):
 	# first: generate list of red day objects with dates and names for the year
 	# then iterate over them, and check whether they already exist for that year
@@ -161,30 +194,69 @@ def get_red_days_for_year(year):
 	
 def create_events_from_list(days):
 	"""Takes a list of objects with 'date' (string, YYYY-MM-DD) and 'name' (string) attributes,
-	and creates (0800 to 1600) Event objects from them unless an object
-	with that name already exists on that date."""
-	from reserver.models import Event, EventCategory
-	added_events_count = 0
-	off_day_event_category = EventCategory.objects.get(name="Red day")
-	for day in days:
-		year = day["date"].split("-")[0]
-		if not Event.objects.filter(start_time__year=year, name=day["name"]).exists():
-			event = Event(
-				start_time = timezone.make_aware(datetime.datetime.strptime(day["date"], '%Y-%m-%d').replace(hour=8)),
-				end_time = timezone.make_aware(datetime.datetime.strptime(day["date"], '%Y-%m-%d').replace(hour=16)),
-				name = day["name"],
-				category = off_day_event_category,
-				description = "This day is a Norwegian national holiday."
-			)
-			event.save()
-			added_events_count += 1
-		elif not Event.objects.filter(start_time__year=year, name=day["name"], category=off_day_event_category).exists():
-			event = Event.objects.get(start_time__year=year, name=day["name"])
-			event.category = off_day_event_category
-			event.save()
-			print("Corrected an event category")
-			
+	and creates (0800 to 1600) red day Event objects from them unless an event
+	with that name already exists in that year. Returns the number of created events."""
+	from django.db import IntegrityError, transaction
+	from reserver.models import Event, get_event_category
+	if len(days) == 0:
+		return 0
+	off_day_event_category = get_event_category("Red day")
+	dates = [datetime.datetime.strptime(day["date"], '%Y-%m-%d') for day in days]
+	
+	# red days created before holiday_date existed can only be recognized by name and year
+	first_year = min(date.year for date in dates)
+	last_year = max(date.year for date in dates)
+	existing_events = Event.objects.filter(
+		name__in=[day["name"] for day in days],
+		start_time__gte=timezone.make_aware(datetime.datetime(first_year, 1, 1)),
+		start_time__lt=timezone.make_aware(datetime.datetime(last_year+1, 1, 1)),
+	).values_list('name', 'start_time')
+	existing_days = set((name, timezone.localtime(start_time).year) for name, start_time in existing_events)
+	
+	new_events = []
+	for day, date in zip(days, dates):
+		if (day["name"], date.year) in existing_days:
+			continue
+		new_events.append(Event(
+			start_time = timezone.make_aware(date.replace(hour=8)),
+			end_time = timezone.make_aware(date.replace(hour=16)),
+			name = day["name"],
+			category = off_day_event_category,
+			description = "This day is a Norwegian national holiday.",
+			holiday_date = date.date(),
+		))
+		
+	try:
+		with transaction.atomic():
+			Event.objects.bulk_create(new_events)
+		added_events_count = len(new_events)
+	except IntegrityError:
+		# another process created some of them first; the unique (category, holiday_date, name) key
+		# rejects those, so add the rest one at a time
+		added_events_count = 0
+		for event in new_events:
+			event.pk = None
+			try:
+				with transaction.atomic():
+					event.save()
+				added_events_count += 1
+			except IntegrityError:
+				pass
+				
 	print("Added " + str(added_events_count) + " new event(s)")
+	return added_events_count
+	
+def set_red_day_holiday_dates():
+	""" Fills in holiday_date for red day events created before it existed. """
+	from django.db import IntegrityError, transaction
+	from reserver.models import Event
+	for event in Event.objects.filter(category__name="Red day", holiday_date__isnull=True, start_time__isnull=False):
+		try:
+			with transaction.atomic():
+				Event.objects.filter(pk=event.pk).update(holiday_date=timezone.localtime(event.start_time).date())
+		except IntegrityError:
+			# a duplicate of another red day; it stays without a date
+			pass
 	
 def check_if_upload_folders_exist():
 	""" This should be renamed; it's misleading since this also creates
@@ -200,49 +272,125 @@ def check_if_upload_folders_exist():
 	if not os.path.exists(settings.EMAIL_FILE_PATH):
 		os.makedirs(settings.EMAIL_FILE_PATH)
 		print("Created folder " + settings.EMAIL_FILE_PATH)
+		
+	if not os.path.exists(settings.ACTION_ARCHIVE_PATH):
+		os.makedirs(settings.ACTION_ARCHIVE_PATH)
+		print("Created folder " + settings.ACTION_ARCHIVE_PATH)
+
+# the integrity sweeps below work on this many rows per query and transaction
+SWEEP_CHUNK_SIZE = 500
 
+def get_chunks(items, size=SWEEP_CHUNK_SIZE):
+	items = list(items)
+	for index in range(0, len(items), size):
+		yield items[index:index+size]
+		
 def check_for_and_fix_users_without_userdata():
+	""" Gives users without user data an empty user data, or an admin one for superusers. Returns the number of fixed users. """
 	from django.contrib.auth.models import User
-	from django.core.exceptions import PermissionDenied, ObjectDoesNotExist
+	from django.db import transaction
 	from reserver.models import UserData, Organization
-	for user in User.objects.all():
-		# check for users without user data, and add them to unapproved users if they're not admins
-		# these may be legacy accounts or accounts created using manage.py's adduser
-		try:
-			user.userdata
-		except ObjectDoesNotExist:
-			user_data = UserData()
-			if user.is_superuser:
-				user_data.role = "admin"
-				user_data.organization = Organization.objects.get(name="R/V Gunnerus")
-			else:
-				user_data.role = ""
-			user_data.user = user
-			user_data.save()
-			
+	# new users get user data when they're saved, so only legacy accounts from before that can lack it
+	gunnerus_org = Organization.objects.filter(name="R/V Gunnerus").first()
+	fixed_count = 0
+	for chunk in get_chunks(User.objects.filter(userdata__isnull=True).values_list('pk', 'is_superuser')):
+		with transaction.atomic():
+			UserData.objects.bulk_create([
+				UserData(user_id=pk, role="admin", organization=gunnerus_org) if is_superuser else UserData(user_id=pk, role="")
+				for pk, is_superuser in chunk
+			])
+		fixed_count += len(chunk)
+	return fixed_count
+	
 def check_for_and_fix_cruises_without_organizations():
-	from django.contrib.auth.models import User
-	from django.core.exceptions import PermissionDenied, ObjectDoesNotExist
-	from reserver.models import UserData, Cruise
-	for cruise in Cruise.objects.all():
-		# check for cruises without an organization, and try to update them from leader's org
-		# these are old cruises created while we had a bug in saving cruise orgs
-		if cruise.organization is None:
-			try:
-				cruise.organization = cruise.leader.userdata.organization
-				cruise.save()
-				print("Corrected cruise org for " + str(cruise) + " to " + str(cruise.leader.userdata.organization))
-			except ObjectDoesNotExist:
-				print("Found cruise missing organization, but leader has no organization")
-				
+	""" Gives cruises without an organization their leader's organization. Returns the number of fixed cruises. """
+	from django.db import transaction
+	from reserver.models import Cruise
+	# these are old cruises created while we had a bug in saving cruise orgs
+	fixable_cruises = Cruise.objects.filter(organization__isnull=True, leader__userdata__organization__isnull=False)
+	cruises_by_organization = {}
+	for pk, organization_pk in fixable_cruises.values_list('pk', 'leader__userdata__organization'):
+		cruises_by_organization.setdefault(organization_pk, []).append(pk)
+	fixed_count = 0
+	for organization_pk, cruise_pks in cruises_by_organization.items():
+		for chunk in get_chunks(cruise_pks):
+			with transaction.atomic():
+				fixed_count += Cruise.objects.filter(pk__in=chunk, organization__isnull=True).update(organization=organization_pk, missing_information_cache_outdated=True)
+	unfixable_count = Cruise.objects.filter(organization__isnull=True).count()
+	if unfixable_count > 0:
+		print("Found " + str(unfixable_count) + " cruise(s) missing organization, but their leaders have no organization")
+	return fixed_count
+	
 def remove_orphaned_cruisedays():
-	from django.core.exceptions import PermissionDenied, ObjectDoesNotExist
-	from reserver.models import Event, CruiseDay, EventCategory
-	cruise_day_category = EventCategory.objects.get(name="Cruise day")
-	for cruise_day_event in Event.objects.filter(category=cruise_day_category):
-		if not CruiseDay.objects.filter(event=cruise_day_event).exists():
-			print("Deleted orphaned cruise day "+str(cruise_day_event))
-			cruise_day_event.delete()
+	""" Deletes cruise day events that no cruise day refers to. Returns the number of deleted events. """
+	from django.db import transaction
+	from reserver.models import Event
+	# Event has no delete receivers, so these deletes cascade set-wise rather than row by row
+	orphaned_event_pks = Event.objects.filter(category__name="Cruise day", cruiseday__isnull=True).values_list('pk', flat=True)
+	deleted_count = 0
+	for chunk in get_chunks(orphaned_event_pks):
+		with transaction.atomic():
+			Event.objects.filter(pk__in=chunk).delete()
+		deleted_count += len(chunk)
+	return deleted_count
+	
+def update_cruise_main_invoices():
+	""" Regenerates the main invoices that no longer match their cruise's receipt, a chunk at a time with
+	    one delete and one insert of generated items. Returns the number of updated invoices. """
+	from decimal import Decimal
+	from django.db import transaction
+	from django.db.models import Case, Value, When
+	from reserver.models import Cruise, InvoiceInformation, ListPrice, PRICE_DECIMAL_PLACES
+	price_precision = Decimal(10) ** -PRICE_DECIMAL_PLACES
+	invoices = InvoiceInformation.objects.filter(is_cruise_invoice=True, cruise__isnull=False).values_list('pk', 'cruise', 'title')
+	updated_count = 0
+	for chunk in get_chunks(invoices):
+		cruises = Cruise.objects.in_bulk([cruise_pk for invoice_pk, cruise_pk, title in chunk])
+		current_items = {}
+		for invoice_pk, name, price in ListPrice.objects.filter(invoice__in=[invoice_pk for invoice_pk, cruise_pk, title in chunk], is_generated=True).values_list('invoice', 'name', 'price'):
+			current_items.setdefault(invoice_pk, []).append((name, price))
+			
+		outdated_invoices = []
+		new_titles = {}
+		new_items = []
+		for invoice_pk, cruise_pk, title in chunk:
+			cruise = cruises[cruise_pk]
+			items = cruise.get_main_invoice_list_prices(invoice_pk)
+			new_title = cruise.get_main_invoice_title()
+			# prices are stored rounded, so compare them rounded
+			if sorted((item.name, item.price.quantize(price_precision)) for item in items) == sorted(current_items.get(invoice_pk, [])) and title == new_title:
+				continue
+			outdated_invoices.append(invoice_pk)
+			if title != new_title:
+				new_titles[invoice_pk] = new_title
+			new_items.extend(items)
+			
+		if not outdated_invoices:
+			continue
+		with transaction.atomic():
+			if new_titles:
+				InvoiceInformation.objects.filter(pk__in=new_titles).update(title=Case(*[When(pk=invoice_pk, then=Value(title)) for invoice_pk, title in new_titles.items()]))
+			ListPrice.objects.filter(invoice__in=outdated_invoices, is_generated=True).delete()
+			ListPrice.objects.bulk_create(new_items)
+		updated_count += len(outdated_invoices)
+	return updated_count
+	
+def run_integrity_sweeps():
+	""" Runs the data repairs and returns {sweep: rows touched}. The sweeps work with queryset updates,
+	    bulk inserts and deletes and models without receivers, so no save receivers fire; the caches they
+	    would have cleared are cleared here. """
+	from django.core.cache import cache
+	from reserver.models import ADMIN_BADGE_COUNTS_CACHE_KEY, ADMIN_OVERVIEW_CACHE_KEY, set_date_dict_outdated
+	summary = OrderedDict([
+		("users without user data", check_for_and_fix_users_without_userdata()),
+		("cruises without organization", check_for_and_fix_cruises_without_organizations()),
+		("orphaned cruise day events", remove_orphaned_cruisedays()),
+		("outdated main invoices", update_cruise_main_invoices()),
+	])
+	if any(summary.values()):
+		cache.delete_many([ADMIN_BADGE_COUNTS_CACHE_KEY, ADMIN_OVERVIEW_CACHE_KEY])
+		set_date_dict_outdated()
+	return summary
 
 def render_add_cal_button(event_name, event_description, start_time, end_time):
 	safe_name = urllib.parse.quote(str(event_name))
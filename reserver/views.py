@@ -15,19 +15,21 @@ from django.contrib.auth.tokens import PasswordResetTokenGenerator
 from django.contrib.sites.shortcuts import get_current_site
 from django.utils.encoding import force_bytes
 from django.utils import six
-import os, tempfile, zipfile
+import os
 from django.http import HttpResponse
-from wsgiref.util import FileWrapper
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
+from django.core.cache import cache
+from django.utils.http import urlencode
+from django.utils.dateparse import parse_date
 from easy_pdf.views import PDFTemplateView
-from easy_pdf.rendering import html_to_pdf, make_response, render_to_pdf_response
+from easy_pdf.rendering import html_to_pdf, make_response
 from django.utils.decorators import method_decorator
 from django import template
 import pyqrcode
 import io
 import base64
 
-from reserver.utils import check_for_and_fix_users_without_userdata, send_user_approval_email
+from reserver.utils import send_user_approval_email
 from reserver.models import *
 from reserver.forms import *
 from reserver.test_models import create_test_models
@@ -38,7 +40,7 @@ from django.contrib.auth.forms import UserCreationForm
 from django.views.decorators.csrf import csrf_exempt
 from django.core.mail import send_mail, get_connection
 
-from django.http import HttpResponse, JsonResponse, HttpResponseRedirect
+from django.http import HttpResponse, JsonResponse, HttpResponseRedirect, StreamingHttpResponse
 from django.template import loader
 from django.utils import timezone
 from reserver.utils import init, send_activation_email
@@ -46,59 +48,56 @@ import datetime
 import json
 from reserver.jobs import send_email, send_template_only_email
 from django.conf import settings
+from django.db.models import Case, IntegerField, Max, Value, When
+from reserver.listings import AdminListing, EARLIEST_DATETIME
+from reserver.backups import iter_backup_archive
+from reserver.downloads import serve_file
+from reserver.pdfs import get_cruise_pdf, queue_cruise_pdf, get_cruises_between, get_merged_cruise_pdf
+from django.http import Http404
+from django.utils._os import safe_join
+from django.core.exceptions import SuspiciousFileOperation
 
-def remove_dups_keep_order(lst):
-	without_dups = []
-	for item in lst:
-		if (item not in without_dups):
-			without_dups.append(item)
-	return without_dups
-	
 def backup_view(request):
-	"""																		 
-	Create a ZIP file on disk and transmit it in chunks of 8KB,				 
-	without loading the whole file into memory. A similar approach can		  
-	be used for large dynamic PDF files.										
-	"""
-	temp = tempfile.TemporaryFile()
-	archive = zipfile.ZipFile(temp, 'w', zipfile.ZIP_DEFLATED)
-	archive.write(settings.DATABASES["default"]["NAME"], 'db.sqlite3')
-	for filename in os.listdir(settings.MEDIA_ROOT):
-		filepath = os.path.join(settings.MEDIA_ROOT, filename)
-		if os.path.isdir(filepath):
-			# skip directories
-			continue
-		archive.write(filepath, "uploads\\"+filename)
-	for filename in os.listdir(os.path.join(settings.BASE_DIR, "reserver/migrations")):
-		filepath = os.path.join(os.path.join(settings.BASE_DIR, "reserver/migrations"), filename)
-		if os.path.isdir(filepath):
-			# skip directories
-			continue
-		archive.write(filepath, "migrations\\"+filename)
-	archive.close()
-	length = temp.tell()
-	wrapper = FileWrapper(temp)
-	temp.seek(0)
-	response = HttpResponse(wrapper, content_type='application/zip')
+	""" Streams a zip of a consistent database snapshot and the uploads as it's being built. """
+	response = StreamingHttpResponse(iter_backup_archive(), content_type='application/zip')
 	response['Content-Disposition'] = 'attachment; filename=reserver-backup-'+timezone.now().strftime('%Y-%m-%d-%H%M%S')+'.zip'
-	response['Content-Length'] = length
 	return response
+	
+def is_upload_viewable_by(user, name):
+	""" Whether the user may download the upload with the given name, relative to MEDIA_ROOT.
+	    Cruise documents follow their cruise; anything else, such as logged emails, is for superusers. """
+	if user.is_superuser:
+		return True
+	documents = Document.objects.filter(file=name).select_related('cruise__organization')
+	return any(document.cruise.is_viewable_by(user) for document in documents)
+	
+def upload_view(request, path):
+	try:
+		full_path = safe_join(settings.MEDIA_ROOT, path)
+	except SuspiciousFileOperation:
+		raise Http404
+	name = os.path.relpath(full_path, settings.MEDIA_ROOT).replace(os.sep, '/')
+	if not is_upload_viewable_by(request.user, name):
+		raise PermissionDenied
+	if not os.path.isfile(full_path):
+		raise Http404
+	# documents are stored under their hash, so they're sent with the name they were uploaded with
+	original_name = Document.objects.filter(file=name).exclude(original_name='').values_list('original_name', flat=True).first()
+	return serve_file(request, full_path, original_name)
 
 def get_cruises_need_attention():
-	return remove_dups_keep_order(list(Cruise.objects.filter(is_submitted=True, is_approved=True, information_approved=False, cruise_end__gte=timezone.now())))
+	return Cruise.objects.filter(is_submitted=True, is_approved=True, information_approved=False, cruise_end__gte=timezone.now()).select_related('leader', 'organization')
 	
 def get_upcoming_cruises():
-	return remove_dups_keep_order(list(Cruise.objects.filter(is_submitted=True, is_approved=True, information_approved=True, cruise_end__gte=timezone.now())))
+	return Cruise.objects.filter(is_submitted=True, is_approved=True, information_approved=True, cruise_end__gte=timezone.now()).select_related('leader', 'organization')
 
 def get_unapproved_cruises():
-	return remove_dups_keep_order(Cruise.objects.filter(is_submitted=True, is_approved=False, cruise_end__gte=timezone.now()).order_by('submit_date'))
+	return Cruise.objects.filter(is_submitted=True, is_approved=False, cruise_end__gte=timezone.now()).order_by('submit_date').select_related('leader', 'organization')
 	
 def get_users_not_approved():
-	check_for_and_fix_users_without_userdata()
-	return list(UserData.objects.filter(role="", email_confirmed=True, user__is_active=True))
+	return UserData.objects.filter(role="", email_confirmed=True, user__is_active=True).select_related('user', 'organization')
 	
 def get_organizationless_users():
-	check_for_and_fix_users_without_userdata()
 	return list(UserData.objects.filter(organization__isnull=True))
 	
 class CruiseList(ListView):
@@ -336,7 +335,8 @@ class CruiseEditView(UpdateView):
 				messages.add_message(self.request, messages.SUCCESS, mark_safe('Cruise ' + str(Cruise) + ' updated.'))
 		if (old_cruise.information_approved):
 			admin_user_emails = [admin_user.email for admin_user in list(User.objects.filter(userdata__role='admin'))]
-			send_template_only_email(admin_user_emails, EmailTemplate.objects.get(title='Approved cruise updated'), cruise=old_cruise)
+			send_template_only_email(admin_user_emails, get_email_template('Approved cruise updated'), cruise=old_cruise)
+		queue_cruise_pdf(new_cruise, self.request)
 		return HttpResponseRedirect(self.get_success_url())
 		
 	def form_invalid(self, form, cruiseday_form, participant_form, document_form, equipment_form, invoice_form):
@@ -365,19 +365,8 @@ def cruise_pdf_view(request, pk):
 	if not cruise.is_viewable_by(request.user):
 		raise PermissionDenied
 		
-	context = {
-		'pagesize': 'A4',
-		'title': 'Cruise summary for ' + str(cruise),
-		'cruise': cruise,
-		'http_host': request.META['HTTP_HOST']
-	}
-		
-	return render_to_pdf_response(
-		request,
-		'reserver/pdfs/cruise_pdf.html',
-		context,
-		download_filename='cruise.pdf'
-	)
+	# rendered ahead of time when the cruise is approved or edited, and otherwise once per version of the cruise
+	return serve_file(request, get_cruise_pdf(cruise, request.get_host()), 'cruise.pdf')
 		
 class CruiseView(CruiseEditView):
 	template_name = 'reserver/cruise_view_form.html'
@@ -495,7 +484,7 @@ def login_redirect(request):
 
 def submit_cruise(request, pk):
 	cruise = get_object_or_404(Cruise, pk=pk)
-	if request.user == cruise.leader or request.user in cruise.owner.all():
+	if cruise.is_owned_by(request.user):
 		if not cruise.is_submittable(user=request.user):
 			messages.add_message(request, messages.ERROR, mark_safe('Cruise could not be submitted: ' + str(cruise.get_missing_information_string()) + '<br>You may review and add any missing or invalid information under its entry in your saved cruise drafts below.'))
 		else:
@@ -510,7 +499,7 @@ def submit_cruise(request, pk):
 			action.save()
 			"""Sends notification email to admins about a new cruise being submitted."""
 			admin_user_emails = [admin_user.email for admin_user in list(User.objects.filter(userdata__role='admin'))]
-			send_template_only_email(admin_user_emails, EmailTemplate.objects.get(title='New cruise'), cruise=cruise)
+			send_template_only_email(admin_user_emails, get_email_template('New cruise'), cruise=cruise)
 			messages.add_message(request, messages.SUCCESS, mark_safe('Cruise successfully submitted. You may track its approval status under "<a href="#cruiseTop">Your Cruises</a>".'))
 	else:
 		raise PermissionDenied
@@ -530,7 +519,7 @@ def unsubmit_cruise(request, pk):
 		set_date_dict_outdated()
 		messages.add_message(request, messages.WARNING, mark_safe('Cruise ' + str(cruise) + ' cancelled.'))
 		admin_user_emails = [admin_user.email for admin_user in list(User.objects.filter(userdata__role='admin'))]
-		send_template_only_email(admin_user_emails, EmailTemplate.objects.get(title='Cruise cancelled'), cruise=cruise)
+		send_template_only_email(admin_user_emails, get_email_template('Cruise cancelled'), cruise=cruise)
 		delete_cruise_deadline_and_departure_notifications(cruise)
 	else:
 		raise PermissionDenied
@@ -591,6 +580,7 @@ def approve_cruise(request, pk):
 			create_cruise_deadline_and_departure_notifications(cruise)
 		else:
 			create_cruise_notifications(cruise, 'Cruise deadlines')
+		queue_cruise_pdf(cruise, request)
 	else:
 		raise PermissionDenied
 	return JsonResponse(json.dumps([], ensure_ascii=True), safe=False)
@@ -645,6 +635,7 @@ def approve_cruise_information(request, pk):
 		if cruise.is_approved:
 			create_cruise_notifications(cruise, 'Cruise departure')
 			create_cruise_administration_notification(cruise, 'Cruise information approved', message=message)
+		queue_cruise_pdf(cruise, request)
 	else:
 		raise PermissionDenied
 	return JsonResponse(json.dumps([], ensure_ascii=True), safe=False)
@@ -879,7 +870,7 @@ def create_cruise_administration_notification(cruise, template, **kwargs):
 	else:
 		notif.extra_message = ""
 	notif.event = cruise_day_event
-	notif.template = EmailTemplate.objects.get(title=template)
+	notif.template = get_email_template(template)
 	notif.save()
 	jobs.create_jobs(jobs.scheduler, [notif])
 	
@@ -920,7 +911,7 @@ def create_season_notifications(season):
 	if (internal_opening_event.start_time > timezone.now()):
 		internal_notification = EmailNotification()
 		internal_notification.event = internal_opening_event
-		internal_notification.template = EmailTemplate.objects.get(title="Internal season opening")
+		internal_notification.template = get_email_template("Internal season opening")
 		internal_notification.save()
 		jobs.create_jobs(jobs.scheduler, [internal_notification])
 	
@@ -928,7 +919,7 @@ def create_season_notifications(season):
 	if (external_opening_event.start_time > timezone.now()):
 		external_notification = EmailNotification()
 		external_notification.event = external_opening_event
-		external_notification.template = EmailTemplate.objects.get(title="External season opening")
+		external_notification.template = get_email_template("External season opening")
 		external_notification.save()
 		jobs.create_jobs(jobs.scheduler, [external_notification])
 	
@@ -946,9 +937,6 @@ def delete_season_notifications(season):
 	
 #To be run when a season is changed
 	
-def get_cruise_pdf(request, pk):
-	return "Not implemented"
-	
 class UserView(UpdateView):
 	template_name = 'reserver/user.html'
 	model = User
@@ -974,63 +962,120 @@ class UserView(UpdateView):
 		elif self.request.user.userdata.email_confirmed and self.request.user.userdata.role == "":
 			messages.add_message(self.request, messages.WARNING, "Your user account has not been approved by an administrator yet. You may save cruise drafts and edit them, but you may not submit cruises for approval before your account is approved.")
 		
+		my_cruises = list(Cruise.objects.filter(pk__in=self.request.user.cruise_permissions.get_cruise_ids()))
+		
 		# add submitted cruises to context
-		submitted_cruises = list(set(list(Cruise.objects.filter(leader=self.request.user, is_submitted=True) | Cruise.objects.filter(owner=self.request.user, is_submitted=True))))
-		context['my_submitted_cruises'] = sorted(list(submitted_cruises), key=lambda x: str(x.cruise_start), reverse=False)
+		submitted_cruises = [cruise for cruise in my_cruises if cruise.is_submitted]
+		context['my_submitted_cruises'] = sorted(submitted_cruises, key=lambda x: str(x.cruise_start), reverse=False)
 		
 		# add unsubmitted cruises to context
-		unsubmitted_cruises = list(set(list(Cruise.objects.filter(leader=self.request.user, is_submitted=False) | Cruise.objects.filter(owner=self.request.user, is_submitted=False))))
-		context['my_unsubmitted_cruises'] = sorted(list(unsubmitted_cruises), key=lambda x: str(x.cruise_start), reverse=False)
+		unsubmitted_cruises = [cruise for cruise in my_cruises if not cruise.is_submitted]
+		context['my_unsubmitted_cruises'] = sorted(unsubmitted_cruises, key=lambda x: str(x.cruise_start), reverse=False)
 		return context
 	
 class CurrentUserView(UserView):
 	def get_object(self):
 		return self.request.user
 	
+# the overview shows the first few of each list and links to the admin listings for the rest
+ADMIN_OVERVIEW_LIST_SIZE = 20
+
 def admin_view(request):
-	last_actions = list(Action.objects.filter(timestamp__lte=timezone.now(), timestamp__gt=timezone.now()-datetime.timedelta(days=30)))[:-4:-1]
-	cruises_need_attention = get_cruises_need_attention()
-	upcoming_cruises = get_upcoming_cruises()
-	unapproved_cruises = get_unapproved_cruises()
-	users_not_approved = get_users_not_approved()
-	current_year = timezone.now().year
-	next_year = timezone.now().year+1
-	internal_days_remaining = 150-CruiseDay.objects.filter(event__start_time__year = current_year, cruise__is_approved = True, cruise__leader__userdata__organization__is_NTNU = True).count()
-	external_days_remaining = 30-CruiseDay.objects.filter(event__start_time__year = current_year, cruise__is_approved = True, cruise__leader__userdata__organization__is_NTNU = False).count()
-	internal_days_remaining_next_year = 150-CruiseDay.objects.filter(event__start_time__year = next_year, cruise__is_approved = True, cruise__leader__userdata__organization__is_NTNU = True).count()
-	external_days_remaining_next_year = 30-CruiseDay.objects.filter(event__start_time__year = next_year, cruise__is_approved = True, cruise__leader__userdata__organization__is_NTNU = False).count()
-	if(len(cruises_need_attention) > 1):
-		messages.add_message(request, messages.WARNING, mark_safe(('<i class="fa fa-exclamation-triangle" aria-hidden="true"></i> %s approved cruises have not had their information approved yet.' % str(len(cruises_need_attention)))+"<br><br><a class='btn btn-primary' href='#approved-cruises-needing-attention'><i class='fa fa-arrow-down' aria-hidden='true'></i> Jump to cruises</a>"))
-	elif(len(cruises_need_attention) == 1):
+	overview = get_admin_overview_snapshot()
+	cruises_need_attention = get_cruises_need_attention().order_by('cruise_start', 'pk')[:ADMIN_OVERVIEW_LIST_SIZE]
+	upcoming_cruises = get_upcoming_cruises().order_by('cruise_start', 'pk')[:ADMIN_OVERVIEW_LIST_SIZE]
+	unapproved_cruises = get_unapproved_cruises()[:ADMIN_OVERVIEW_LIST_SIZE]
+	users_not_approved = get_users_not_approved().order_by('user__last_name', 'pk')[:ADMIN_OVERVIEW_LIST_SIZE]
+	today = str(timezone.localdate())
+	cruises_need_attention_count = overview['cruises_need_attention_count']
+	users_not_approved_count = overview['users_not_approved_count']
+	unapproved_cruises_count = overview['unapproved_cruises_count']
+	if(cruises_need_attention_count > 1):
+		messages.add_message(request, messages.WARNING, mark_safe(('<i class="fa fa-exclamation-triangle" aria-hidden="true"></i> %s approved cruises have not had their information approved yet.' % str(cruises_need_attention_count))+"<br><br><a class='btn btn-primary' href='#approved-cruises-needing-attention'><i class='fa fa-arrow-down' aria-hidden='true'></i> Jump to cruises</a>"))
+	elif(cruises_need_attention_count == 1):
 		messages.add_message(request, messages.WARNING, mark_safe('<i class="fa fa-exclamation-triangle" aria-hidden="true"></i> An approved cruise has not had its information approved yet.'+"<br><br><a class='btn btn-primary' href='#approved-cruises-needing-attention'><i class='fa fa-arrow-down' aria-hidden='true'></i> Jump to cruise</a>"))
-	if(len(users_not_approved) > 1):
-		messages.add_message(request, messages.INFO, mark_safe(('<i class="fa fa-info-circle" aria-hidden="true"></i> %s users need attention.' % str(len(users_not_approved)))+"<br><br><a class='btn btn-primary' href='#users-needing-attention'><i class='fa fa-arrow-down' aria-hidden='true'></i> Jump to users</a>"))
-	elif(len(users_not_approved) == 1):
+	if(users_not_approved_count > 1):
+		messages.add_message(request, messages.INFO, mark_safe(('<i class="fa fa-info-circle" aria-hidden="true"></i> %s users need attention.' % str(users_not_approved_count))+"<br><br><a class='btn btn-primary' href='#users-needing-attention'><i class='fa fa-arrow-down' aria-hidden='true'></i> Jump to users</a>"))
+	elif(users_not_approved_count == 1):
 		messages.add_message(request, messages.INFO, mark_safe('<i class="fa fa-info-circle" aria-hidden="true"></i> A user needs attention.'+"<br><br><a class='btn btn-primary' href='#users-needing-attention'><i class='fa fa-arrow-down' aria-hidden='true'></i> Jump to user</a>"))
-	if(len(unapproved_cruises) > 1):
-		messages.add_message(request, messages.INFO, mark_safe(('<i class="fa fa-info-circle" aria-hidden="true"></i> %s cruises are awaiting approval.' % str(len(unapproved_cruises)))+"<br><br><a class='btn btn-primary' href='#unapproved-cruises-needing-attention'><i class='fa fa-arrow-down' aria-hidden='true'></i> Jump to cruises</a>"))
-	elif(len(unapproved_cruises) == 1):
+	if(unapproved_cruises_count > 1):
+		messages.add_message(request, messages.INFO, mark_safe(('<i class="fa fa-info-circle" aria-hidden="true"></i> %s cruises are awaiting approval.' % str(unapproved_cruises_count))+"<br><br><a class='btn btn-primary' href='#unapproved-cruises-needing-attention'><i class='fa fa-arrow-down' aria-hidden='true'></i> Jump to cruises</a>"))
+	elif(unapproved_cruises_count == 1):
 		messages.add_message(request, messages.INFO, mark_safe('<i class="fa fa-info-circle" aria-hidden="true"></i> A cruise is awaiting approval.'+"<br><br><a class='btn btn-primary' href='#unapproved-cruises-needing-attention'><i class='fa fa-arrow-down' aria-hidden='true'></i> Jump to cruise</a>"))
-	return render(request, 'reserver/admin_overview.html', {'unapproved_cruises':unapproved_cruises, 'upcoming_cruises':upcoming_cruises, 'cruises_need_attention':cruises_need_attention, 'users_not_verified':users_not_approved, 'internal_days_remaining':internal_days_remaining, 'external_days_remaining':external_days_remaining, 'internal_days_remaining_next_year':internal_days_remaining_next_year, 'external_days_remaining_next_year':external_days_remaining_next_year, 'current_year':current_year, 'next_year':next_year, 'last_actions':last_actions})
+	context = {
+		'unapproved_cruises':unapproved_cruises,
+		'upcoming_cruises':upcoming_cruises,
+		'cruises_need_attention':cruises_need_attention,
+		'users_not_verified':users_not_approved,
+		'all_unapproved_cruises_url':reverse('admin-cruises') + '?' + urlencode({'sort': 'submitted', 'approved': 'False', 'ends_after': today}),
+		'all_upcoming_cruises_url':reverse('admin-cruises') + '?' + urlencode({'sort': 'start', 'information_approved': 'True', 'ends_after': today}),
+		'all_cruises_need_attention_url':reverse('admin-cruises') + '?' + urlencode({'sort': 'start', 'information_approved': 'False', 'ends_after': today}),
+		'all_users_not_verified_url':reverse('admin-users') + '?' + urlencode({'awaiting_approval': 'True'}),
+	}
+	context.update(overview)
+	return render(request, 'reserver/admin_overview.html', context)
 
 def admin_cruise_view(request):
-	cruises = list(Cruise.objects.filter(is_approved=True))
-	cruises_need_attention = get_cruises_need_attention()
-	users_not_approved = get_users_not_approved()
-	if(len(cruises_need_attention) > 1):
-		messages.add_message(request, messages.WARNING, mark_safe(('<i class="fa fa-exclamation-triangle" aria-hidden="true"></i> %s upcoming cruises have not had their information approved yet.' % str(len(cruises_need_attention)))+"<br><br><a class='btn btn-primary' href='"+reverse('admin')+"#approved-cruises-needing-attention'><i class='fa fa-arrow-right' aria-hidden='true'></i> Jump to cruises</a>"))
-	elif(len(cruises_need_attention) == 1):
+	if request.GET.get('approved') == 'False':
+		cruises = Cruise.objects.filter(is_submitted=True, is_approved=False)
+	else:
+		cruises = Cruise.objects.filter(is_approved=True)
+	cruises = cruises.select_related('leader', 'organization').annotate(
+		listing_has_food=Max(Case(When(Q(cruise__breakfast_count__gt=0) | Q(cruise__lunch_count__gt=0) | Q(cruise__dinner_count__gt=0), then=Value(1)), default=Value(0), output_field=IntegerField())),
+		listing_has_overnight_stays=Max(Case(When(cruise__overnight_count__gt=0, then=Value(1)), default=Value(0), output_field=IntegerField())),
+		listing_invoice_sent=Max(Case(When(invoiceinformation__is_cruise_invoice=True, invoiceinformation__is_sent=True, then=Value(1)), default=Value(0), output_field=IntegerField())),
+	)
+	listing = AdminListing(
+		request,
+		cruises,
+		sort_options={
+			'start': ('Start date', 'cruise_start', EARLIEST_DATETIME),
+			'submitted': ('Submit date', 'submit_date', EARLIEST_DATETIME),
+			'leader': ('Leader', 'leader__last_name', ''),
+		},
+		default_sort='-start',
+		search_fields=('display_name', 'leader__first_name', 'leader__last_name', 'organization__name', 'description'),
+		filter_options={
+			'approved': ('Cruise days', 'is_approved', [('True', 'Approved'), ('False', 'Awaiting approval')]),
+			'information_approved': ('Information', 'information_approved', [('True', 'Approved'), ('False', 'Not approved')]),
+			# the only choice is today, so links from the overview keep working until the day is over
+			'ends_after': ('Dates', 'cruise_end__date__gte', [(str(timezone.localdate()), 'Not ended yet')]),
+		}
+	)
+	cruises_need_attention_count = get_cruises_need_attention().count()
+	if(cruises_need_attention_count > 1):
+		messages.add_message(request, messages.WARNING, mark_safe(('<i class="fa fa-exclamation-triangle" aria-hidden="true"></i> %s upcoming cruises have not had their information approved yet.' % str(cruises_need_attention_count))+"<br><br><a class='btn btn-primary' href='"+reverse('admin')+"#approved-cruises-needing-attention'><i class='fa fa-arrow-right' aria-hidden='true'></i> Jump to cruises</a>"))
+	elif(cruises_need_attention_count == 1):
 		messages.add_message(request, messages.WARNING, mark_safe('<i class="fa fa-exclamation-triangle" aria-hidden="true"></i> An upcoming cruise has not had its information approved yet.'+"<br><br><a class='btn btn-primary' href='"+reverse('admin')+"#approved-cruises-needing-attention'><i class='fa fa-arrow-right' aria-hidden='true'></i> Jump to cruise</a>"))
-	return render(request, 'reserver/admin_cruises.html', {'cruises':cruises})
+	return render(request, 'reserver/admin_cruises.html', {'cruises':listing, 'listing':listing})
 	
 def admin_user_view(request):
-	users = list(UserData.objects.exclude(role="").order_by('-role', 'user__last_name', 'user__first_name'))
-	users_not_approved = get_users_not_approved()
-	if(len(users_not_approved) > 1):
-		messages.add_message(request, messages.INFO, mark_safe(('<i class="fa fa-info-circle" aria-hidden="true"></i> %s users need attention.' % str(len(users_not_approved)))+"<br><br><a class='btn btn-primary' href='"+reverse('admin')+"#users-needing-attention'><i class='fa fa-arrow-right' aria-hidden='true'></i> Jump to users</a>"))
-	elif(len(users_not_approved) == 1):
+	if request.GET.get('awaiting_approval') == 'True':
+		users = get_users_not_approved()
+	else:
+		users = UserData.objects.exclude(role="").select_related('user', 'organization')
+	listing = AdminListing(
+		request,
+		users,
+		sort_options={
+			'name': ('Last name', 'user__last_name', ''),
+			'organization': ('Organization', 'organization__name', ''),
+			'created': ('Registration date', 'created', EARLIEST_DATETIME),
+		},
+		default_sort='name',
+		search_fields=('user__first_name', 'user__last_name', 'user__username', 'user__email', 'organization__name', 'phone_number'),
+		filter_options={
+			'role': ('Role', 'role', [('internal', 'Internal users'), ('external', 'External users'), ('invoicer', 'Invoicers'), ('admin', 'Administrators')]),
+			# picks the users above rather than filtering them; users awaiting approval have confirmed their email
+			'awaiting_approval': ('Approval', 'email_confirmed', [('True', 'Awaiting approval')]),
+		}
+	)
+	users_not_approved_count = get_users_not_approved().count()
+	if(users_not_approved_count > 1):
+		messages.add_message(request, messages.INFO, mark_safe(('<i class="fa fa-info-circle" aria-hidden="true"></i> %s users need attention.' % str(users_not_approved_count))+"<br><br><a class='btn btn-primary' href='"+reverse('admin')+"#users-needing-attention'><i class='fa fa-arrow-right' aria-hidden='true'></i> Jump to users</a>"))
+	elif(users_not_approved_count == 1):
 		messages.add_message(request, messages.INFO, mark_safe('<i class="fa fa-info-circle" aria-hidden="true"></i> A user needs attention.'+"<br><br><a class='btn btn-primary' href='"+reverse('admin')+"#users-needing-attention'><i class='fa fa-arrow-right' aria-hidden='true'></i> Jump to user</a>"))
-	return render(request, 'reserver/admin_users.html', {'users':users})
+	return render(request, 'reserver/admin_users.html', {'users':listing, 'listing':listing})
 
 from hijack.signals import hijack_started, hijack_ended
 
@@ -1063,30 +1108,77 @@ class UserDataEditView(UpdateView):
 		return reverse_lazy('admin-users')
 	
 def admin_event_view(request):
-	off_day_event_category = EventCategory.objects.get(name="Red day")
-	cruise_day_event_category = EventCategory.objects.get(name="Cruise day")
-	all_events = list(Event.objects.all().exclude(category=cruise_day_event_category).exclude(category=off_day_event_category))
-	events = []
-	for event in all_events:
-		if event.is_scheduled_event():
-			events.append(event)
-
-	return render(request, 'reserver/admin_events.html', {'events':events})
+	off_day_event_category = get_event_category("Red day")
+	cruise_day_event_category = get_event_category("Cruise day")
+	# same as Event.is_scheduled_event, done in the query
+	events = Event.objects.exclude(category=cruise_day_event_category).exclude(category=off_day_event_category).filter(cruiseday__isnull=True, season__isnull=True, internal_order__isnull=True, external_order__isnull=True).select_related('category')
+	category_choices = [(str(category.pk), category.name) for category in EventCategory.objects.exclude(pk__in=[cruise_day_event_category.pk, off_day_event_category.pk])]
+	listing = AdminListing(
+		request,
+		events,
+		sort_options={
+			'start': ('Start time', 'start_time', EARLIEST_DATETIME),
+			'name': ('Name', 'name', ''),
+		},
+		default_sort='-start',
+		search_fields=('name', 'description'),
+		filter_options={
+			'category': ('Category', 'category', category_choices),
+		}
+	)
+	return render(request, 'reserver/admin_events.html', {'events':listing, 'listing':listing})
 	
 def admin_announcements_view(request):
 	stored_announcements = list(Announcement.objects.all())
 	return render(request, 'reserver/admin_announcements.html', {'stored_announcements':stored_announcements})
 
+ACTION_TYPE_CHOICES_CACHE_KEY = 'admin_action_type_choices'
+ACTION_TYPE_CHOICES_CACHE_TIMEOUT = 60*60
+
+def get_action_type_choices():
+	choices = cache.get(ACTION_TYPE_CHOICES_CACHE_KEY)
+	if choices is None:
+		choices = [(action, action) for action in Action.objects.order_by('action').values_list('action', flat=True).distinct()]
+		cache.set(ACTION_TYPE_CHOICES_CACHE_KEY, choices, ACTION_TYPE_CHOICES_CACHE_TIMEOUT)
+	return choices
+
 def admin_actions_view(request):
-	last_actions = list(Action.objects.filter(timestamp__lte=timezone.now(), timestamp__gt=timezone.now()-datetime.timedelta(days=30)))
+	archived_months = jobs.get_archived_action_months()
+	archive_month = request.GET.get('archive', '')
+	if archive_month in archived_months:
+		return admin_archived_actions_view(request, archive_month, archived_months)
+
+	listing = AdminListing(
+		request,
+		Action.objects.select_related('user'),
+		sort_options={
+			'time': ('Log time', 'timestamp', None),
+		},
+		default_sort='-time',
+		search_fields=('target', 'action', 'description'),
+		filter_options={
+			'user': ('User', 'user__username__iexact', None),
+			'action': ('Action', 'action', get_action_type_choices()),
+		},
+		page_size=20,
+	)
+
+	return render(request, 'reserver/admin_actions.html', {'actions':listing, 'listing':listing, 'archived_months':archived_months})
 
-	#actions = Action.objects.all()
-	#"paginator = Paginator(actions, 25) # Show 25 actions per page
-	#page = request.GET.get('page')
-	#page_actions = paginator.get_page(page)
+def admin_archived_actions_view(request, archive_month, archived_months):
+	""" Archived actions are only kept as files, so a month is read in full and filtered here. """
+	search = request.GET.get('q', '').strip()
+	user = request.GET.get('user', '').strip()
+	action_type = request.GET.get('action', '')
+
+	actions = jobs.read_archived_actions(archive_month)
+	if search:
+		actions = [action for action in actions if any(search.lower() in action[field].lower() for field in ('target', 'action', 'description'))]
+	if user:
+		actions = [action for action in actions if action['user'].lower() == user.lower()]
+	if action_type:
+		actions = [action for action in actions if action['action'] == action_type]
 
-	actions = Action.objects.all()
-	actions = actions[::-1]
 	paginator = Paginator(actions, 20)
 	page = request.GET.get('page')
 	try:
@@ -1097,41 +1189,85 @@ def admin_actions_view(request):
 	except EmptyPage:
 		# If page is out of range (e.g. 9999), deliver last page of results.
 		page_actions = paginator.page(paginator.num_pages)
-	
-	return render(request, 'reserver/admin_actions.html', {'actions':page_actions})
+
+	query_string = urlencode({'archive': archive_month, 'q': search, 'user': user, 'action': action_type})
+
+	return render(request, 'reserver/admin_actions.html', {
+		'actions':page_actions,
+		'archive_month':archive_month,
+		'archived_months':archived_months,
+		'search':search,
+		'user_filter':user,
+		'action_filter':action_type,
+		'query_string':query_string,
+	})
+
+def get_date_parameter(request, name):
+	try:
+		return parse_date(request.GET.get(name, ''))
+	except ValueError:
+		return None
+
+STATISTICS_TABLE_METRICS = ['cruise_count', 'approved_cruise_count', 'cruise_day_count', 'approved_cruise_day_count', 'user_count', 'emailconfirmed_user_count', 'organization_count', 'emails_sent', 'emails_failed']
+STATISTICS_CHART_METRICS = ['user_count', 'cruise_day_count']
 
 def admin_statistics_view(request):
-	#last_statistics = list(Statistics.objects.filter(timestamp__lte=timezone.now(), timestamp__gt=timezone.now()-datetime.timedelta(days=30)))
-	last_statistics = list(Statistics.objects.filter(timestamp__lte=timezone.now()))
-	seen_timestamps = set()
-	unique_statistics = []
-	for statistic in last_statistics:
-		if statistic.timestamp.strftime('%Y-%m-%d') not in seen_timestamps:
-			unique_statistics.append(statistic)
-			seen_timestamps.add(statistic.timestamp.strftime('%Y-%m-%d'))
-	operation_years = []
-	for season in Season.objects.all():
-		season_start_year = season.season_event.start_time.year
-		season_end_year = season.season_event.end_time.year
-		if season_start_year not in operation_years:
-			operation_years.append(season_start_year)
-		if season_end_year not in operation_years:
-			operation_years.append(season_end_year)
-
-	unique_statistics.reverse()
-	
-	paginator = Paginator(unique_statistics, 20)
+	start = get_date_parameter(request, 'start')
+	end = get_date_parameter(request, 'end')
+	days = StatisticValue.objects.filter(metric='cruise_count').order_by('-day')
+	if start is not None:
+		days = days.filter(day__gte=start)
+	if end is not None:
+		days = days.filter(day__lte=end)
+	
+	paginator = Paginator(days.values_list('day', flat=True), 20)
 	page = request.GET.get('page')
 	try:
-		page_statistics = paginator.page(page)
+		page_days = paginator.page(page)
 	except PageNotAnInteger:
 		# If page is not an integer, deliver first page.
-		page_statistics = paginator.page(1)
+		page_days = paginator.page(1)
 	except EmptyPage:
 		# If page is out of range (e.g. 9999), deliver last page of results.
-		page_statistics = paginator.page(paginator.num_pages)
-		
-	return render(request, 'reserver/admin_statistics.html', {'statistics':page_statistics})
+		page_days = paginator.page(paginator.num_pages)
+		
+	# one row per day, one column per metric
+	day_values = {day: {} for day in page_days}
+	for day, metric, value in StatisticValue.objects.filter(day__in=list(page_days), metric__in=STATISTICS_TABLE_METRICS).values_list('day', 'metric', 'value'):
+		day_values[day][metric] = value
+	statistics_rows = [(day, [day_values[day].get(metric) for metric in STATISTICS_TABLE_METRICS]) for day in page_days]
+	
+	metrics = [(metric, get_statistic_metric_label(metric)) for metric in StatisticValue.objects.order_by('metric').values_list('metric', flat=True).distinct()]
+	query_string = urlencode({'start': start.isoformat() if start else '', 'end': end.isoformat() if end else ''})
+		
+	return render(request, 'reserver/admin_statistics.html', {
+		'statistics':page_days,
+		'statistics_rows':statistics_rows,
+		'statistics_columns':[get_statistic_metric_label(metric) for metric in STATISTICS_TABLE_METRICS],
+		'metrics':metrics,
+		'start':start,
+		'end':end,
+		'query_string':query_string,
+	})
+	
+def admin_statistics_series_view(request):
+	""" Returns the requested metrics as chart series, one point per day, week or month. With the
+	    automatic resolution, the longer the range, the coarser the points. """
+	start = get_date_parameter(request, 'start')
+	end = get_date_parameter(request, 'end')
+	metrics = request.GET.getlist('metric') or STATISTICS_CHART_METRICS
+	resolution = request.GET.get('resolution', '')
+	if resolution not in STATISTICS_SERIES_RESOLUTIONS:
+		first_day = start or StatisticValue.objects.filter(metric__in=metrics).order_by('day').values_list('day', flat=True).first()
+		days = ((end or timezone.localtime(timezone.now()).date()) - first_day).days if first_day else 0
+		if days <= 120:
+			resolution = 'day'
+		elif days <= 2*365:
+			resolution = 'week'
+		else:
+			resolution = 'month'
+	labels, series = get_statistics_series(resolution, metrics, start, end)
+	return JsonResponse({'resolution': resolution, 'labels': labels, 'series': series})
 	
 def admin_work_hour_view(request, **kwargs):
 	if (request.user.is_superuser):
@@ -1171,8 +1307,47 @@ def admin_work_hour_view(request, **kwargs):
 	)
 	
 def admin_season_view(request):
-	seasons = Season.objects.all().order_by('-season_event__start_time')
-	return render(request, 'reserver/admin_seasons.html', {'seasons':seasons})
+	listing = AdminListing(
+		request,
+		Season.objects.select_related('season_event', 'internal_order_event', 'external_order_event'),
+		sort_options={
+			'start': ('Start date', 'season_event__start_time', EARLIEST_DATETIME),
+			'name': ('Name', 'name', ''),
+		},
+		default_sort='-start',
+		search_fields=('name',),
+	)
+	return render(request, 'reserver/admin_seasons.html', {'seasons':listing, 'listing':listing})
+	
+def admin_cruise_pdf_export_view(request):
+	""" Sends the summaries of every approved cruise in a season, or between two dates, as one PDF. """
+	if request.GET.get('season'):
+		season = get_object_or_404(Season.objects.select_related('season_event'), pk=request.GET.get('season'))
+		if season.season_event is None:
+			messages.add_message(request, messages.WARNING, mark_safe('Season ' + str(season.name) + ' has no dates set.'))
+			return redirect('seasons')
+		title = 'Cruise summaries for ' + season.name
+		start = season.season_event.start_time
+		end = season.season_event.end_time
+		back_url = reverse('seasons')
+	else:
+		start_date = get_date_parameter(request, 'start')
+		end_date = get_date_parameter(request, 'end')
+		if start_date is None or end_date is None:
+			messages.add_message(request, messages.WARNING, mark_safe('Pick both a start and an end date to export cruise summaries.'))
+			return redirect('admin-cruises')
+		title = 'Cruise summaries, ' + str(start_date) + ' to ' + str(end_date)
+		start = timezone.make_aware(datetime.datetime.combine(start_date, datetime.time()))
+		end = timezone.make_aware(datetime.datetime.combine(end_date + datetime.timedelta(days=1), datetime.time()))
+		back_url = reverse('admin-cruises')
+	cruises = list(get_cruises_between(start, end))
+	if len(cruises) == 0:
+		messages.add_message(request, messages.WARNING, mark_safe('There are no approved cruises to export in that period.'))
+		return HttpResponseRedirect(back_url)
+	action = Action(user=request.user, timestamp=timezone.now(), target=title)
+	action.action = "exported cruise summaries"
+	action.save()
+	return serve_file(request, get_merged_cruise_pdf(title, cruises, request.get_host()), title + '.pdf')
 	
 def food_view(request, pk):
 	cruise = Cruise.objects.get(pk=pk)
@@ -1193,6 +1368,8 @@ def register_view(request):
 			user.is_active = True
 			user.save()
 			ud = userdata_form.save(commit=False)
+			# the user's blank user data was created on save, so fill in that instead of adding another
+			ud.pk = user.userdata.pk
 			ud.user = user
 			ud.email_confirmed = False
 			ud.save()
@@ -1217,11 +1394,11 @@ def activate_view(request, uidb64, token):
 	if user is not None and account_activation_token.check_token(user, token):
 		user.userdata.email_confirmed = True
 		user.userdata.save()
-		login(request, user)
+		login(request, user, backend='reserver.auth_backends.UserContextBackend')
 		messages.add_message(request, messages.SUCCESS, "Your account's email address has been confirmed!")
 		"""Sends notification mail to admins about a new user."""
 		admin_user_emails = [admin_user.email for admin_user in list(User.objects.filter(userdata__role='admin'))]
-		send_template_only_email(admin_user_emails, EmailTemplate.objects.get(title='New user'), user=user)
+		send_template_only_email(admin_user_emails, get_email_template('New user'), user=user)
 		return redirect('home')
 	else:
 		raise PermissionDenied
@@ -1267,18 +1444,18 @@ class CreateSeason(CreateView):
 		"""Called when all our forms are valid. Creates a Cruise with Participants and CruiseDays."""
 		season = form.save(commit=False)
 		season_event = Event()
-		season_event.category = EventCategory.objects.get(name="Season")
+		season_event.category = get_event_category("Season")
 		season_event.name = 'Event for ' + form.cleaned_data.get("name")
 		season_event.start_time = form.cleaned_data.get("season_event_start_date")
 		season_event.end_time = form.cleaned_data.get("season_event_end_date").replace(hour=23, minute=59)
 		season_event.save()
 		internal_order_event = Event()
-		internal_order_event.category = EventCategory.objects.get(name="Internal season opening")
+		internal_order_event.category = get_event_category("Internal season opening")
 		internal_order_event.name = 'Internal opening of ' + form.cleaned_data.get("name")
 		internal_order_event.start_time = form.cleaned_data.get("internal_order_event_date")
 		internal_order_event.save()
 		external_order_event = Event()
-		external_order_event.category = EventCategory.objects.get(name="External season opening")
+		external_order_event.category = get_event_category("External season opening")
 		external_order_event.name = 'External opening of ' + form.cleaned_data.get("name")
 		external_order_event.start_time = form.cleaned_data.get("external_order_event_date")
 		external_order_event.save()
@@ -1437,26 +1614,32 @@ class DeleteListPrice(DeleteView):
 
 def admin_debug_view(request):
 	if (request.user.is_superuser):
-		debug_data = DebugData.objects.all()
-		debug_data = debug_data[::-1]
-		paginator = Paginator(debug_data, 5)
-		page = request.GET.get('page')
-		try:
-			page_debug_data = paginator.page(page)
-		except PageNotAnInteger:
-			# If page is not an integer, deliver first page.
-			page_debug_data = paginator.page(1)
-		except EmptyPage:
-			# If page is out of range (e.g. 9999), deliver last page of results.
-			page_debug_data = paginator.page(paginator.num_pages)
+		listing = AdminListing(
+			request,
+			DebugData.objects.defer('data', 'request_metadata'),
+			sort_options={
+				'time': ('Log time', 'timestamp', None),
+			},
+			default_sort='-time',
+			search_fields=('label',),
+			page_size=25,
+		)
 	else:
 		raise PermissionDenied
 		
-	return render(request, 'reserver/admin_debug.html', {'debug_data': page_debug_data})
+	return render(request, 'reserver/admin_debug.html', {'debug_data': listing, 'listing': listing})
+	
+def admin_debug_detail_view(request, pk):
+	if (request.user.is_superuser):
+		log = get_object_or_404(DebugData, pk=pk)
+	else:
+		raise PermissionDenied
+		
+	return render(request, 'reserver/admin_debug_detail.html', {'log': log, 'log_data': log.get_data(), 'log_metadata': log.get_request_metadata()})
 		
 def view_cruise_invoices(request, pk):
 	cruise = get_object_or_404(Cruise, pk=pk)
-	if (request.user.pk == cruise.leader.pk or request.user in cruise.owner.all() or request.user.is_superuser):
+	if (cruise.is_owned_by(request.user) or request.user.is_superuser):
 		invoices = InvoiceInformation.objects.filter(cruise=pk)
 	else:
 		raise PermissionDenied
@@ -1665,7 +1848,7 @@ def reject_invoice(request, pk):
 		action.save()
 		messages.add_message(request, messages.SUCCESS, mark_safe('Invoice "' + str(invoice) + '" rejected.'))
 		admin_user_emails = [admin_user.email for admin_user in list(User.objects.filter(userdata__role='admin'))]
-		send_template_only_email(admin_user_emails, EmailTemplate.objects.get(title='Invoice rejected'), invoice=invoice)
+		send_template_only_email(admin_user_emails, get_email_template('Invoice rejected'), invoice=invoice)
 	else:
 		raise PermissionDenied
 	return JsonResponse(json.dumps([], ensure_ascii=True), safe=False)
@@ -1677,9 +1860,31 @@ class StringReprJSONEncoder(json.JSONEncoder):
 		except:
 			return '[unserializable]'
 	
+# request.META also holds the server's environment, so only these keys and the request headers are logged
+DEBUG_DATA_METADATA_KEYS = ['REMOTE_ADDR', 'REQUEST_METHOD', 'PATH_INFO', 'QUERY_STRING', 'CONTENT_TYPE', 'CONTENT_LENGTH', 'SERVER_NAME', 'SERVER_PORT']
+
+def get_debug_data_metadata(request):
+	return {key: value for key, value in request.META.items() if key in DEBUG_DATA_METADATA_KEYS or (key.startswith('HTTP_') and key != 'HTTP_COOKIE')}
+	
+def is_debug_data_rate_limited(user):
+	""" Counts logs per user in fixed windows of DEBUG_DATA_RATE_PERIOD seconds. """
+	key = 'debug_data_rate_' + str(user.pk)
+	if cache.add(key, 1, settings.DEBUG_DATA_RATE_PERIOD):
+		return False
+	try:
+		return cache.incr(key) > settings.DEBUG_DATA_RATE_LIMIT
+	except ValueError:
+		# the window expired between the two calls
+		cache.set(key, 1, settings.DEBUG_DATA_RATE_PERIOD)
+		return False
+	
 @csrf_exempt
 def log_debug_data(request):
 	if request.user.is_authenticated():
+		if int(request.META.get('CONTENT_LENGTH') or 0) > settings.DEBUG_DATA_MAX_PAYLOAD_SIZE or len(request.body) > settings.DEBUG_DATA_MAX_PAYLOAD_SIZE:
+			return JsonResponse({'error': 'Debug data is too large.'}, status=413)
+		if is_debug_data_rate_limited(request.user):
+			return JsonResponse({'error': 'Too much debug data has been logged recently.'}, status=429)
 		log_data = ""
 		label = ""
 		try:
@@ -1688,12 +1893,15 @@ def log_debug_data(request):
 			label = json_data["label"]
 		except:
 			pass
+		if not isinstance(log_data, str):
+			log_data = json.dumps(log_data, cls=StringReprJSONEncoder, ensure_ascii=True)
 		log = DebugData()
-		log.data = log_data
-		log.label = label + " from user " + str(request.user)
+		log.set_data(log_data)
+		log.label = (str(label)[:500] + " from user " + str(request.user))[:1000]
 		log.timestamp = timezone.now()
-		log.request_metadata = json.dumps(request.META, cls=StringReprJSONEncoder, ensure_ascii=True)
+		log.set_request_metadata(json.dumps(get_debug_data_metadata(request), cls=StringReprJSONEncoder, ensure_ascii=True))
 		log.save()
+		jobs.trim_debug_data()
 	else:
 		raise PermissionDenied
 	return JsonResponse(json.dumps([], ensure_ascii=True), safe=False)
@@ -1709,7 +1917,7 @@ def mark_invoice_as_finalized(request, pk):
 		action.save()
 		messages.add_message(request, messages.SUCCESS, mark_safe('Invoice "' + str(invoice) + '" marked as finalized. It is now viewable by invoicers.'))
 		invoicer_user_emails = [invoice_user.email for invoice_user in list(User.objects.filter(userdata__role='invoicer'))]
-		send_template_only_email(invoicer_user_emails, EmailTemplate.objects.get(title='New invoice ready'), invoice=invoice)
+		send_template_only_email(invoicer_user_emails, get_email_template('New invoice ready'), invoice=invoice)
 	else:
 		raise PermissionDenied
 	return redirect(request.META['HTTP_REFERER'])
@@ -1789,9 +1997,19 @@ def mark_invoice_as_unsent(request, pk):
 # organization views
 
 def admin_organization_view(request):
-	organizations = list(Organization.objects.all())
-
-	return render(request, 'reserver/admin_organizations.html', {'organizations':organizations})	
+	listing = AdminListing(
+		request,
+		Organization.objects.all(),
+		sort_options={
+			'name': ('Name', 'name', ''),
+		},
+		default_sort='name',
+		search_fields=('name',),
+		filter_options={
+			'is_NTNU': ('NTNU', 'is_NTNU', [('True', 'NTNU'), ('False', 'Not NTNU')]),
+		}
+	)
+	return render(request, 'reserver/admin_organizations.html', {'organizations':listing, 'listing':listing})
 		
 class CreateOrganization(CreateView):
 	model = Organization
@@ -1828,8 +2046,7 @@ class OrganizationDeleteView(DeleteView):
 # category views
 
 def admin_eventcategory_view(request):
-	from reserver.utils import check_default_models
-	check_default_models()
+	ensure_default_models()
 	eventcategories = list(EventCategory.objects.all())
 
 	return render(request, 'reserver/admin_eventcategories.html', {'eventcategories':eventcategories})
@@ -1946,55 +2163,61 @@ class AnnouncementDeleteView(DeleteView):
 # notification views
 
 def view_email_logs(request):
-	import os.path
-	email_logs = []
-	email_log_files = os.listdir(settings.EMAIL_FILE_PATH)
-	email_log_files.sort()
-	for filename in email_log_files:
-		data = ""
-		subject = ""
-		recipients = ""
-		with open(os.path.join(settings.EMAIL_FILE_PATH, filename), 'r') as email_log:
-			data=email_log.read()
-			try:
-				subject = re.search('Subject: ([^\n]*)', data).group(1)
-			except AttributeError:
-				pass
-			try:
-				recipients = re.search('To: ([^\n]*)', data).group(1)
-			except AttributeError:
-				pass
-		email_logs.append({
-			"title": filename,
-			"subject": subject,
-			"recipients": recipients,
-			"url": "/uploads/debug-emails/"+filename
-		})
-	email_logs.reverse()
-
-	return render(request, 'reserver/admin_sent_emails.html', {'email_logs':email_logs})
+	email_logs = EmailLog.objects.all().order_by('-timestamp')
+	paginator = Paginator(email_logs, 25)
+	page = request.GET.get('page')
+	try:
+		page_email_logs = paginator.page(page)
+	except PageNotAnInteger:
+		# If page is not an integer, deliver first page.
+		page_email_logs = paginator.page(1)
+	except EmptyPage:
+		# If page is out of range (e.g. 9999), deliver last page of results.
+		page_email_logs = paginator.page(paginator.num_pages)
+
+	return render(request, 'reserver/admin_sent_emails.html', {'email_logs':page_email_logs})
 
 def test_email_view(request):
 	send_email('test@test.no', 'a message', EmailNotification())
 	return HttpResponseRedirect(reverse_lazy('email_list_view'))
 	
 def purge_email_logs(request):
-	import os
-	import glob
-
-	files = glob.glob(settings.EMAIL_FILE_PATH+'*')
-	for file in files:
-		if ".log" in file and "debug-emails" in file:
-			os.remove(file)
-		
+	from reserver.jobs import apply_email_log_retention
+	deleted_count = apply_email_log_retention(delete_all=True)
+	messages.add_message(request, messages.SUCCESS, mark_safe('Purged ' + str(deleted_count) + ' email logs.'))
 	return HttpResponseRedirect(reverse_lazy('email_list_view'))
 
 def admin_notification_view(request):
-	from reserver.utils import check_default_models
-	check_default_models()
+	ensure_default_models()
 	notifications = EmailNotification.objects.filter(is_special=True)
 	email_templates = EmailTemplate.objects.all()
-	return render(request, 'reserver/admin_notifications.html', {'notifications':notifications, 'email_templates':email_templates})
+	dead_deliveries = EmailDelivery.objects.filter(status=EmailDelivery.DEAD).order_by('-created')
+	pending_delivery_count = EmailDelivery.objects.filter(status=EmailDelivery.PENDING).count()
+	return render(request, 'reserver/admin_notifications.html', {'notifications':notifications, 'email_templates':email_templates, 'dead_deliveries':dead_deliveries, 'pending_delivery_count':pending_delivery_count})
+
+def retry_email_delivery_view(request, pk):
+	from reserver.jobs import attempt_email_delivery
+	delivery = get_object_or_404(EmailDelivery, pk=pk)
+	delivery.status = EmailDelivery.PENDING
+	delivery.attempts = 0
+	delivery.last_error = ''
+	if attempt_email_delivery(delivery):
+		messages.add_message(request, messages.SUCCESS, mark_safe('Email to ' + delivery.recipient + ' was sent.'))
+	else:
+		messages.add_message(request, messages.WARNING, mark_safe('Email to ' + delivery.recipient + ' could not be sent yet, and will be retried automatically.'))
+	action = Action(user=request.user, timestamp=timezone.now(), target=str(delivery))
+	action.action = "retried failed email"
+	action.save()
+	return HttpResponseRedirect(reverse_lazy('notifications'))
+	
+def delete_email_delivery_view(request, pk):
+	delivery = get_object_or_404(EmailDelivery, pk=pk)
+	action = Action(user=request.user, timestamp=timezone.now(), target=str(delivery))
+	action.action = "discarded failed email"
+	action.save()
+	delivery.delete()
+	messages.add_message(request, messages.SUCCESS, mark_safe('Failed email discarded.'))
+	return HttpResponseRedirect(reverse_lazy('notifications'))
 
 class SettingsEditView(UpdateView):
 	model = Settings
@@ -2369,8 +2592,21 @@ def cruise_receipt_source(request):
 	
 # calendar views
 	
+# red days are generated for the calendar this many years around the current one
+CALENDAR_RED_DAY_YEAR_SPAN = 20
+
 def calendar_event_source(request):
-	events = list(Event.objects.filter(start_time__isnull=False).distinct())
+	# the calendar asks for the shown period in milliseconds; make sure its red days exist
+	current_year = timezone.now().year
+	try:
+		first_year = datetime.datetime.fromtimestamp(int(request.GET['from'])/1000, tz=timezone.utc).year
+		last_year = datetime.datetime.fromtimestamp(int(request.GET['to'])/1000, tz=timezone.utc).year
+	except (KeyError, ValueError, OverflowError, OSError):
+		first_year = last_year = current_year
+	first_year = max(first_year, current_year-CALENDAR_RED_DAY_YEAR_SPAN)
+	last_year = min(last_year, current_year+CALENDAR_RED_DAY_YEAR_SPAN)
+	ensure_red_days_for_years(range(first_year, last_year+1))
+	events = list(Event.objects.filter(start_time__isnull=False).distinct().select_related('category', 'season', 'cruiseday__cruise__leader', 'cruiseday__cruise__organization'))
 	calendar_events = {"success": 1, "result": []}
 	for event in events:
 		if (event.is_hidden_from_users and not request.user.is_superuser):